@@ -0,0 +1,815 @@
+"""
+ChatFight Replay Benchmark
+==========================
+Reproduce un corpus de imágenes de ChatFight a través del pipeline real del bot
+(chatfight_handler -> process_chatfight_message -> ChatFightProcessor) sin Telegram,
+sin Groq y sin MongoDB:
+
+- Telegram: Client/Message falsos en proceso que sirven la imagen desde memoria
+- Groq: servidor HTTP local compatible con la API de chat completions, con
+  latencia configurable e inyección de errores
+- MongoDB: colecciones en memoria
+
+Informa throughput, percentiles de latencia extremo a extremo, pico de memoria
+y precisión frente a las etiquetas del corpus.
+
+Uso:
+    python bench.py --corpus corpus/ --repeat 3 --latency 400 --error-rate 0.05
+    python bench.py --synthetic 50
+
+El corpus es un directorio con imágenes y un labels.json:
+    {"casa.jpg": {"tipo": "palabra", "answer": "CASA"}, ...}
+"""
+
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import time
+import tracemalloc
+from collections import Counter, deque
+from io import BytesIO
+from types import SimpleNamespace
+from typing import Dict, List, Optional, Tuple
+
+# El bot lee la configuración al importarse: valores inocuos para ejecutar sin red.
+# MONGO_URI apunta a un puerto cerrado con timeout mínimo; las colecciones se sustituyen después.
+os.environ.setdefault("API_ID", "1")
+os.environ.setdefault("API_HASH", "bench")
+os.environ.setdefault("CHATFIGHT_BOT_ID", "691070694")
+os.environ.setdefault("CHATFIGHT_GROUP_ID", "-1000000000001")
+os.environ["MONGO_URI"] = "mongodb://127.0.0.1:1/?serverSelectionTimeoutMS=1"
+logging.getLogger("chatfight-bot").setLevel(logging.CRITICAL)
+
+import main  # noqa: E402
+from pyrogram import raw, utils  # noqa: E402
+
+log = logging.getLogger("chatfight-bench")
+
+# =============================================================================
+# MONGODB STAND-IN
+# =============================================================================
+
+class MemoryCursor:
+    """Cursor mínimo con sort/limit"""
+
+    def __init__(self, docs: List[dict]):
+        self._docs = docs
+
+    def sort(self, key: str, direction: int = 1):
+        self._docs.sort(key=lambda d: d.get(key) or 0, reverse=direction < 0)
+        return self
+
+    def limit(self, n: int):
+        self._docs = self._docs[:n]
+        return self
+
+    def __iter__(self):
+        return iter(self._docs)
+
+
+class MemoryCollection:
+    """Colección en memoria con el subconjunto de operaciones que usa el bot"""
+
+    def __init__(self):
+        self.docs: List[dict] = []
+        self.writes = 0
+
+    def create_index(self, *args, **kwargs):
+        return "memory"
+
+    def _matches(self, doc: dict, query: dict) -> bool:
+        return all(doc.get(k) == v for k, v in query.items())
+
+    def find_one(self, query: dict):
+        return next((d for d in self.docs if self._matches(d, query)), None)
+
+    def find(self, query: Optional[dict] = None):
+        return MemoryCursor([d for d in self.docs if self._matches(d, query or {})])
+
+    def insert_many(self, docs, ordered: bool = True):
+        self.writes += 1
+        self.docs.extend(dict(d) for d in docs)
+
+    def update_one(self, query: dict, update: dict, upsert: bool = False):
+        self.writes += 1
+        doc = self.find_one(query)
+        if doc is None:
+            if not upsert:
+                return
+            doc = dict(query)
+            self.docs.append(doc)
+        for path, value in update.get("$set", {}).items():
+            _set_path(doc, path, value)
+        for path, amount in update.get("$inc", {}).items():
+            _set_path(doc, path, (_get_path(doc, path) or 0) + amount)
+        for path, spec in update.get("$push", {}).items():
+            items = (_get_path(doc, path) or []) + list(spec["$each"])
+            if "$slice" in spec:
+                items = items[spec["$slice"]:]
+            _set_path(doc, path, items)
+
+
+def _get_path(doc: dict, path: str):
+    for part in path.split("."):
+        if not isinstance(doc, dict):
+            return None
+        doc = doc.get(part)
+    return doc
+
+
+def _set_path(doc: dict, path: str, value):
+    parts = path.split(".")
+    for part in parts[:-1]:
+        doc = doc.setdefault(part, {})
+    doc[parts[-1]] = value
+
+
+def install_memory_mongo() -> Dict[str, MemoryCollection]:
+    """Sustituye las colecciones de MongoDB del bot por colecciones en memoria"""
+    collections = {"stats": MemoryCollection(), "cache": MemoryCollection(), "history": MemoryCollection()}
+    main.get_chatfight_collection = lambda: collections["stats"]
+    main.get_cache_collection = lambda: collections["cache"]
+    main.get_history_collection = lambda: collections["history"]
+    main.mongo_ready.set()
+    return collections
+
+# =============================================================================
+# TELEGRAM STAND-IN
+# =============================================================================
+
+class FakeMessage:
+    """Mensaje de Pyrogram con los atributos que usa el bot"""
+
+    _next_id = 1
+
+    def __init__(self, client: "FakeClient", chat_id: int, user_id: int, caption: Optional[str] = None,
+                 text: Optional[str] = None, image: Optional[bytes] = None, as_document: bool = False,
+                 mime_type: str = "image/jpeg"):
+        self.id = FakeMessage._next_id
+        FakeMessage._next_id += 1
+        self._client = client
+        self.chat = SimpleNamespace(id=chat_id, username=None)
+        self.from_user = SimpleNamespace(id=user_id, username=None, is_self=user_id == client.me.id)
+        self.outgoing = self.from_user.is_self
+        self.caption = caption
+        self.text = text
+        self.entities = None
+        self.reply_to_message_id = None
+        self.photo = None
+        self.document = None
+        self.replies: List[str] = []
+        if image is not None:
+            file_unique_id = hashlib.sha1(image).hexdigest()[:16]
+            media = client.register_media(file_unique_id, image)
+            if as_document:
+                self.document = SimpleNamespace(**media, mime_type=mime_type, file_name="image.jpg")
+            else:
+                thumbs = [
+                    SimpleNamespace(**client.register_media(f"{file_unique_id}_{width}", data), width=width, height=height)
+                    for width, height, data in make_thumbnails(image)
+                ]
+                self.photo = SimpleNamespace(**media, thumbs=thumbs)
+
+    async def reply(self, text: str, *args, **kwargs):
+        return await self._client.send_message(self.chat.id, text, reply_to_message_id=self.id)
+
+    async def reply_text(self, text: str, *args, **kwargs):
+        return await self.reply(text)
+
+    async def delete(self):
+        return True
+
+
+class FakeClient:
+    """Cliente de Pyrogram en proceso: sirve medios desde memoria y registra los envíos"""
+
+    name = "bench"
+
+    def __init__(self, download_latency: float = 0.0):
+        self.download_latency = download_latency
+        self.media: Dict[str, bytes] = {}
+        self.sent: List[dict] = []
+        self.bytes_downloaded = 0
+        self.peer_lookups = 0
+        self.me = SimpleNamespace(id=4242, username="benchbot", first_name="Bench")
+        # Rondas en juego: message_id -> {"answer", "decided"}. La primera respuesta correcta gana
+        self.rounds: Dict[int, dict] = {}
+        self._verdicts: List[asyncio.Task] = []
+
+    def register_media(self, file_unique_id: str, data: bytes) -> dict:
+        self.media[file_unique_id] = data
+        return {"file_id": file_unique_id, "file_unique_id": file_unique_id, "file_size": len(data)}
+
+    async def download_media(self, media, in_memory: bool = False, **kwargs):
+        if self.download_latency:
+            await asyncio.sleep(self.download_latency)
+        file_id = media if isinstance(media, str) else media.file_id
+        data = self.media[file_id]
+        self.bytes_downloaded += len(data)
+        buffer = BytesIO(data)
+        buffer.name = f"{file_id}.jpg"
+        return buffer
+
+    async def resolve_peer(self, chat_id: int):
+        self.peer_lookups += 1
+        return raw.types.InputPeerChannel(channel_id=utils.get_channel_id(chat_id), access_hash=0)
+
+    def rnd_id(self) -> int:
+        return random.getrandbits(63)
+
+    async def invoke(self, query):
+        """Vía cruda: solo messages.SendMessage, con el resultado que devuelve Telegram en un grupo"""
+        if not isinstance(query, raw.functions.messages.SendMessage):
+            raise NotImplementedError(type(query).__name__)
+        chat_id = utils.get_peer_id(raw.types.PeerChannel(channel_id=query.peer.channel_id))
+        sent = await self.send_message(chat_id, query.message, reply_to_message_id=query.reply_to_msg_id)
+        return raw.types.Updates(
+            updates=[raw.types.UpdateMessageID(id=sent.id, random_id=query.random_id)],
+            users=[], chats=[], date=int(time.time()), seq=0,
+        )
+
+    async def send_message(self, chat_id: int, text: str, reply_to_message_id: Optional[int] = None, **kwargs):
+        self.sent.append({
+            "chat_id": chat_id,
+            "text": text,
+            "reply_to_message_id": reply_to_message_id,
+            "at": time.perf_counter(),
+        })
+        sent = SentMessage(chat_id, text)
+        game = self.rounds.get(reply_to_message_id)
+        if game is not None and not game["decided"] and text.strip().lower() == game["answer"].lower():
+            # Primera respuesta correcta: ChatFight anuncia que hemos ganado respondiendo a nuestro mensaje
+            game["decided"] = True
+            verdict = FakeMessage(self, chat_id, main.settings.bot_id,
+                                  text=f"🏆 @{self.me.username} ha ganado. La respuesta correcta era: {game['answer']}")
+            verdict.reply_to_message_id = sent.id
+            self._verdicts.append(asyncio.create_task(dispatch(self, verdict)))
+        return sent
+
+
+class SentMessage:
+    """Mensaje enviado por el bot: se puede editar y borrar"""
+
+    def __init__(self, chat_id: int, text: str):
+        self.id = FakeMessage._next_id
+        FakeMessage._next_id += 1
+        self.chat = SimpleNamespace(id=chat_id)
+        self.text = text
+
+    async def edit_text(self, text: str, *args, **kwargs):
+        self.text = text
+        return self
+
+    async def delete(self):
+        return True
+
+# =============================================================================
+# GROQ STAND-IN
+# =============================================================================
+
+class MockInferenceServer:
+    """
+    Servidor HTTP/1.1 local compatible con /openai/v1/chat/completions.
+    Identifica la imagen por el hash de sus bytes y responde con la etiqueta del corpus.
+    """
+
+    def __init__(self, answers: Dict[str, str], latency: float = 0.3, jitter: float = 0.1,
+                 error_rate: float = 0.0, wrong_rate: float = 0.0, slow_rate: float = 0.0,
+                 chatter_tokens: int = 0, token_latency: float = 0.0, connect_latency: float = 0.0,
+                 rpm: int = 0, seed: int = 0):
+        self.answers = answers
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.wrong_rate = wrong_rate
+        self.slow_rate = slow_rate
+        self.chatter_tokens = chatter_tokens
+        self.token_latency = token_latency
+        self.connect_latency = connect_latency
+        # Límite de peticiones por minuto y clave, como el de Groq (0 = sin límite)
+        self.rpm = rpm
+        self._windows: Dict[str, deque] = {}
+        self.rate_limited = 0
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.errors = 0
+        self.connections = 0
+        self._server = None
+        self._connections = set()
+
+    @staticmethod
+    def image_key(data: bytes) -> str:
+        return hashlib.sha256(data).hexdigest()
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        self._server = await asyncio.start_server(self._handle, host, port)
+        host, port = self._server.sockets[0].getsockname()[:2]
+        return f"http://{host}:{port}"
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            # Cerrar también las conexiones keep-alive que sigan abiertas
+            for writer in list(self._connections):
+                writer.close()
+            await self._server.wait_closed()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._connections.add(writer)
+        self.connections += 1
+        try:
+            # Coste de abrir una conexión nueva (handshake TCP/TLS)
+            if self.connect_latency:
+                await asyncio.sleep(self.connect_latency)
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", "0")))
+                extra = {}
+                if request_line.split()[1].split(b"?")[0].endswith(b"/models"):
+                    status, payload, tokens = "200 OK", {"object": "list", "data": [{"id": "mock", "object": "model"}]}, None
+                else:
+                    extra, limited = self._rate_limit(headers.get("authorization", ""))
+                    if limited:
+                        status, payload, tokens = "429 Too Many Requests", {
+                            "error": {"message": "rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}
+                        }, None
+                    else:
+                        status, payload, tokens = await self._complete(body)
+                head = "".join(f"{name}: {value}\r\n" for name, value in extra.items())
+                if tokens is not None:
+                    await self._stream(writer, payload, tokens, head)
+                    continue
+                data = json.dumps(payload).encode()
+                writer.write(
+                    f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\n{head}"
+                    f"Content-Length: {len(data)}\r\n\r\n".encode() + data
+                )
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self._connections.discard(writer)
+            writer.close()
+
+    def _rate_limit(self, api_key: str) -> Tuple[Dict[str, str], bool]:
+        """Ventana deslizante de un minuto por clave. Returns: (cabeceras x-ratelimit-*, limitada)"""
+        if not self.rpm:
+            return {}, False
+        now = time.monotonic()
+        window = self._windows.setdefault(api_key, deque())
+        while window and now - window[0] >= 60:
+            window.popleft()
+        limited = len(window) >= self.rpm
+        if not limited:
+            window.append(now)
+        reset = 60 - (now - window[0]) if window else 0.0
+        headers = {
+            "x-ratelimit-limit-requests": str(self.rpm),
+            "x-ratelimit-remaining-requests": str(self.rpm - len(window)),
+            "x-ratelimit-reset-requests": f"{reset:.2f}s",
+        }
+        if limited:
+            self.rate_limited += 1
+            headers["retry-after"] = str(max(1, int(reset + 0.999)))
+        return headers, limited
+
+    async def _complete(self, body: bytes):
+        self.requests += 1
+        request = json.loads(body or b"{}")
+        delay = max(0.0, self.random.gauss(self.latency, self.jitter)) if self.jitter else self.latency
+        if self.random.random() < self.slow_rate:
+            delay *= 10
+        await asyncio.sleep(delay)
+
+        if self.random.random() < self.error_rate:
+            self.errors += 1
+            return "500 Internal Server Error", {"error": {"message": "injected error", "type": "server_error"}}, None
+
+        answer = ""
+        for message in request.get("messages", []):
+            content = message.get("content")
+            for part in content if isinstance(content, list) else []:
+                if part.get("type") == "image_url":
+                    url = part["image_url"]["url"]
+                    data = base64.b64decode(url.split(",", 1)[1])
+                    answer = self.answers.get(self.image_key(data), "NOSE")
+        if self.random.random() < self.wrong_rate:
+            answer = "Creo que la respuesta es " + answer[::-1]
+        # Texto de relleno tras la respuesta, como hacen a veces los modelos
+        answer += "".join(["\n\nEspero", " que", " te", " sirva", "."][i % 5] for i in range(self.chatter_tokens))
+
+        tokens = [answer[i:i + 3] for i in range(0, len(answer), 3)]
+        if request.get("stream"):
+            return "200 OK", {"id": f"chatcmpl-{self.requests}", "model": request.get("model", "mock")}, tokens
+        # Sin streaming el cliente espera a que se generen todos los tokens
+        await asyncio.sleep(len(tokens) * self.token_latency)
+
+        return "200 OK", {
+            "id": f"chatcmpl-{self.requests}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "mock"),
+            "choices": [{
+                "index": 0,
+                "finish_reason": "stop",
+                "message": {"role": "assistant", "content": answer},
+            }],
+            "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+        }, None
+
+    async def _stream(self, writer: asyncio.StreamWriter, meta: dict, tokens: List[str], head: str = ""):
+        """Envía la respuesta como server-sent events (chunked, la conexión sigue viva), un fragmento por token"""
+        def send(data: bytes):
+            writer.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+
+        writer.write(
+            f"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n{head}Transfer-Encoding: chunked\r\n\r\n".encode()
+        )
+        for token in tokens:
+            chunk = {
+                "id": meta["id"],
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": meta["model"],
+                "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}],
+            }
+            send(f"data: {json.dumps(chunk)}\n\n".encode())
+            await writer.drain()
+            if self.token_latency:
+                await asyncio.sleep(self.token_latency)
+        send(b"data: [DONE]\n\n")
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+# =============================================================================
+# CORPUS
+# =============================================================================
+
+def load_corpus(path: str) -> List[dict]:
+    """Carga imágenes y etiquetas de un directorio con labels.json"""
+    with open(os.path.join(path, "labels.json"), encoding="utf-8") as f:
+        labels = json.load(f)
+    corpus = []
+    for name, label in sorted(labels.items()):
+        with open(os.path.join(path, name), "rb") as f:
+            corpus.append({"name": name, "image": f.read(), "tipo": label["tipo"], "answer": str(label["answer"])})
+    return corpus
+
+
+def synthetic_corpus(count: int, seed: int = 0) -> List[dict]:
+    """Genera imágenes de palabras y operaciones con Pillow"""
+    from PIL import Image, ImageDraw
+
+    rng = random.Random(seed)
+    syllables = ["CA", "SA", "PE", "RRO", "GA", "TO", "ME", "LI", "BRO", "NU", "BE", "FUE", "GO", "PLA", "YA"]
+    corpus = []
+    for i in range(count):
+        if i % 2:
+            a, b = rng.randint(1, 99), rng.randint(1, 99)
+            op = rng.choice("+-*")
+            text, tipo = f"{a} {op} {b}", "operacion"
+            answer = str(main.safe_eval(f"{a}{op}{b}"))
+        else:
+            text = answer = "".join(rng.choice(syllables) for _ in range(rng.randint(2, 4)))
+            tipo = "palabra"
+        img = Image.new("RGB", (480, 240), (rng.randint(180, 255), rng.randint(180, 255), rng.randint(180, 255)))
+        ImageDraw.Draw(img).text((40, 100), text, fill=(0, 0, 0))
+        buffer = BytesIO()
+        img.save(buffer, "JPEG", quality=90)
+        corpus.append({"name": f"synthetic_{i}", "image": buffer.getvalue(), "tipo": tipo, "answer": answer})
+    return corpus
+
+
+THUMBNAIL_SIDES = (90, 320)
+_thumbnails: Dict[str, List[Tuple[int, int, bytes]]] = {}
+
+
+def make_thumbnails(image: bytes) -> List[Tuple[int, int, bytes]]:
+    """Miniaturas JPEG al estilo de Telegram (lado mayor de 90 y 320 px): [(ancho, alto, bytes)]"""
+    key = hashlib.sha1(image).hexdigest()
+    if key not in _thumbnails:
+        from PIL import Image
+
+        thumbs = []
+        with Image.open(BytesIO(image)) as img:
+            for side in THUMBNAIL_SIDES:
+                if max(img.size) <= side:
+                    continue
+                thumb = img.convert("RGB")
+                thumb.thumbnail((side, side))
+                buffer = BytesIO()
+                thumb.save(buffer, "JPEG", quality=80)
+                thumbs.append((thumb.width, thumb.height, buffer.getvalue()))
+        _thumbnails[key] = thumbs
+    return _thumbnails[key]
+
+
+def corpus_answers(corpus: List[dict], unreadable_below: int = 0) -> Dict[str, str]:
+    """
+    Respuestas del servidor de inferencia por hash de imagen: el original, sus miniaturas
+    (las menores que `unreadable_below` no se leen) y cada una procesada con los perfiles
+    entre los que elige el router
+    """
+    profiles = [profile for profile in main.router.profiles() if profile is not None]
+    answers = {}
+    for item in corpus:
+        renditions = [(item["image"], item["answer"])]
+        for width, height, data in make_thumbnails(item["image"]):
+            readable = max(width, height) >= unreadable_below
+            renditions.append((data, item["answer"] if readable else "No se puede leer"))
+        for data, answer in renditions:
+            answers[MockInferenceServer.image_key(data)] = answer
+            for profile in profiles:
+                processed, _ = main.preprocess_image(data, "image/jpeg", profile)
+                answers[MockInferenceServer.image_key(processed)] = answer
+    return answers
+
+
+def caption_for(tipo: str) -> str:
+    return main.CAPTION_OPERACION if tipo == "operacion" else main.CAPTION_PALABRA
+
+# =============================================================================
+# BENCHMARK
+# =============================================================================
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def dispatch(client: FakeClient, message: FakeMessage):
+    """
+    Entrega un mensaje como lo haría Pyrogram: el handler de juegos (con su filtro) y,
+    en el grupo de handlers 1, el de señales de cierre de ronda para mensajes del bot
+    """
+    if await main.chatfight_game_filter(client, message):
+        await main.chatfight_handler(client, message)
+    if message.from_user.id == main.settings.bot_id:
+        await main.round_signal_handler(client, message)
+
+
+async def announce_winner(client: FakeClient, message: FakeMessage, answer: str, delay: float):
+    """
+    Otro jugador acierta a los `delay` segundos: si el bot no ganó antes, ChatFight anuncia
+    al rival respondiendo al juego y revela la respuesta correcta
+    """
+    game = client.rounds[message.id] = {"answer": answer, "decided": False}
+    await asyncio.sleep(delay)
+    if game["decided"]:
+        return
+    game["decided"] = True
+    winner = FakeMessage(client, message.chat.id, main.settings.bot_id,
+                         text=f"🏆 Otro jugador ha ganado la ronda. La respuesta correcta era: {answer}")
+    winner.reply_to_message_id = message.id
+    winner.reply_to_message = message
+    await dispatch(client, winner)
+
+
+async def run_benchmark(args) -> dict:
+    corpus = load_corpus(args.corpus) if args.corpus else synthetic_corpus(args.synthetic, args.seed)
+    if not corpus:
+        raise SystemExit("Corpus vacío")
+
+    collections = install_memory_mongo()
+    # Perfil de preprocesado: el servidor reconoce tanto la imagen original como la procesada
+    if args.no_preprocess:
+        main.image_profile = None
+    elif main.Image is not None:
+        main.image_profile = main.ImageProfile(
+            crop=not args.no_crop, max_side=args.max_side, mode=args.image_mode, quality=args.quality,
+        )
+    # Las miniaturas por debajo de --unreadable-below se "leen" mal, lo que fuerza el escalado al original
+    main.runtime_settings.get("photo_min_side").setter(args.min_side)
+    main.router = main.InferenceRouter(enabled=not args.no_router)
+    answers = corpus_answers(corpus, args.unreadable_below)
+    server = MockInferenceServer(
+        answers,
+        latency=args.latency / 1000, jitter=args.jitter / 1000,
+        error_rate=args.error_rate, wrong_rate=args.wrong_rate, slow_rate=args.slow_rate,
+        chatter_tokens=args.chatter, token_latency=args.token_latency / 1000,
+        connect_latency=args.connect_latency / 1000, rpm=args.rpm, seed=args.seed,
+    )
+    os.environ["GROQ_BASE_URL"] = await server.start()
+
+    client = FakeClient(download_latency=args.download_latency / 1000)
+    # Grupos simulados: sin límite de respuestas para medir el pipeline completo
+    group_ids = [int(main.settings.group_id) - index for index in range(args.groups)]
+    main.shards.clear()
+    for group_id in group_ids:
+        shard = main.GroupShard(group_id, rate_per_minute=0)
+        shard.enabled = True
+        main.shards[group_id] = shard
+    main._chatfight_processor = main.ChatFightProcessor(
+        "bench-key", max_concurrency=args.concurrency,
+        api_keys=[f"bench-key-{i + 1}" for i in range(args.keys)],
+        backup_model=args.backup_model, hedge_delay=args.hedge_delay / 1000,
+        streaming=not args.no_stream,
+    )
+    # Las rondas se reproducen más rápido que en un grupo real: solo se descartan las
+    # superadas por otra más reciente si se pide expresamente
+    main._chatfight_processor.scheduler.drop_superseded = args.drop_superseded
+    main.round_tracker.close_on_next = args.drop_superseded
+    main._local_solver = main.LocalArithmeticSolver()
+    if args.warmup:
+        await main._chatfight_processor.warm_up()
+    for shard in main.shards.values():
+        shard.writer.start()
+    main.history_writer.start()
+    main.router.writer.start()
+    main.loop_monitor.start()
+    main.post_processor.start()
+
+    tracemalloc.start()
+    interval = 1.0 / args.rate if args.rate else 0.0
+    rounds = []
+    winners: List[asyncio.Task] = []
+    started = time.perf_counter()
+
+    for _ in range(args.repeat):
+        for index, item in enumerate(corpus):
+            message = FakeMessage(
+                client, group_ids[index % len(group_ids)], main.settings.bot_id,
+                caption=caption_for(item["tipo"]), image=item["image"], as_document=args.documents,
+            )
+            rounds.append({"message": message, "item": item, "sent_at": time.perf_counter()})
+            await dispatch(client, message)
+            if args.winner_after:
+                winners.append(asyncio.create_task(
+                    announce_winner(client, message, item["answer"], args.winner_after / 1000)))
+            for n in range(args.noise):
+                noise = FakeMessage(client, message.chat.id, 1000 + n, text=f"mensaje de charla {n}")
+                await dispatch(client, noise)
+            if interval:
+                await asyncio.sleep(interval)
+
+    while main._chatfight_tasks:
+        await asyncio.gather(*list(main._chatfight_tasks), return_exceptions=True)
+    elapsed = time.perf_counter() - started
+    # Los anuncios pendientes cierran las rondas y dan el resultado de cada respuesta
+    await asyncio.gather(*winners, return_exceptions=True)
+    await asyncio.gather(*client._verdicts, return_exceptions=True)
+    await main.post_processor.stop()
+    for shard in main.shards.values():
+        await shard.writer.stop()
+    await main.history_writer.stop()
+    await main.router.writer.stop()
+    await main.loop_monitor.stop()
+    _, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    replies = {}
+    for sent in client.sent:
+        replies.setdefault(sent["reply_to_message_id"], sent)
+
+    latencies, correct = [], 0
+    for entry in rounds:
+        reply = replies.get(entry["message"].id)
+        if reply is None:
+            continue
+        latencies.append(reply["at"] - entry["sent_at"])
+        if reply["text"].strip().lower() == entry["item"]["answer"].strip().lower():
+            correct += 1
+
+    await main._chatfight_processor.close()
+    main._local_solver.close()
+    await server.stop()
+
+    return {
+        "rounds": len(rounds),
+        "answered": len(latencies),
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed else None,
+        "latency_ms": {
+            f"p{int(q * 100)}": round(percentile(latencies, q) * 1000, 1) if latencies else None
+            for q in (0.5, 0.95, 0.99)
+        },
+        "accuracy": round(correct / len(rounds), 4),
+        "inference_requests": server.requests,
+        "http_connections": server.connections,
+        "warmup": dict(main.warmup_status),
+        "injected_errors": server.errors,
+        "rate_limited_429": server.rate_limited,
+        "scheduler": {
+            "dropped": main._chatfight_processor.scheduler.dropped,
+            "retries": main._chatfight_processor.scheduler.retries,
+            "throttled": main._chatfight_processor.scheduler.throttled,
+        },
+        "hedged_requests": main._chatfight_processor.hedges,
+        "early_stops": main._chatfight_processor.early_stops,
+        "bytes_downloaded": client.bytes_downloaded,
+        "peer_lookups": client.peer_lookups,
+        "downloads": {
+            "thumbnails": main.download_stats.thumbnails,
+            "escalations": main.download_stats.escalations,
+        },
+        "image_profile": main.image_profile.name if main.image_profile else "original",
+        "payload": {name: {k: int(v) for k, v in entry.items()} for name, entry in main.preprocess_stats.profiles.items()},
+        "mongo_writes": collections["stats"].writes,
+        "history": {
+            "rounds": len(collections["history"].docs),
+            "inserts": collections["history"].writes,
+            "sources": dict(Counter(doc["source"] for doc in collections["history"].docs)),
+        },
+        "responses_per_group": {str(s.group_id): s.stats["total_responses"] for s in main.shards.values()},
+        "rounds_completed": sum(s.stats["rounds_completed"] for s in main.shards.values()),
+        "rounds_cancelled": sum(s.stats["rounds_cancelled"] for s in main.shards.values()),
+        "outcomes": dict(main.outcome_tracker.counts),
+        "router": {
+            tipo: {arm.label: f"{arm.wins}/{arm.pulls}" for arm in arms.values()}
+            for tipo, arms in main.router.arms.items()
+        },
+        "event_loop": {
+            "lag_p99_ms": round((main.loop_monitor.lag.percentiles(0.99)[0] or 0) * 1000, 1),
+            "lag_max_ms": round(main.loop_monitor.max_lag * 1000, 1),
+            "blocks": main.loop_monitor.blocks,
+            "max_tasks": main.loop_monitor.max_tasks,
+        },
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "tracemalloc_peak_mb": round(traced_peak / 1024 / 1024, 2),
+        "stages": main.metrics.summary_text(),
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark offline del pipeline de ChatFight")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--corpus", help="Directorio con imágenes y labels.json")
+    source.add_argument("--synthetic", type=int, default=20, help="Genera N imágenes sintéticas (por defecto)")
+    parser.add_argument("--repeat", type=int, default=1, help="Veces que se reproduce el corpus")
+    parser.add_argument("--rate", type=float, default=0.0, help="Rondas por segundo (0 = todas a la vez)")
+    parser.add_argument("--concurrency", type=int, default=main.settings.groq_max_concurrency, help="Inferencias simultáneas")
+    parser.add_argument("--latency", type=float, default=300.0, help="Latencia media de inferencia (ms)")
+    parser.add_argument("--jitter", type=float, default=50.0, help="Desviación de la latencia (ms)")
+    parser.add_argument("--download-latency", type=float, default=20.0, help="Latencia de descarga (ms)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fracción de respuestas HTTP 500")
+    parser.add_argument("--wrong-rate", type=float, default=0.0, help="Fracción de respuestas con texto basura")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="Fracción de inferencias 10 veces más lentas")
+    parser.add_argument("--backup-model", default=main.settings.groq_backup_model, help="Modelo de respaldo (activa hedging)")
+    parser.add_argument("--hedge-delay", type=float, default=main.settings.hedge_delay * 1000, help="Espera antes del respaldo (ms)")
+    parser.add_argument("--chatter", type=int, default=0, help="Tokens de relleno tras la respuesta")
+    parser.add_argument("--drop-superseded", action="store_true", help="Descarta las rondas superadas por una más reciente del mismo grupo")
+    parser.add_argument("--no-router", action="store_true", help="Siempre el modelo principal, el prompt base y el perfil activo")
+    parser.add_argument("--winner-after", type=float, default=0.0, help="Otro jugador gana cada ronda a los N ms (0 = nunca)")
+    parser.add_argument("--rpm", type=int, default=0, help="Límite de peticiones por minuto y clave del servidor (0 = sin límite)")
+    parser.add_argument("--keys", type=int, default=1, help="Claves de API entre las que repartir las peticiones")
+    parser.add_argument("--connect-latency", type=float, default=0.0, help="Coste de abrir cada conexión HTTP (ms)")
+    parser.add_argument("--warmup", action="store_true", help="Calienta las conexiones con Groq antes de la primera ronda")
+    parser.add_argument("--token-latency", type=float, default=0.0, help="Latencia entre tokens en streaming (ms)")
+    parser.add_argument("--no-stream", action="store_true", help="Desactiva el streaming de tokens")
+    parser.add_argument("--no-preprocess", action="store_true", help="Envía las imágenes sin preprocesar")
+    parser.add_argument("--no-crop", action="store_true", help="No recorta la imagen al contenido")
+    parser.add_argument("--max-side", type=int, default=main.settings.image_max_side, help="Lado máximo en píxeles (0 = sin reducir)")
+    parser.add_argument("--image-mode", choices=main.ImageProfile.MODES, default=main.settings.image_mode, help="Modo de color")
+    parser.add_argument("--quality", type=int, default=main.settings.image_quality, help="Calidad JPEG")
+    parser.add_argument("--min-side", type=int, default=main.settings.photo_min_side, help="Lado mínimo de la miniatura a descargar (0 = siempre el original)")
+    parser.add_argument("--unreadable-below", type=int, default=0, help="Las miniaturas con lado mayor inferior no se reconocen")
+    parser.add_argument("--documents", action="store_true", help="Envía las imágenes como documentos")
+    parser.add_argument("--noise", type=int, default=0, help="Mensajes de charla (no juegos) enviados tras cada ronda")
+    parser.add_argument("--groups", type=int, default=1, help="Grupos (shards) entre los que se reparten las rondas")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--min-accuracy", type=float, default=None, help="Sale con código 1 si la precisión es menor")
+    parser.add_argument("--json", action="store_true", help="Salida en JSON")
+    parser.add_argument("--verbose", action="store_true", help="Muestra los logs del bot")
+    return parser.parse_args(argv)
+
+
+def main_cli(argv=None) -> int:
+    args = parse_args(argv)
+    logging.getLogger("chatfight-bot").setLevel(logging.INFO if args.verbose else logging.CRITICAL)
+    logging.getLogger("httpx").setLevel(logging.INFO if args.verbose else logging.WARNING)
+    report = asyncio.run(run_benchmark(args))
+
+    if args.json:
+        print(json.dumps(report, indent=2, ensure_ascii=False))
+    else:
+        stages = report.pop("stages")
+        for key, value in report.items():
+            print(f"{key:>22}: {value}")
+        print("\nLatencias por etapa:")
+        print(stages)
+
+    if args.min_accuracy is not None and report["accuracy"] < args.min_accuracy:
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
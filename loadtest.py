@@ -0,0 +1,413 @@
+"""
+ChatFight Load Test
+===================
+Inunda un grupo simulado con mensajes sintéticos de Pyrogram y los entrega a los
+handlers reales del bot tal como lo haría el dispatcher de Pyrogram (filtros,
+grupos de handlers y un número fijo de workers), contra los mismos sustitutos en
+proceso de Telegram, Groq y MongoDB que usa bench.py.
+
+La mezcla de mensajes es configurable: charla, comandos (-cf, -ping, .help...),
+juegos con foto y juegos con la imagen como documento. Informa:
+
+- mensajes por segundo entregados y cola pendiente en el dispatcher
+- tareas de asyncio en vuelo y rondas en proceso (actual y máximo)
+- RSS y crecimiento de tracemalloc, con las líneas que más memoria retienen
+- tiempo dentro de cada handler por tipo de mensaje y retraso del event loop
+- actualizaciones de estadísticas perdidas o duplicadas: respuestas enviadas frente
+  a los contadores en memoria y frente al documento persistido
+
+Uso:
+    python loadtest.py --rate 200 --duration 20
+    python loadtest.py --rate 50 --mix chatter=50,command=10,photo=30,document=10 --json
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import time
+import tracemalloc
+from collections import Counter
+from typing import Dict, List, Optional
+
+import bench
+from bench import FakeClient, FakeMessage, MockInferenceServer, main
+from pyrogram.handlers import MessageHandler
+
+log = logging.getLogger("chatfight-loadtest")
+
+KINDS = ("chatter", "command", "photo", "document")
+
+CHATTER = (
+    "jajaja", "alguien juega?", "buenas noches", "qué fácil era esa", "otra ronda!",
+    "me ganaste por un segundo", "gg", "👍", "quién va primero en la tabla?",
+)
+
+# =============================================================================
+# MESSAGE GENERATION
+# =============================================================================
+
+def parse_mix(spec: str) -> Dict[str, float]:
+    """Pesos por tipo de mensaje: "chatter=70,command=5,photo=20,document=5" """
+    mix = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        kind, _, weight = item.partition("=")
+        if kind not in KINDS:
+            raise argparse.ArgumentTypeError(f"tipo de mensaje desconocido: {kind} (válidos: {', '.join(KINDS)})")
+        try:
+            mix[kind] = float(weight)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"peso no válido para {kind}: {weight!r}")
+    if not mix or sum(mix.values()) <= 0:
+        raise argparse.ArgumentTypeError("la mezcla necesita al menos un peso positivo")
+    return mix
+
+
+class MessageFactory:
+    """Genera mensajes sintéticos de un grupo según la mezcla indicada"""
+
+    def __init__(self, client: FakeClient, group_id: int, corpus: List[dict], mix: Dict[str, float],
+                 commands: List[str], seed: int = 0):
+        self.client = client
+        self.group_id = group_id
+        self.corpus = corpus
+        self.kinds = list(mix)
+        self.weights = [mix[kind] for kind in self.kinds]
+        self.commands = commands
+        self.random = random.Random(seed)
+        self.games: Dict[int, str] = {}
+        self._next_image = 0
+
+    def make(self) -> FakeMessage:
+        kind = self.random.choices(self.kinds, self.weights)[0]
+        if kind == "chatter":
+            message = FakeMessage(self.client, self.group_id, 1000 + self.random.randrange(50),
+                                  text=self.random.choice(CHATTER))
+        elif kind == "command":
+            # Los comandos los envía la propia cuenta
+            message = FakeMessage(self.client, self.group_id, self.client.me.id,
+                                  text=self.random.choice(self.commands))
+        else:
+            item = self.corpus[self._next_image % len(self.corpus)]
+            self._next_image += 1
+            message = FakeMessage(self.client, self.group_id, main.settings.bot_id,
+                                  caption=bench.caption_for(item["tipo"]), image=item["image"],
+                                  as_document=kind == "document")
+            self.games[message.id] = item["answer"]
+        message.kind = kind
+        return message
+
+# =============================================================================
+# DISPATCH
+# =============================================================================
+
+class Dispatcher:
+    """
+    Réplica del bucle de Pyrogram (Dispatcher.handler_worker): `workers` tareas leen de una
+    cola y, en cada grupo de handlers, ejecutan el primer MessageHandler cuyo filtro acepta
+    el mensaje. Un handler lento retiene a su worker igual que en producción.
+    """
+
+    def __init__(self, client: FakeClient, workers: int):
+        self.client = client
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.workers = workers
+        self.delivered = 0
+        self.errors = 0
+        self.max_backlog = 0
+        self.handler_time: Dict[str, List[float]] = {}
+        self._tasks: List[asyncio.Task] = []
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def put(self, message: FakeMessage):
+        self.queue.put_nowait(message)
+        self.max_backlog = max(self.max_backlog, self.queue.qsize())
+
+    async def _worker(self):
+        while True:
+            message = await self.queue.get()
+            started = time.perf_counter()
+            try:
+                await self.deliver(message)
+            finally:
+                self.handler_time.setdefault(message.kind, []).append(time.perf_counter() - started)
+                self.delivered += 1
+                self.queue.task_done()
+
+    async def deliver(self, message: FakeMessage):
+        for group in main.app.dispatcher.groups.values():
+            for handler in group:
+                if not isinstance(handler, MessageHandler):
+                    continue
+                try:
+                    if not await handler.check(self.client, message):
+                        continue
+                    await handler.callback(self.client, message)
+                except Exception as e:
+                    self.errors += 1
+                    log.debug(f"Error en {handler.callback.__name__}: {e}")
+                break
+
+    async def drain(self):
+        await self.queue.join()
+        for task in self._tasks:
+            task.cancel()
+
+# =============================================================================
+# RESOURCE SAMPLING
+# =============================================================================
+
+def current_rss_mb() -> float:
+    """RSS actual (Linux); en otros sistemas, el máximo alcanzado"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Sampler:
+    """Muestrea periódicamente tareas, rondas en proceso, cola, RSS y memoria de Python"""
+
+    def __init__(self, dispatcher: Dispatcher, interval: float):
+        self.dispatcher = dispatcher
+        self.interval = interval
+        self.peak = Counter()
+        self.samples = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def sample(self) -> dict:
+        values = {
+            "tasks": len(asyncio.all_tasks()),
+            "rounds_in_flight": len(main._chatfight_tasks),
+            "backlog": self.dispatcher.queue.qsize(),
+            "rss_mb": current_rss_mb(),
+            "traced_mb": tracemalloc.get_traced_memory()[0] / 1024 / 1024,
+        }
+        for key, value in values.items():
+            self.peak[key] = max(self.peak[key], value)
+        self.samples += 1
+        return values
+
+    async def _run(self):
+        while True:
+            self.sample()
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+
+# =============================================================================
+# LOAD TEST
+# =============================================================================
+
+def stats_integrity(client: FakeClient, factory: MessageFactory, shard: main.GroupShard,
+                    collections: Dict[str, bench.MemoryCollection]) -> dict:
+    """
+    Compara las respuestas que llegaron a Telegram con los contadores del grupo en memoria
+    y con el documento de MongoDB: cualquier diferencia es una actualización perdida o duplicada
+    """
+    replies = Counter(sent["reply_to_message_id"] for sent in client.sent
+                      if sent["reply_to_message_id"] in factory.games)
+    sent = sum(replies.values())
+    recorded = shard.stats["total_responses"]
+    by_type = sum(shard.stats.get(f"{name}_responses", 0) for name in main.GAME_TYPES)
+    doc = collections["stats"].find_one({"type": "chatfight_stats", "group_id": shard.group_id}) or {}
+    persisted = bench._get_path(doc, "stats.total_responses") or 0
+    rounds = shard.stats.get("rounds_completed", 0) + shard.stats.get("rounds_cancelled", 0)
+    return {
+        "replies_sent": sent,
+        "duplicated_replies": sum(count - 1 for count in replies.values()),
+        "recorded_in_memory": recorded,
+        "lost_in_memory": sent - recorded,
+        "per_type_mismatch": recorded - by_type,
+        "persisted": persisted,
+        "lost_in_mongo": recorded - persisted,
+        "errors": shard.stats["errors"],
+        "history_docs": len(collections["history"].docs),
+        "history_missing": rounds - len(collections["history"].docs),
+    }
+
+
+async def run_loadtest(args) -> dict:
+    # Los handlers se registran a nivel de módulo con tareas del loop de Pyrogram: dejarlas correr
+    await asyncio.sleep(0)
+    if not main.app.dispatcher.groups:
+        raise SystemExit("No hay handlers registrados en el cliente principal")
+
+    corpus = bench.synthetic_corpus(args.images, args.seed)
+    collections = bench.install_memory_mongo()
+    server = MockInferenceServer(
+        bench.corpus_answers(corpus),
+        latency=args.latency / 1000, jitter=args.jitter / 1000, seed=args.seed,
+    )
+    os.environ["GROQ_BASE_URL"] = await server.start()
+
+    client = FakeClient(download_latency=args.download_latency / 1000)
+    # Un solo grupo: el que filtran los handlers registrados al importar el bot
+    shard = main.shards[main.settings.group_id]
+    shard.enabled = True
+    shard.budget = main.RateBudget(args.rate_per_minute)
+    main._chatfight_processor = main.ChatFightProcessor(
+        "load-key", max_concurrency=args.concurrency,
+        api_keys=[f"load-key-{i + 1}" for i in range(args.keys)],
+    )
+    main._chatfight_processor.scheduler.drop_superseded = args.drop_superseded
+    main.round_tracker.close_on_next = args.drop_superseded
+    main._local_solver = main.LocalArithmeticSolver()
+    shard.writer.start()
+    main.history_writer.start()
+    main.router.writer.start()
+    main.loop_monitor.start()
+    main.post_processor.start()
+
+    factory = MessageFactory(client, shard.group_id, corpus, args.mix, args.commands, args.seed)
+    dispatcher = Dispatcher(client, args.workers)
+    sampler = Sampler(dispatcher, args.sample_interval)
+
+    tracemalloc.start()
+    baseline = tracemalloc.take_snapshot()
+    start_sample = sampler.sample()
+    dispatcher.start()
+    sampler.start()
+
+    total = int(args.rate * args.duration)
+    interval = 1.0 / args.rate
+    kinds = Counter()
+    started = time.perf_counter()
+    for index in range(total):
+        message = factory.make()
+        kinds[message.kind] += 1
+        dispatcher.put(message)
+        # Ritmo absoluto: los retrasos del loop no reducen la carga ofrecida
+        delay = started + (index + 1) * interval - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+    offered_s = time.perf_counter() - started
+
+    await dispatcher.drain()
+    delivered_s = time.perf_counter() - started
+    while main._chatfight_tasks:
+        await asyncio.gather(*list(main._chatfight_tasks), return_exceptions=True)
+    elapsed = time.perf_counter() - started
+
+    sampler.stop()
+    end_sample = sampler.sample()
+    snapshot = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    # Borrados diferidos de las respuestas a comandos que siguen esperando
+    pending_cleanups = len(main._cleanup_tasks)
+    for task in list(main._cleanup_tasks):
+        task.cancel()
+    await main.post_processor.stop()
+    await shard.writer.stop()
+    await main.history_writer.stop()
+    await main.router.writer.stop()
+    await main.loop_monitor.stop()
+    await main._chatfight_processor.close()
+    main._local_solver.close()
+    await server.stop()
+
+    growth = snapshot.compare_to(baseline, "lineno")
+    return {
+        "messages": total,
+        "mix": dict(kinds),
+        "offered_rate": round(total / offered_s, 1) if offered_s else None,
+        "delivered_rate": round(dispatcher.delivered / delivered_s, 1) if delivered_s else None,
+        "elapsed_s": round(elapsed, 3),
+        "workers": args.workers,
+        "max_backlog": dispatcher.max_backlog,
+        "handler_errors": dispatcher.errors,
+        "handler_ms": {
+            kind: {
+                "p50": round(bench.percentile(times, 0.5) * 1000, 1),
+                "p99": round(bench.percentile(times, 0.99) * 1000, 1),
+                "max": round(max(times) * 1000, 1),
+            }
+            for kind, times in dispatcher.handler_time.items()
+        },
+        "tasks": {"start": start_sample["tasks"], "peak": sampler.peak["tasks"], "end": end_sample["tasks"]},
+        "rounds_in_flight_peak": sampler.peak["rounds_in_flight"],
+        "pending_cleanups": pending_cleanups,
+        "rss_mb": {
+            "start": round(start_sample["rss_mb"], 1),
+            "peak": round(sampler.peak["rss_mb"], 1),
+            "end": round(end_sample["rss_mb"], 1),
+        },
+        "tracemalloc_mb": {
+            "peak": round(sampler.peak["traced_mb"], 2),
+            "growth": round(end_sample["traced_mb"] - start_sample["traced_mb"], 2),
+        },
+        "top_growth": [
+            f"{stat.traceback[0].filename.rsplit(os.sep, 1)[-1]}:{stat.traceback[0].lineno} "
+            f"{stat.size_diff / 1024:+.1f} KB"
+            for stat in growth[:args.top]
+        ],
+        "event_loop": {
+            "lag_p99_ms": round((main.loop_monitor.lag.percentiles(0.99)[0] or 0) * 1000, 1),
+            "lag_max_ms": round(main.loop_monitor.max_lag * 1000, 1),
+            "blocks": main.loop_monitor.blocks,
+        },
+        "stats": stats_integrity(client, factory, shard, collections),
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Prueba de carga de los handlers de ChatFight")
+    parser.add_argument("--rate", type=float, default=100.0, help="Mensajes por segundo ofrecidos")
+    parser.add_argument("--duration", type=float, default=10.0, help="Segundos de carga")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("chatter=70,command=5,photo=20,document=5"),
+                        help="Pesos por tipo de mensaje: chatter, command, photo, document")
+    parser.add_argument("--commands", type=lambda s: [c.strip() for c in s.split(",") if c.strip()],
+                        default=["-cf", "-ping", ".help"], help="Comandos que envía la cuenta, separados por comas")
+    parser.add_argument("--images", type=int, default=100, help="Imágenes sintéticas distintas entre las que se reparten los juegos")
+    parser.add_argument("--workers", type=int, default=main.app.workers, help="Workers del dispatcher (como Client.workers)")
+    parser.add_argument("--concurrency", type=int, default=main.settings.groq_max_concurrency, help="Inferencias simultáneas")
+    parser.add_argument("--keys", type=int, default=1, help="Claves de API entre las que repartir las peticiones")
+    parser.add_argument("--latency", type=float, default=300.0, help="Latencia media de inferencia (ms)")
+    parser.add_argument("--jitter", type=float, default=50.0, help="Desviación de la latencia (ms)")
+    parser.add_argument("--download-latency", type=float, default=20.0, help="Latencia de descarga (ms)")
+    parser.add_argument("--rate-per-minute", type=float, default=0.0, help="Presupuesto de respuestas del grupo (0 = sin límite)")
+    parser.add_argument("--drop-superseded", action="store_true", help="Descarta las rondas superadas por una más reciente")
+    parser.add_argument("--sample-interval", type=float, default=0.25, help="Segundos entre muestras de recursos")
+    parser.add_argument("--top", type=int, default=5, help="Líneas con mayor crecimiento de memoria que se muestran")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--strict", action="store_true", help="Sale con código 1 si hay actualizaciones perdidas o duplicadas")
+    parser.add_argument("--json", action="store_true", help="Salida en JSON")
+    parser.add_argument("--verbose", action="store_true", help="Muestra los logs del bot")
+    return parser.parse_args(argv)
+
+
+def main_cli(argv=None) -> int:
+    args = parse_args(argv)
+    logging.getLogger("chatfight-bot").setLevel(logging.INFO if args.verbose else logging.CRITICAL)
+    logging.getLogger("chatfight-loadtest").setLevel(logging.DEBUG if args.verbose else logging.WARNING)
+    logging.getLogger("httpx").setLevel(logging.INFO if args.verbose else logging.WARNING)
+    # El loop de Pyrogram: en él quedaron pendientes los registros de handlers del bot
+    report = main.app.loop.run_until_complete(run_loadtest(args))
+
+    if args.json:
+        print(json.dumps(report, indent=2, ensure_ascii=False))
+    else:
+        for key, value in report.items():
+            print(f"{key:>22}: {value}")
+
+    integrity = report["stats"]
+    if args.strict and any(integrity[key] for key in
+                           ("duplicated_replies", "lost_in_memory", "per_type_mismatch", "lost_in_mongo")):
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
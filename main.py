@@ -9,26 +9,56 @@ Autor: ElJoker63
 Repo: https://github.com/ElJoker63/chatfight-bot
 """
 
+import ast
 import asyncio
+import heapq
+import itertools
+import multiprocessing
+import operator
 import os
+import random
 import re
 import sys
+import threading
 import time
-import uuid
 import base64
 import logging
 import traceback
-from datetime import datetime, timezone
-from typing import Optional, Tuple
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+from io import BytesIO
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple, Union
 from pymongo import MongoClient
-from pymongo.errors import PyMongoError
+from pymongo.errors import OperationFailure, PyMongoError
 
 from dotenv import load_dotenv
-from pyrogram import Client, filters
+from pyrogram import Client, filters, idle, raw
 from pyrogram.enums import ParseMode
+from pyrogram.handlers import MessageHandler
 from pyrogram.types import Message
 
-from groq import Groq
+import httpx
+from groq import (
+    APIConnectionError, APIStatusError, AsyncGroq, DefaultAsyncHttpxClient, RateLimitError
+)
+# El SDK importa los tipos de chat de forma perezosa en la primera petición: importarlos aquí
+# evita ese bloqueo del event loop (~0,4 s) en la primera ronda
+import groq.types.chat  # noqa: F401
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow es opcional: sin él se desactiva el hash perceptual
+    Image = None
+
+try:
+    import pytesseract
+except ImportError:  # pytesseract es opcional: sin él no hay solver local
+    pytesseract = None
 
 # =============================================================================
 # CONFIGURATION
@@ -36,22 +66,21 @@ from groq import Groq
 
 load_dotenv()
 
-# Telegram API credentials
-API_ID = int(os.getenv("API_ID", "0"))
-API_HASH = os.getenv("API_HASH", "")
-
-# Session string (optional - if absent uses local session file)
-SESSION_STRING = os.getenv("SESSION_STRING", "")
+# Cuenta de Telegram principal: recibe los comandos de control
+MAIN_ACCOUNT = "main"
 
-# ChatFight configuration
-CHATFIGHT_BOT_ID = int(os.getenv("CHATFIGHT_BOT_ID"))
-CHATFIGHT_GROUP_ID = int(os.getenv("CHATFIGHT_GROUP_ID"))
+# Modos de color del preprocesado de imágenes
+IMAGE_MODES = ("color", "gray", "binary")
 
-# MongoDB configuration
-MONGO_URI = os.getenv("MONGO_URI")
-
-# Groq API Key for AI image analysis
-GROQ_API_KEY = os.getenv("GROQ_API_KEY", "")
+# Mensajes del bot ChatFight que cierran una ronda (ganador, tiempo agotado...), además de
+# cualquier respuesta suya al mensaje del juego
+DEFAULT_ROUND_CLOSE_PATTERN = (
+    r"ganador|ha ganado|ganó|acertó|ha acertado|respuesta correcta|tiempo agotado|se acabó el tiempo|nadie"
+)
+# Respuesta correcta que revela ChatFight al cerrar la ronda (grupo con nombre "answer")
+DEFAULT_OUTCOME_ANSWER_PATTERN = (
+    r"(?:respuesta|palabra|resultado)(?:\s+correct[ao])?(?:\s+era)?\s*[:=]\s*[«\"'`*]*(?P<answer>-?[^\s«»\"'`*.,!]+)"
+)
 
 # Captions que identifican los juegos
 CAPTION_PALABRA = "Sé el primero en escribir la palabra que aparece en la foto para escalar en la clasificación de minijuegos."
@@ -59,6 +88,280 @@ CAPTION_OPERACION = "Sé el primero en escribir el resultado del cálculo en fot
 
 # Colección de ChatFight en MongoDB
 CHATFIGHT_COLLECTION_NAME = "ChatFight"
+CHATFIGHT_CACHE_COLLECTION_NAME = "ChatFightCache"
+CHATFIGHT_HISTORY_COLLECTION_NAME = "ChatFightHistory"
+
+class ConfigError(ValueError):
+    """Configuración ausente o no válida (se listan todos los problemas a la vez)"""
+
+def parse_shard_spec(spec: str, group_id: int, rate_per_minute: float) -> Tuple[Tuple[int, str, float], ...]:
+    """
+    Grupos atendidos a partir de CHATFIGHT_SHARDS ("group_id[:cuenta[:por_minuto]]", ...).
+    Vacío = solo group_id con la cuenta principal. Lanza ValueError si no es válido.
+    Returns: ((group_id, cuenta, respuestas_por_minuto), ...)
+    """
+    result: Dict[int, Tuple[int, str, float]] = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        fields = item.split(":")
+        shard_group = int(fields[0])
+        account = (fields[1] if len(fields) > 1 and fields[1] else MAIN_ACCOUNT).lower()
+        rate = float(fields[2]) if len(fields) > 2 and fields[2] else rate_per_minute
+        result[shard_group] = (shard_group, account, rate)
+    if not result and group_id:
+        result[group_id] = (group_id, MAIN_ACCOUNT, rate_per_minute)
+    return tuple(result.values())
+
+@dataclass(frozen=True)
+class Settings:
+    """
+    Toda la configuración del bot, leída de las variables de entorno una sola vez al importar
+    el módulo. Un valor no válido no interrumpe la importación: toma el valor por defecto y el
+    problema queda en errors, que main() comprueba con validate() antes de abrir conexiones.
+    """
+    # Telegram API credentials y session string de cada cuenta (vacío = fichero de sesión local).
+    # La principal usa SESSION_STRING y cada cuenta extra SESSION_STRING_<CUENTA>
+    api_id: int
+    api_hash: str
+    session_strings: Dict[str, str]
+    
+    # ChatFight: bot, grupo principal y grupos atendidos (shards) con su cuenta y presupuesto
+    bot_id: int
+    group_id: int
+    shards: Tuple[Tuple[int, str, float], ...]
+    shard_rate_per_minute: float
+    
+    # MongoDB: plazo (segundos) de selección de servidor y conexión y espera máxima entre
+    # reintentos. La conexión se abre en segundo plano: el bot responde desde el arranque.
+    # start_enabled: estado de los grupos sin estado persistido (o sin MongoDB)
+    mongo_uri: str
+    mongo_timeout: float
+    mongo_retry_max: float
+    start_enabled: bool
+    
+    # Groq: claves (round-robin), peticiones simultáneas y plazo por petición (segundos)
+    groq_api_keys: Tuple[str, ...]
+    groq_max_concurrency: int
+    groq_timeout: float
+    # Reintentos ante 429/5xx/errores de red: máximo y backoff exponencial con jitter (segundos)
+    groq_max_retries: int
+    groq_backoff_base: float
+    groq_backoff_max: float
+    # Descartar (o cancelar si ya están en curso) los juegos superados por otro más reciente del grupo
+    drop_superseded_rounds: bool
+    round_close_pattern: str
+    
+    # Modelo principal, respaldo opcional para hedging, streaming con corte anticipado
+    # y tokens máximos por respuesta
+    groq_model: str
+    groq_backup_model: str
+    groq_backup_api_key: str
+    groq_backup_base_url: str
+    hedge_delay: float
+    groq_streaming: bool
+    groq_max_tokens: int
+    
+    # Router adaptativo (Thompson sampling) por tipo de juego sobre (modelo, variante de prompt,
+    # perfil de imagen): modelos extra servidos con las mismas claves, modos de imagen a probar y
+    # latencia de inferencia (segundos) a partir de la cual se penaliza una combinación
+    router_enabled: bool
+    router_models: Tuple[str, ...]
+    router_image_modes: Tuple[str, ...]
+    router_latency_budget: float
+    # Resultado de cada respuesta según los mensajes posteriores de ChatFight: plazo para
+    # recibirlo (segundos) y expresión regular que extrae la respuesta correcta
+    outcome_timeout: float
+    outcome_answer_pattern: str
+    
+    # Calentamiento al arrancar: inferencia sintética opcional y ping de keep-alive
+    # a Groq y a la sesión de medios de Telegram cada keepalive_interval segundos sin actividad (0 = desactivado)
+    warmup_inference: bool
+    keepalive_interval: float
+    
+    # Caché de respuestas: entradas por nivel, vigencia (s) y distancia de Hamming máxima
+    # (sobre 256 bits) para considerar dos imágenes iguales
+    cache_max_size: int
+    cache_ttl: float
+    phash_max_distance: int
+    
+    # Solver local de operaciones: confianza mínima del OCR (0-100) y procesos del pool (0 = desactivado)
+    local_ocr_min_confidence: float
+    local_solver_workers: int
+    
+    # Persistencia de estadísticas: intervalo de volcado (s) y cambios pendientes que fuerzan un volcado
+    stats_flush_interval: float
+    stats_flush_batch: int
+    
+    # Historial de rondas (colección propia): días que se conservan (0 = sin caducidad),
+    # documentos por inserción y máximo en memoria mientras MongoDB no está disponible
+    history_ttl_days: float
+    history_batch: int
+    history_max_buffer: int
+    
+    # Métricas de latencia: muestras por etapa, fichero Prometheus opcional y puerto HTTP opcional (0 = desactivado)
+    metrics_window: int
+    metrics_file: str
+    metrics_export_interval: float
+    metrics_host: str
+    metrics_port: int
+    
+    # Monitor del event loop: intervalo de muestreo del retraso (s), bloqueo a partir del cual se
+    # captura la pila del código que retiene el loop (s) y bloqueos que se conservan para -cf
+    loop_monitor_interval: float
+    loop_block_threshold: float
+    loop_block_keep: int
+    
+    # Preprocesado de imágenes antes de la inferencia (requiere Pillow): recorte al contenido,
+    # lado máximo en píxeles (0 = sin reducir), modo (color, gray, binary) y calidad JPEG
+    image_preprocess: bool
+    image_crop: bool
+    image_max_side: int
+    image_mode: str
+    image_quality: int
+    
+    # Tamaño de descarga: la miniatura más pequeña cuyo lado mayor alcance este mínimo (píxeles);
+    # si el resultado no es válido se descarga el original. 0 = siempre el original
+    photo_min_side: int
+    
+    # Directorio opcional para archivar las imágenes recibidas (depuración). Vacío = sin disco
+    archive_dir: str
+    
+    errors: Tuple[str, ...] = ()
+    
+    @classmethod
+    def from_env(cls, environ=os.environ) -> "Settings":
+        """Lee y valida las variables de entorno. Nunca lanza: los problemas quedan en errors"""
+        errors = []
+        
+        def text(name: str, default: str = "") -> str:
+            return environ.get(name, default)
+        
+        def flag(name: str, default: str) -> bool:
+            return environ.get(name, default) == "1"
+        
+        def number(name: str, default: str, kind=int):
+            raw = environ.get(name) or default
+            try:
+                return kind(raw)
+            except ValueError:
+                errors.append(f"{name}={raw!r} no es un número")
+                return kind(default)
+        
+        def listed(name: str, default: str = "") -> Tuple[str, ...]:
+            return tuple(item.strip() for item in environ.get(name, default).split(",") if item.strip())
+        
+        def pattern(name: str, default: str) -> str:
+            raw = environ.get(name, default)
+            try:
+                re.compile(raw)
+            except re.error as e:
+                errors.append(f"{name} no es una expresión regular válida: {e}")
+                return default
+            return raw
+        
+        api_id = number("API_ID", "0")
+        api_hash = text("API_HASH")
+        if not api_id or not api_hash:
+            errors.append("API_ID y API_HASH son obligatorios")
+        
+        group_id = number("CHATFIGHT_GROUP_ID", "0")
+        shard_rate = number("SHARD_RATE_PER_MINUTE", "30", float)
+        shards: Tuple[Tuple[int, str, float], ...] = ()
+        try:
+            shards = parse_shard_spec(text("CHATFIGHT_SHARDS"), group_id, shard_rate)
+        except ValueError as e:
+            errors.append(f"CHATFIGHT_SHARDS no válido: {e}")
+        if not shards and not errors:
+            errors.append("Define CHATFIGHT_GROUP_ID o CHATFIGHT_SHARDS")
+        session_strings = {MAIN_ACCOUNT: text("SESSION_STRING")}
+        for _, account, _ in shards:
+            if account not in session_strings:
+                session_strings[account] = text(f"SESSION_STRING_{account.upper()}")
+        
+        mongo_timeout = number("MONGO_TIMEOUT", "5", float)
+        if mongo_timeout <= 0:
+            errors.append("MONGO_TIMEOUT debe ser mayor que 0")
+        
+        keys = listed("GROQ_API_KEYS")
+        if not keys and text("GROQ_API_KEY"):
+            keys = (text("GROQ_API_KEY"),)
+        
+        image_mode = text("IMAGE_MODE", "color")
+        if image_mode not in IMAGE_MODES:
+            errors.append(f"IMAGE_MODE debe ser uno de: {', '.join(IMAGE_MODES)}")
+            image_mode = "color"
+        # El vigilante del loop comprueba cada threshold/2 segundos: con 0 no dormiría nunca
+        loop_block_threshold = number("LOOP_BLOCK_THRESHOLD", "0.25", float)
+        if loop_block_threshold <= 0:
+            errors.append("LOOP_BLOCK_THRESHOLD debe ser mayor que 0")
+            loop_block_threshold = 0.25
+        
+        return cls(
+            api_id=api_id, api_hash=api_hash, session_strings=session_strings,
+            bot_id=number("CHATFIGHT_BOT_ID", "691070694"), group_id=group_id,
+            shards=shards, shard_rate_per_minute=shard_rate,
+            mongo_uri=text("MONGO_URI"), mongo_timeout=mongo_timeout,
+            mongo_retry_max=number("MONGO_RETRY_MAX", "60", float),
+            start_enabled=flag("CHATFIGHT_START_ENABLED", "1"),
+            groq_api_keys=keys,
+            groq_max_concurrency=number("GROQ_MAX_CONCURRENCY", "4"),
+            groq_timeout=number("GROQ_TIMEOUT", "30", float),
+            groq_max_retries=number("GROQ_MAX_RETRIES", "3"),
+            groq_backoff_base=number("GROQ_BACKOFF_BASE", "0.25", float),
+            groq_backoff_max=number("GROQ_BACKOFF_MAX", "4", float),
+            drop_superseded_rounds=flag("DROP_SUPERSEDED_ROUNDS", "1"),
+            round_close_pattern=pattern("ROUND_CLOSE_PATTERN", DEFAULT_ROUND_CLOSE_PATTERN),
+            groq_model=text("GROQ_MODEL", "meta-llama/llama-4-scout-17b-16e-instruct"),
+            groq_backup_model=text("GROQ_BACKUP_MODEL"),
+            groq_backup_api_key=text("GROQ_BACKUP_API_KEY"),
+            groq_backup_base_url=text("GROQ_BACKUP_BASE_URL"),
+            hedge_delay=number("HEDGE_DELAY", "1.5", float),
+            groq_streaming=flag("GROQ_STREAMING", "1"),
+            groq_max_tokens=number("GROQ_MAX_TOKENS", "100"),
+            router_enabled=flag("ROUTER_ENABLED", "1"),
+            router_models=listed("ROUTER_MODELS"),
+            router_image_modes=listed("ROUTER_IMAGE_MODES", "color,gray"),
+            router_latency_budget=number("ROUTER_LATENCY_BUDGET", "2", float),
+            outcome_timeout=number("OUTCOME_TIMEOUT", "120", float),
+            outcome_answer_pattern=pattern("OUTCOME_ANSWER_PATTERN", DEFAULT_OUTCOME_ANSWER_PATTERN),
+            warmup_inference=flag("WARMUP_INFERENCE", "0"),
+            keepalive_interval=number("KEEPALIVE_INTERVAL", "30", float),
+            cache_max_size=number("CACHE_MAX_SIZE", "5000"),
+            cache_ttl=number("CACHE_TTL", str(7 * 24 * 3600), float),
+            phash_max_distance=number("PHASH_MAX_DISTANCE", "24"),
+            local_ocr_min_confidence=number("LOCAL_OCR_MIN_CONFIDENCE", "80", float),
+            local_solver_workers=number("LOCAL_SOLVER_WORKERS", "2"),
+            stats_flush_interval=number("STATS_FLUSH_INTERVAL", "5", float),
+            stats_flush_batch=number("STATS_FLUSH_BATCH", "20"),
+            history_ttl_days=number("HISTORY_TTL_DAYS", "30", float),
+            history_batch=number("HISTORY_BATCH", "50"),
+            history_max_buffer=number("HISTORY_MAX_BUFFER", "5000"),
+            metrics_window=number("METRICS_WINDOW", "1000"),
+            metrics_file=text("METRICS_FILE"),
+            metrics_export_interval=number("METRICS_EXPORT_INTERVAL", "15", float),
+            metrics_host=text("METRICS_HOST", "127.0.0.1"),
+            metrics_port=number("METRICS_PORT", "0"),
+            loop_monitor_interval=number("LOOP_MONITOR_INTERVAL", "0.1", float),
+            loop_block_threshold=loop_block_threshold,
+            loop_block_keep=number("LOOP_BLOCK_KEEP", "5"),
+            image_preprocess=flag("IMAGE_PREPROCESS", "1"),
+            image_crop=flag("IMAGE_CROP", "1"),
+            image_max_side=number("IMAGE_MAX_SIDE", "768"),
+            image_mode=image_mode,
+            image_quality=number("IMAGE_QUALITY", "85"),
+            photo_min_side=number("PHOTO_MIN_SIDE", "320"),
+            archive_dir=text("CHATFIGHT_ARCHIVE_DIR"),
+            errors=tuple(errors),
+        )
+    
+    def validate(self):
+        """Lanza ConfigError con todos los problemas encontrados al leer la configuración"""
+        if self.errors:
+            raise ConfigError("; ".join(self.errors))
+
+# La única lectura de la configuración: los clientes, los grupos, los valores por defecto
+# de las clases y los ajustes en caliente salen de esta instancia. Lo que -cfset puede
+# cambiar después se lee con runtime_settings.value(...) o del objeto que lo aplica
+settings = Settings.from_env()
 
 # =============================================================================
 # LOGGING SETUP
@@ -71,340 +374,3022 @@ logging.basicConfig(
 )
 log = logging.getLogger("chatfight-bot")
 
+# =============================================================================
+# LATENCY METRICS
+# =============================================================================
+
+class LatencyHistogram:
+    """Ventana deslizante de latencias (segundos) con percentiles"""
+    
+    def __init__(self, window: int = settings.metrics_window):
+        self._samples = deque(maxlen=max(1, window))
+        self.count = 0
+        self.total = 0.0
+    
+    def observe(self, seconds: float):
+        self._samples.append(seconds)
+        self.count += 1
+        self.total += seconds
+    
+    def percentiles(self, *quantiles: float) -> Tuple[Optional[float], ...]:
+        """Percentiles (0-1) sobre la ventana actual, por rango más cercano"""
+        if not self._samples:
+            return tuple(None for _ in quantiles)
+        ordered = sorted(self._samples)
+        last = len(ordered) - 1
+        return tuple(ordered[min(last, int(q * len(ordered)))] for q in quantiles)
+
+class Metrics:
+    """Registro de latencias por etapa del pipeline de respuesta"""
+    
+    QUANTILES = (0.5, 0.95, 0.99)
+    
+    def __init__(self, window: int = settings.metrics_window):
+        self.window = window
+        self.histograms: Dict[str, LatencyHistogram] = {}
+    
+    def observe(self, stage: str, seconds: float):
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histograms[stage] = LatencyHistogram(self.window)
+        histogram.observe(seconds)
+        # También en la traza de la ronda en curso (si la hay)
+        trace = round_trace.get()
+        if trace is not None:
+            stages = trace["stages"]
+            stages[stage] = stages.get(stage, 0.0) + seconds
+    
+    @contextmanager
+    def span(self, stage: str):
+        """Mide con reloj monótono el bloque de código como una etapa"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+    
+    def summary_text(self) -> str:
+        """Resumen p50/p95/p99 por etapa para -cf"""
+        if not self.histograms:
+            return "• Sin datos todavía"
+        lines = []
+        for stage, histogram in self.histograms.items():
+            p50, p95, p99 = histogram.percentiles(*self.QUANTILES)
+            lines.append(
+                f"• {stage}: p50 {p50 * 1000:.0f} · p95 {p95 * 1000:.0f} · p99 {p99 * 1000:.0f} ms (n={histogram.count})"
+            )
+        return "\n".join(lines)
+    
+    def prometheus_text(self) -> str:
+        """Exporta las latencias en formato de texto de Prometheus (tipo summary)"""
+        name = "chatfight_stage_latency_seconds"
+        lines = [
+            f"# HELP {name} Latencia por etapa del pipeline de respuesta de ChatFight",
+            f"# TYPE {name} summary",
+        ]
+        for stage, histogram in self.histograms.items():
+            for q, value in zip(self.QUANTILES, histogram.percentiles(*self.QUANTILES)):
+                lines.append(f'{name}{{stage="{stage}",quantile="{q}"}} {value:.6f}')
+            lines.append(f'{name}_sum{{stage="{stage}"}} {histogram.total:.6f}')
+            lines.append(f'{name}_count{{stage="{stage}"}} {histogram.count}')
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+# Traza de la ronda en curso para el historial: tiempos por etapa y datos como el modelo o el
+# origen de la respuesta. La fija process_chatfight_message; las tareas hijas comparten el dict
+round_trace: ContextVar[Optional[dict]] = ContextVar("round_trace", default=None)
+
+def trace_note(**fields):
+    """Anota datos en la traza de la ronda en curso (si la hay)"""
+    trace = round_trace.get()
+    if trace is not None:
+        trace.update(fields)
+
+def _write_metrics_file(path: str, text: str):
+    """Escritura atómica del fichero de métricas"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+async def metrics_file_exporter(path: str, interval: float = settings.metrics_export_interval):
+    """Vuelca periódicamente las métricas a un fichero (textfile collector de node_exporter)"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await asyncio.to_thread(_write_metrics_file, path, metrics.prometheus_text())
+        except Exception as e:
+            log.warning(f"[ChatFight] Error exportando métricas: {e}")
+
+async def _handle_metrics_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """Servidor HTTP mínimo: responde /metrics en formato Prometheus"""
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+        # Descartar las cabeceras
+        while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[1].split("?")[0] == "/metrics":
+            status, body = "200 OK", metrics.prometheus_text().encode()
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except Exception as e:
+        log.debug(f"[ChatFight] Error en petición de métricas: {e}")
+    finally:
+        writer.close()
+
+async def start_metrics_server(host: str = settings.metrics_host, port: int = settings.metrics_port):
+    """Arranca el endpoint HTTP de métricas"""
+    server = await asyncio.start_server(_handle_metrics_request, host, port)
+    log.info(f"[ChatFight] Métricas disponibles en http://{host}:{port}/metrics")
+    return server
+
+# =============================================================================
+# EVENT LOOP MONITOR
+# =============================================================================
+
+class LoopMonitor:
+    """
+    Mide el retraso de planificación del event loop y detecta las llamadas que lo bloquean.
+    
+    Una tarea duerme `interval` segundos y anota cuánto tarde despierta (retraso del loop).
+    Un hilo vigilante comprueba ese latido: si el loop lleva más de `threshold` segundos sin
+    despertarla, captura con sys._current_frames() la pila del código que lo está reteniendo.
+    """
+    
+    # Espera mínima del hilo vigilante entre comprobaciones (s), aunque el umbral sea muy bajo
+    MIN_WATCH_INTERVAL = 0.01
+    
+    def __init__(self, interval: float = settings.loop_monitor_interval, threshold: float = settings.loop_block_threshold,
+                 keep: int = settings.loop_block_keep, window: int = settings.metrics_window):
+        self.interval = interval
+        self.threshold = threshold
+        self.lag = LatencyHistogram(window)
+        self.max_lag = 0.0
+        self.tasks = 0
+        self.max_tasks = 0
+        self.blocks = 0
+        self.recent: deque = deque(maxlen=max(1, keep))
+        self._beat = time.monotonic()
+        self._stack: Optional[traceback.StackSummary] = None
+        self._loop_thread: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stop = threading.Event()
+    
+    def start(self):
+        if self.interval <= 0 or self._task is not None:
+            return
+        self._loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stop.clear()
+        self._task = asyncio.create_task(self._sample())
+        threading.Thread(target=self._watch, name="chatfight-loop-watchdog", daemon=True).start()
+    
+    async def _sample(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - expected)
+            self._beat = time.monotonic()
+            self.lag.observe(lag)
+            self.max_lag = max(self.max_lag, lag)
+            self.tasks = len(asyncio.all_tasks(loop))
+            self.max_tasks = max(self.max_tasks, self.tasks)
+            if lag >= self.threshold:
+                self._report(lag)
+    
+    def _report(self, lag: float):
+        """Registra un bloqueo con la pila capturada por el vigilante (si llegó a verlo)"""
+        stack, self._stack = self._stack, None
+        self.blocks += 1
+        if stack:
+            frame = stack[-1]
+            where = f"{os.path.basename(frame.filename)}:{frame.lineno} ({frame.name})"
+        else:
+            where = "pila no capturada"
+        self.recent.append((datetime.now().strftime("%H:%M:%S"), lag, where))
+        log.warning(f"[ChatFight] Event loop bloqueado {lag * 1000:.0f} ms en {where}"
+                    + (f". Pila:\n{''.join(stack.format())}" if stack else ""))
+    
+    def _watch(self):
+        """Hilo vigilante: captura la pila del hilo del loop mientras está bloqueado"""
+        captured = None
+        while not self._stop.wait(max(self.threshold / 2, self.MIN_WATCH_INTERVAL)):
+            beat = self._beat
+            if beat == captured or time.monotonic() - beat - self.interval < self.threshold:
+                continue
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is not None:
+                self._stack = traceback.extract_stack(frame, limit=12)
+                captured = beat
+    
+    async def stop(self):
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+    
+    def text(self) -> str:
+        """Retraso del loop, tareas en vuelo y últimos bloqueos para -cf"""
+        if not self.lag.count:
+            return "• Sin datos todavía"
+        p50, p95, p99 = self.lag.percentiles(*Metrics.QUANTILES)
+        lines = [
+            f"• Retraso: p50 {p50 * 1000:.0f} · p95 {p95 * 1000:.0f} · p99 {p99 * 1000:.0f} · "
+            f"máx {self.max_lag * 1000:.0f} ms",
+            f"• Tareas: {self.tasks} (máx {self.max_tasks})",
+            f"• Bloqueos ≥ {self.threshold * 1000:.0f} ms: {self.blocks}",
+        ]
+        lines.extend(f"  {at} {lag * 1000:.0f} ms en {where}" for at, lag, where in self.recent)
+        return "\n".join(lines)
+
+loop_monitor = LoopMonitor()
+
 # =============================================================================
 # MONGODB CONNECTION
 # =============================================================================
 
 _chatfight_client = None
 _chatfight_collection = None
+_cache_collection = None
+_history_collection = None
+
+# Se activa cuando MongoDB está conectado y el estado persistido ya se combinó con el de memoria.
+# Hasta entonces las estadísticas se acumulan en memoria y no se intenta escribir
+mongo_ready = asyncio.Event()
+mongo_status = {"state": "pendiente", "attempts": 0, "error": None}
 
 def get_chatfight_collection():
-    """Inicializa y retorna la conexión a MongoDB para ChatFight"""
-    global _chatfight_client, _chatfight_collection
+    """Retorna la colección de ChatFight (requiere init_chatfight_db)"""
+    if _chatfight_collection is None:
+        raise RuntimeError("MongoDB no está conectado")
+    return _chatfight_collection
+
+def get_cache_collection():
+    """Retorna la colección donde se persiste la caché de respuestas"""
+    if _cache_collection is None:
+        raise RuntimeError("MongoDB no está conectado")
+    return _cache_collection
+
+def get_history_collection():
+    """Retorna la colección con el historial de rondas"""
+    if _history_collection is None:
+        raise RuntimeError("MongoDB no está conectado")
+    return _history_collection
+
+def migrate_stats_history(collection, history_collection):
+    """Mueve el historial antiguo (lista dentro del documento de estadísticas) a su colección"""
+    for doc in collection.find({"type": "chatfight_stats", "stats.history": {"$exists": True}}):
+        entries, skipped = [], 0
+        for entry in doc["stats"]["history"]:
+            # Una entrada dañada no debe bloquear la migración (se reintentaría en cada arranque)
+            try:
+                created_at = datetime.fromisoformat(entry["timestamp"])
+            except (KeyError, TypeError, ValueError) as e:
+                log.warning(f"[ChatFight] Entrada de historial antigua ignorada ({e!r}): {entry!r:.120}")
+                skipped += 1
+                continue
+            entries.append({
+                "created_at": created_at,
+                "group_id": doc.get("group_id"),
+                "tipo": entry.get("tipo"),
+                "answer": entry.get("response"),
+                "source": "legacy",
+                "outcome": "answered",
+            })
+        if entries:
+            history_collection.insert_many(entries, ordered=False)
+        collection.update_one({"_id": doc["_id"]}, {"$unset": {"stats.history": ""}})
+        log.info(f"[ChatFight] {len(entries)} entradas de historial migradas a {CHATFIGHT_HISTORY_COLLECTION_NAME}"
+                 f"{f' ({skipped} ignoradas)' if skipped else ''}")
+
+def init_chatfight_db(uri: str, timeout: float = settings.mongo_timeout):
+    """
+    Conecta con MongoDB y prepara los índices (bloqueante, se ejecuta en un hilo).
+    Todos los plazos están acotados por timeout; lanza la excepción si no hay conexión.
+    """
+    global _chatfight_client, _chatfight_collection, _cache_collection, _history_collection
     
-    if _chatfight_client is None:
-        _chatfight_client = MongoClient(MONGO_URI)
-        _db = _chatfight_client["userdm"]
-        _chatfight_collection = _db[CHATFIGHT_COLLECTION_NAME]
+    timeout_ms = int(timeout * 1000)
+    client = MongoClient(uri, serverSelectionTimeoutMS=timeout_ms, connectTimeoutMS=timeout_ms,
+                         socketTimeoutMS=timeout_ms * 2)
+    try:
+        client.admin.command('ping')
+        db = client["userdm"]
         
-        # Crear un índice para el documento único de estadísticas
-        _chatfight_collection.create_index("type", unique=True)
+        # Un documento por tipo y grupo. El índice antiguo (único por tipo) impide varios grupos
+        collection = db[CHATFIGHT_COLLECTION_NAME]
+        indexes = collection.index_information()
+        if indexes.get("type_1", {}).get("unique"):
+            collection.drop_index("type_1")
+        collection.create_index([("type", 1), ("group_id", 1)], unique=True)
+        
+        cache_collection = db[CHATFIGHT_CACHE_COLLECTION_NAME]
+        cache_collection.create_index([("tier", 1), ("key", 1)], unique=True)
+        try:
+            # MongoDB elimina solo las entradas caducadas
+            cache_collection.create_index("created_at", expireAfterSeconds=int(settings.cache_ttl))
+        except PyMongoError as e:
+            log.warning(f"[ChatFight] No se pudo crear el índice TTL de la caché: {e}")
+        
+        # Historial: consultas por grupo y periodo, actualización del resultado por ronda y caducidad
+        history_collection = db[CHATFIGHT_HISTORY_COLLECTION_NAME]
+        history_collection.create_index([("group_id", 1), ("created_at", -1)])
+        history_collection.create_index([("group_id", 1), ("message_id", 1)])
+        try:
+            if settings.history_ttl_days > 0:
+                history_collection.create_index("created_at", expireAfterSeconds=int(settings.history_ttl_days * 86400))
+            else:
+                history_collection.create_index("created_at")
+        except PyMongoError as e:
+            log.warning(f"[ChatFight] No se pudo crear el índice TTL del historial: {e}")
+        migrate_stats_history(collection, history_collection)
+    except Exception:
+        client.close()
+        raise
     
-    return _chatfight_collection
+    _chatfight_client, _chatfight_collection = client, collection
+    _cache_collection, _history_collection = cache_collection, history_collection
+    log.info("[ChatFight] MongoDB conectado correctamente")
 
-def init_chatfight_db():
-    """Inicializa la base de datos ChatFight"""
-    try:
-        collection = get_chatfight_collection()
-        _chatfight_client.admin.command('ping')
-        log.info("[ChatFight] MongoDB conectado correctamente")
-        return True
-    except Exception as e:
-        log.error(f"[ChatFight] Error de conexión a MongoDB: {e}")
+# =============================================================================
+# CHATFIGHT DATABASE FUNCTIONS
+# =============================================================================
+
+def load_chatfight_db(group_id: int, legacy: bool = False) -> Optional[dict]:
+    """
+    Carga el estado de un grupo desde MongoDB (None si el grupo no tiene documento).
+    legacy=True adopta el documento antiguo sin group_id (un solo grupo) si existe.
+    Los errores de conexión se propagan para que el llamante reintente.
+    """
+    collection = get_chatfight_collection()
+    doc = collection.find_one({"type": "chatfight_stats", "group_id": group_id})
+    if doc is None and legacy:
+        legacy_filter = {"type": "chatfight_stats", "group_id": {"$exists": False}}
+        doc = collection.find_one(legacy_filter)
+        if doc is not None:
+            collection.update_one(legacy_filter, {"$set": {"group_id": group_id}})
+            log.info(f"[ChatFight] Estadísticas antiguas migradas al grupo {group_id}")
+    if doc is None:
+        return None
+    return {
+        "enabled": doc.get("enabled", False),
+        "stats": doc.get("stats", {})
+    }
+
+class BackgroundWriter(ABC):
+    """
+    Base de la persistencia write-behind: bucle que llama a flush() cada flush_interval
+    segundos o en cuanto hay batch_size cambios pendientes, y un último volcado al apagar.
+    """
+    
+    label = "cambios"
+    
+    def __init__(self, flush_interval: float, batch_size: int):
+        self.flush_interval = flush_interval
+        self.batch_size = max(1, batch_size)
+        self.flushes = 0
+        self._pending = 0
+        self._wake: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+    
+    @property
+    def pending(self) -> int:
+        """Número de cambios a la espera de ser escritos"""
+        return self._pending
+    
+    def _mark(self):
+        self._pending += 1
+        if self._pending >= self.batch_size and self._wake is not None:
+            self._wake.set()
+    
+    def start(self):
+        """Arranca el bucle de volcado periódico"""
+        if self._task is None:
+            self._wake = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+    
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            await self.flush()
+    
+    @abstractmethod
+    async def flush(self) -> bool:
+        """Escribe lo pendiente. Returns: False si quedan cambios sin guardar"""
+    
+    async def stop(self):
+        """Detiene el bucle y vuelca lo pendiente"""
+        # Se detiene con una bandera y no con cancel() para no cortar un volcado a medias
+        if self._task is not None:
+            self._stopping = True
+            self._wake.set()
+            await self._task
+            self._task = None
+        if not await self.flush():
+            log.warning(f"[ChatFight] {self._pending} {self.label} sin guardar (MongoDB no disponible)")
+
+class StatsWriter(BackgroundWriter):
+    """
+    Persistencia write-behind del documento de estadísticas.
+    Acumula incrementos ($inc) y valores ($set) y los envía en una sola actualización
+    atómica: por intervalo, al llegar a un número de cambios pendientes o al apagar.
+    La escritura se ejecuta fuera del event loop.
+    """
+    
+    label = "cambios de estadísticas"
+    
+    def __init__(self, doc_filter: dict, flush_interval: float = settings.stats_flush_interval,
+                 batch_size: int = settings.stats_flush_batch):
+        super().__init__(flush_interval, batch_size)
+        self.doc_filter = doc_filter
+        self._inc: Dict[str, int] = {}
+        self._set: Dict[str, object] = {}
+    
+    def inc(self, field: str, amount: int = 1):
+        """Suma un valor a un contador"""
+        self._inc[field] = self._inc.get(field, 0) + amount
+        self._mark()
+    
+    def set(self, field: str, value):
+        """Fija el valor de un campo (gana el último)"""
+        self._set[field] = value
+        self._mark()
+    
+    def has_pending(self, field: str) -> bool:
+        """Indica si hay un valor sin escribir para un campo ($set)"""
+        return field in self._set
+    
+    def _build_update(self, inc: dict, set_: dict) -> dict:
+        update = {"$set": {**set_, "updated_at": datetime.now(timezone.utc)}}
+        if inc:
+            update["$inc"] = inc
+        return update
+    
+    async def flush(self) -> bool:
+        """Escribe los cambios pendientes. Si falla, los devuelve al buffer"""
+        if not self._pending:
+            return True
+        if not mongo_ready.is_set():
+            # Sin MongoDB todavía: se conserva todo en memoria hasta que conecte
+            return False
+        inc, set_ = self._inc, self._set
+        self._inc, self._set, self._pending = {}, {}, 0
+        
+        try:
+            update = self._build_update(inc, set_)
+            with metrics.span("db_save"):
+                await asyncio.to_thread(self._write, update)
+            self.flushes += 1
+            return True
+        except Exception as e:
+            log.error(f"[ChatFight] Error de guardado en MongoDB: {e}")
+            # Reintegrar lo no escrito sin pisar valores más recientes
+            for field, amount in inc.items():
+                self._inc[field] = self._inc.get(field, 0) + amount
+            for field, value in set_.items():
+                self._set.setdefault(field, value)
+            self._pending += len(inc) + len(set_)
+            return False
+    
+    def _write(self, update: dict):
+        get_chatfight_collection().update_one(self.doc_filter, update, upsert=True)
+
+# =============================================================================
+# CHATFIGHT GROUP SHARDS
+# =============================================================================
+
+# Estadísticas por defecto
+default_stats = {
+    "total_responses": 0,
+    "palabra_responses": 0,
+    "operacion_responses": 0,
+    "errors": 0,
+    "rounds_completed": 0,
+    "rounds_cancelled": 0,
+    "won": 0,
+    "lost": 0,
+    "wrong": 0,
+    "last_response": None,
+}
+
+class RateBudget:
+    """Token bucket: respuestas por minuto permitidas en un grupo"""
+    
+    def __init__(self, per_minute: float):
+        self.per_minute = per_minute
+        self.capacity = max(1.0, per_minute)
+        self.tokens = self.capacity
+        self.rejected = 0
+        self._updated = time.monotonic()
+    
+    def try_acquire(self) -> bool:
+        """Consume un token si hay disponible. per_minute <= 0 = sin límite"""
+        if self.per_minute <= 0:
+            return True
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.per_minute / 60)
+        self._updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        self.rejected += 1
         return False
 
+class GroupShard:
+    """
+    Un grupo atendido por el bot: activación, estadísticas, presupuesto de respuestas
+    y documento de MongoDB propios. El procesador, la caché y el solver son compartidos.
+    """
+    
+    def __init__(self, group_id: int, account: str = MAIN_ACCOUNT,
+                 rate_per_minute: float = settings.shard_rate_per_minute):
+        self.group_id = group_id
+        self.account = account
+        self.enabled = settings.start_enabled
+        self.stats = dict(default_stats)
+        self.budget = RateBudget(rate_per_minute)
+        self.writer = StatsWriter({"type": "chatfight_stats", "group_id": group_id})
+        self.loaded = False
+    
+    def load(self):
+        """Carga el estado persistido del grupo (bloqueante) y lo combina con el de memoria"""
+        self.reconcile(load_chatfight_db(self.group_id, legacy=self.group_id == settings.group_id))
+    
+    def reconcile(self, persisted: Optional[dict]):
+        """
+        Combina el estado persistido con lo acumulado en memoria desde el arranque: los contadores
+        locales se suman (son incrementos ya pendientes de escribir) y un cambio de activación
+        hecho antes de conectar prevalece sobre el guardado.
+        """
+        if self.loaded:
+            return
+        self.loaded = True
+        if persisted is None:
+            # Grupo nuevo: se persiste el estado con el que arrancó
+            if not self.writer.has_pending("enabled"):
+                self.writer.set("enabled", self.enabled)
+            return
+        if not self.writer.has_pending("enabled"):
+            self.enabled = persisted.get("enabled", False)
+        
+        local = self.stats
+        merged = {**default_stats, **persisted.get("stats", {})}
+        for field, value in local.items():
+            if isinstance(value, int) and not isinstance(value, bool):
+                merged[field] = merged.get(field, 0) + value
+        merged["last_response"] = local["last_response"] or merged.get("last_response")
+        self.stats = merged
+    
+    def toggle(self, enabled: Optional[bool] = None) -> bool:
+        """Activa/desactiva el grupo (o fija el estado indicado)"""
+        self.enabled = (not self.enabled) if enabled is None else enabled
+        self.writer.set("enabled", self.enabled)
+        return self.enabled
+    
+    def record_response(self, tipo: str, response: str):
+        """Registra una respuesta enviada en memoria y en el buffer de persistencia"""
+        now = datetime.now(timezone.utc).isoformat()
+        counter = f"{tipo}_responses"
+        
+        self.stats["total_responses"] += 1
+        self.stats[counter] = self.stats.get(counter, 0) + 1
+        self.stats["last_response"] = now
+        
+        self.writer.inc("stats.total_responses")
+        self.writer.inc(f"stats.{counter}")
+        self.writer.set("stats.last_response", now)
+    
+    def record_error(self):
+        """Registra un error de procesamiento"""
+        self.stats["errors"] += 1
+        self.writer.inc("stats.errors")
+    
+    def record_outcome(self, outcome: str):
+        """Registra el resultado de una respuesta enviada: won, lost o wrong"""
+        self.stats[outcome] = self.stats.get(outcome, 0) + 1
+        self.writer.inc(f"stats.{outcome}")
+    
+    def record_round(self, cancelled: bool):
+        """Registra el final del trabajo de una ronda: completado o cancelado al cerrarse"""
+        counter = "rounds_cancelled" if cancelled else "rounds_completed"
+        self.stats[counter] = self.stats.get(counter, 0) + 1
+        self.writer.inc(f"stats.{counter}")
+
+def build_shards(settings: Settings) -> Dict[int, GroupShard]:
+    """Construye los shards de la configuración (vacío si CHATFIGHT_SHARDS no es válido: validate() lo informa)"""
+    return {group_id: GroupShard(group_id, account, rate) for group_id, account, rate in settings.shards}
+
+# Grupos atendidos. Su estado persistido se carga en segundo plano (connect_database)
+shards = build_shards(settings)
+
+def get_shard(chat_id: int) -> Optional[GroupShard]:
+    """Retorna el shard de un chat o None si el chat no es un grupo atendido"""
+    return shards.get(chat_id)
+
+# =============================================================================
+# CHATFIGHT GAME TYPES
+# =============================================================================
+
+# Imagen en memoria: bytes o una vista sobre el buffer descargado
+ImageData = Union[bytes, bytearray, memoryview]
+
+# Solver previo a Groq: recibe la imagen y retorna la respuesta o None si no puede
+GameSolver = Callable[[ImageData], Awaitable[Optional[str]]]
+
+DEFAULT_PROMPT = "Responde solo con lo que se pide en la imagen."
+DEFAULT_TEMPERATURE = 0.3
+
+class PromptVariant:
+    """Una forma de pedir la respuesta al modelo: texto y temperatura (el router elige entre ellas)"""
+    
+    def __init__(self, name: str, text: str, temperature: float = DEFAULT_TEMPERATURE):
+        self.name = name
+        self.text = text
+        self.temperature = temperature
+
+class GameType:
+    """
+    Un minijuego de ChatFight: cómo reconocerlo en el caption (frases en cualquier idioma),
+    qué pedir al modelo (prompt base y variantes alternativas), cómo normalizar y validar
+    la respuesta y qué solvers se prueban antes de llamar a Groq.
+    """
+    
+    def __init__(self, name: str, label: str, matchers: Tuple[str, ...], prompt: str,
+                 validator: Optional["re.Pattern[str]"] = None,
+                 normalize: Optional[Callable[[str], str]] = None,
+                 solvers: Tuple[GameSolver, ...] = (),
+                 example_caption: Optional[str] = None,
+                 prompt_variants: Tuple[PromptVariant, ...] = (),
+                 temperature: float = DEFAULT_TEMPERATURE):
+        self.name = name
+        self.label = label
+        self.matchers = matchers
+        self.prompt = prompt
+        self.validator = validator
+        self.normalize = normalize
+        self.solvers = solvers
+        self.example_caption = example_caption
+        self.prompts = (PromptVariant("base", prompt, temperature),) + tuple(prompt_variants)
+
+# Tipos registrados (por nombre) y patrón combinado para clasificarlos en una sola pasada
+GAME_TYPES: Dict[str, GameType] = {}
+_game_pattern: Optional["re.Pattern[str]"] = None
+_game_groups: Dict[str, str] = {}
+
+def _build_game_pattern():
+    """
+    Compila todas las frases de todos los tipos en una sola expresión regular con un
+    grupo con nombre por tipo; match.lastgroup indica el tipo sin recorrer la lista.
+    """
+    global _game_pattern, _game_groups
+    alternatives, groups = [], {}
+    for index, game in enumerate(GAME_TYPES.values()):
+        group = f"g{index}"
+        groups[group] = game.name
+        # Las frases más largas primero para que no las tape un prefijo
+        phrases = sorted(game.matchers, key=len, reverse=True)
+        alternatives.append(f"(?P<{group}>{'|'.join(re.escape(p) for p in phrases)})")
+    _game_pattern = re.compile("|".join(alternatives), re.IGNORECASE) if alternatives else None
+    _game_groups = groups
+
+def register_game_type(game: GameType) -> GameType:
+    """
+    Registra (o reemplaza) un tipo de juego y recompila el patrón de clasificación.
+    Si declara un caption de ejemplo, comprueba que se clasifica como ese tipo.
+    """
+    if not game.matchers:
+        raise ValueError(f"El tipo de juego '{game.name}' no declara frases de detección")
+    GAME_TYPES[game.name] = game
+    _build_game_pattern()
+    if game.example_caption is not None and classify_caption(game.example_caption) != game.name:
+        del GAME_TYPES[game.name]
+        _build_game_pattern()
+        raise ValueError(f"El caption de ejemplo de '{game.name}' no se clasifica como tal")
+    return game
+
+def classify_caption(text: str) -> Optional[str]:
+    """Retorna el tipo de juego cuyo patrón aparece primero en el texto, o None"""
+    if not text or _game_pattern is None:
+        return None
+    match = _game_pattern.search(text)
+    return _game_groups[match.lastgroup] if match else None
+
 # =============================================================================
-# CHATFIGHT IN-MEMORY STATE
+# CHATFIGHT INFERENCE SCHEDULER
 # =============================================================================
 
-chatfight_enabled = False
+# Ronda de juego: (group_id, message_id). Un juego nuevo en el grupo deja obsoletos los anteriores
+RoundKey = Tuple[int, int]
+
+class StaleRoundError(Exception):
+    """La petición ya no merece cuota: plazo vencido, ronda superada o sin cuota a tiempo"""
+
+def parse_reset(value: Optional[str]) -> Optional[float]:
+    """Convierte los tiempos de las cabeceras de Groq ("2m59.56s", "7.66s", "120ms", "3") en segundos"""
+    if not value:
+        return None
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", value)
+    if not parts:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    units = {"h": 3600.0, "m": 60.0, "s": 1.0, "ms": 0.001}
+    return sum(float(amount) * units[unit] for amount, unit in parts)
+
+class ApiKey:
+    """
+    Una clave de Groq con su cliente y el presupuesto que anuncian las cabeceras
+    x-ratelimit-* de cada respuesta (peticiones y tokens restantes y cuándo se reponen).
+    """
+    
+    def __init__(self, name: str, client: AsyncGroq):
+        self.name = name
+        self.client = client
+        self.requests_remaining: Optional[int] = None
+        self.tokens_remaining: Optional[int] = None
+        self.requests_reset_at = 0.0
+        self.tokens_reset_at = 0.0
+        self.blocked_until = 0.0
+        # Tokens estimados por petición (media móvil de lo que descuenta cada respuesta)
+        self.request_cost = 1000.0
+        self.requests = 0
+        self.rate_limited = 0
+    
+    def update(self, headers):
+        """Actualiza el presupuesto con las cabeceras de una respuesta"""
+        now = time.monotonic()
+        requests = headers.get("x-ratelimit-remaining-requests")
+        if requests is not None:
+            self.requests_remaining = int(requests)
+            self.requests_reset_at = now + (parse_reset(headers.get("x-ratelimit-reset-requests")) or 0.0)
+        tokens = headers.get("x-ratelimit-remaining-tokens")
+        if tokens is not None:
+            tokens = int(tokens)
+            if self.tokens_remaining is not None and 0 < self.tokens_remaining - tokens:
+                self.request_cost = 0.8 * self.request_cost + 0.2 * (self.tokens_remaining - tokens)
+            self.tokens_remaining = tokens
+            self.tokens_reset_at = now + (parse_reset(headers.get("x-ratelimit-reset-tokens")) or 0.0)
+    
+    def reserve(self):
+        """Descuenta una petición del presupuesto hasta que lleguen las cabeceras reales"""
+        self.requests += 1
+        if self.requests_remaining is not None:
+            self.requests_remaining -= 1
+        if self.tokens_remaining is not None:
+            self.tokens_remaining -= int(self.request_cost)
+    
+    def on_rate_limited(self, retry_after: Optional[float]):
+        """Un 429: la clave queda bloqueada durante retry-after (1 s si no viene)"""
+        self.rate_limited += 1
+        self.blocked_until = max(self.blocked_until, time.monotonic() + (retry_after or 1.0))
+    
+    def wait_time(self, now: float) -> float:
+        """Segundos hasta que la clave tenga cuota para una petición más (0 = ya)"""
+        waits = [self.blocked_until - now]
+        if self.requests_remaining is not None and self.requests_remaining < 1:
+            waits.append(self.requests_reset_at - now)
+        if self.tokens_remaining is not None and self.tokens_remaining < self.request_cost:
+            waits.append(self.tokens_reset_at - now)
+        return max(0.0, *waits)
+
+class InferenceScheduler:
+    """
+    Admisión de peticiones a Groq: como mucho `capacity` a la vez, atendidas por orden
+    de plazo (la que vence antes primero). Descarta las rondas ya superadas o vencidas
+    en lugar de gastar cuota en ellas y reparte entre claves según su presupuesto.
+    """
+    
+    def __init__(self, capacity: int, max_retries: int = settings.groq_max_retries,
+                 backoff_base: float = settings.groq_backoff_base, backoff_max: float = settings.groq_backoff_max,
+                 drop_superseded: bool = settings.drop_superseded_rounds):
+        self.capacity = max(1, capacity)
+        self.drop_superseded = drop_superseded
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.active = 0
+        self._queue: List[Tuple[float, int, asyncio.Future, Optional[RoundKey]]] = []
+        self._sequence = itertools.count()
+        self._latest_round: Dict[int, int] = {}
+        self.dropped = 0
+        self.retries = 0
+        self.throttled = 0
+    
+    @property
+    def queued(self) -> int:
+        return sum(1 for _, _, future, _ in self._queue if not future.done())
+    
+    def set_capacity(self, capacity: int):
+        """Cambia en caliente las inferencias simultáneas (al subir, se atiende la cola)"""
+        self.capacity = max(1, capacity)
+        self._wake()
+    
+    def note_round(self, round_key: Optional[RoundKey]):
+        """Registra un juego nuevo: los anteriores del mismo grupo pasan a estar obsoletos"""
+        if round_key is not None and self.drop_superseded:
+            group_id, message_id = round_key
+            if message_id > self._latest_round.get(group_id, 0):
+                self._latest_round[group_id] = message_id
+    
+    def is_stale(self, deadline: float, round_key: Optional[RoundKey]) -> bool:
+        if time.monotonic() >= deadline:
+            return True
+        return round_key is not None and round_key[1] < self._latest_round.get(round_key[0], 0)
+    
+    async def acquire(self, deadline: float, round_key: Optional[RoundKey] = None):
+        """Espera un hueco libre; lanza StaleRoundError si la ronda deja de merecerlo"""
+        if self.is_stale(deadline, round_key):
+            self.dropped += 1
+            raise StaleRoundError("ronda obsoleta antes de encolar")
+        if self.active < self.capacity and not self._queue:
+            self.active += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (deadline, next(self._sequence), future, round_key))
+        try:
+            await future
+        except asyncio.CancelledError:
+            # Si el hueco llegó a concederse, se devuelve
+            if future.done() and not future.cancelled() and future.exception() is None:
+                self.release()
+            raise
+    
+    def release(self):
+        self.active -= 1
+        self._wake()
+    
+    def _wake(self):
+        """Concede huecos libres a las esperas con el plazo más próximo"""
+        while self._queue and self.active < self.capacity:
+            deadline, _, future, round_key = heapq.heappop(self._queue)
+            if future.done():
+                continue
+            if self.is_stale(deadline, round_key):
+                self.dropped += 1
+                future.set_exception(StaleRoundError("ronda obsoleta en cola"))
+                continue
+            self.active += 1
+            future.set_result(None)
+    
+    @asynccontextmanager
+    async def slot(self, deadline: float, round_key: Optional[RoundKey] = None):
+        await self.acquire(deadline, round_key)
+        try:
+            yield
+        finally:
+            self.release()
+    
+    async def pick_key(self, backend: "InferenceBackend", deadline: float) -> ApiKey:
+        """
+        Siguiente clave del backend con cuota (round-robin). Si ninguna tiene, espera a la
+        primera que se reponga, salvo que eso ocurra después del plazo.
+        """
+        now = time.monotonic()
+        keys = backend.keys
+        order = [keys[(backend.next_key + i) % len(keys)] for i in range(len(keys))]
+        key = min(order, key=lambda k: k.wait_time(now))
+        backend.next_key = (keys.index(key) + 1) % len(keys)
+        wait = key.wait_time(now)
+        if wait > 0:
+            if now + wait >= deadline:
+                self.dropped += 1
+                raise StaleRoundError(f"sin cuota en {backend.name} antes del plazo ({wait:.1f}s)")
+            self.throttled += 1
+            log.info(f"[ChatFight] Sin cuota en Groq ({key.name}), esperando {wait:.1f}s")
+            await asyncio.sleep(wait)
+        key.reserve()
+        return key
+    
+    def backoff(self, attempt: int) -> float:
+        """Backoff exponencial con jitter completo"""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+    
+    def text(self) -> str:
+        """Resumen para -cf"""
+        return (f"• En curso: {self.active}/{self.capacity} · en cola: {self.queued}\n"
+                f"• Descartadas (obsoletas o sin cuota): {self.dropped}\n"
+                f"• Reintentos: {self.retries} · esperas por cuota: {self.throttled}")
 
 # =============================================================================
-# CHATFIGHT DATABASE FUNCTIONS
+# CHATFIGHT GROQ CLIENT
 # =============================================================================
 
-def load_chatfight_db():
-    """Carga el estado desde MongoDB"""
-    try:
-        collection = get_chatfight_collection()
-        doc = collection.find_one({"type": "chatfight_stats"})
-        if doc:
-            return {
-                "enabled": doc.get("enabled", False),
-                "stats": doc.get("stats", {})
-            }
-    except Exception as e:
-        log.error(f"[ChatFight] Error de carga desde MongoDB: {e}")
-    return {"enabled": False, "stats": {}}
+class InvalidAnswerError(ValueError):
+    """La respuesta del modelo no supera el validador de su tipo"""
+
+def clean_answer(tipo: str, raw: str) -> str:
+    """Normaliza la respuesta del modelo sin unir palabras sueltas"""
+    answer = raw.strip().strip(".,;:!¡?¿\"'`*_ ")
+    game = GAME_TYPES.get(tipo)
+    if game is not None and game.normalize is not None:
+        answer = game.normalize(answer)
+    return answer
+
+# Fin de una respuesta en streaming: salto de línea o puntuación de cierre seguida de espacio
+_STREAM_DELIMITER = re.compile(r"\n|[.!?;](?=\s)")
+
+def early_answer(tipo: str, text: str, final: bool = False) -> Optional[str]:
+    """
+    Busca en el texto parcial el primer segmento completo (cerrado por un delimitador)
+    que sea una respuesta válida. Con final=True el último segmento también cuenta.
+    """
+    position = 0
+    for match in _STREAM_DELIMITER.finditer(text):
+        candidate = clean_answer(tipo, text[position:match.start()])
+        if candidate and is_valid_answer(tipo, candidate):
+            return candidate
+        position = match.end()
+    if final:
+        candidate = clean_answer(tipo, text[position:])
+        if candidate and is_valid_answer(tipo, candidate):
+            return candidate
+    return None
+
+def is_valid_answer(tipo: str, answer: str) -> bool:
+    """Comprueba la respuesta contra el validador del tipo (sin validador: no vacía)"""
+    game = GAME_TYPES.get(tipo)
+    validator = game.validator if game is not None else None
+    if validator is None:
+        return bool(answer)
+    return bool(validator.match(answer))
+
+# Estado del calentamiento de conexiones por paso ("groq primary", "media main", ...)
+warmup_status: Dict[str, str] = {}
+
+@asynccontextmanager
+async def warmup_step(name: str):
+    """Registra en warmup_status la duración o el error de un paso de calentamiento (sin propagarlo)"""
+    warmup_status[name] = "⏳ en curso"
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        warmup_status[name] = f"❌ {type(e).__name__}"
+        log.warning(f"[ChatFight] Calentamiento '{name}' fallido: {e}")
+        return
+    elapsed = (time.perf_counter() - started) * 1000
+    warmup_status[name] = f"✅ {elapsed:.0f} ms"
+    log.info(f"[ChatFight] Calentamiento '{name}' listo en {elapsed:.0f} ms")
+
+class InferenceBackend:
+    """Un modelo servido por un endpoint de inferencia concreto, con una o varias claves"""
+    
+    def __init__(self, name: str, keys: List[ApiKey], model: str):
+        self.name = name
+        self.keys = keys
+        self.model = model
+        self.next_key = 0
+        self.wins = 0
+        self.failures = 0
+    
+    @property
+    def client(self) -> AsyncGroq:
+        return self.keys[0].client
+
+def create_groq_client(api_key: str, timeout: float, base_url: Optional[str] = None) -> AsyncGroq:
+    """
+    Cliente Groq cuyo pool conserva las conexiones inactivas más que el ping de keep-alive
+    (httpx las descarta a los 5 s por defecto y la siguiente petición repite el handshake TLS)
+    """
+    expiry = max(5.0, settings.keepalive_interval * 2)
+    http_client = DefaultAsyncHttpxClient(
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=expiry)
+    )
+    # Los reintentos los gestiona InferenceScheduler, que conoce el plazo de cada juego
+    return AsyncGroq(api_key=api_key, base_url=base_url, timeout=timeout, http_client=http_client,
+                     max_retries=0)
+
+class ChatFightProcessor:
+    def __init__(self, api_key: str, max_concurrency: int = settings.groq_max_concurrency, timeout: float = settings.groq_timeout,
+                 model: str = settings.groq_model, backup_model: str = settings.groq_backup_model,
+                 backup_api_key: str = settings.groq_backup_api_key, backup_base_url: str = settings.groq_backup_base_url,
+                 hedge_delay: float = settings.hedge_delay, streaming: bool = settings.groq_streaming,
+                 api_keys: Optional[List[str]] = None, extra_models: Optional[List[str]] = None,
+                 max_tokens: int = settings.groq_max_tokens):
+        # Claves del backend principal: GROQ_API_KEYS (round-robin) o solo api_key
+        api_keys = (api_keys if api_keys is not None else list(settings.groq_api_keys)) or [api_key]
+        keys = [ApiKey(f"key{i + 1}", create_groq_client(key, timeout)) for i, key in enumerate(api_keys)]
+        self.client = keys[0].client
+        self.model = model
+        self.timeout = timeout
+        self.hedge_delay = hedge_delay
+        self.max_tokens = max_tokens
+        self.primary = InferenceBackend("primary", keys, model)
+        # Modelos entre los que elige el router, servidos con las mismas claves que el principal
+        self.models: Dict[str, InferenceBackend] = {model: self.primary}
+        for index, extra in enumerate(extra_models if extra_models is not None else settings.router_models):
+            self.models.setdefault(extra, InferenceBackend(f"model{index + 2}", keys, extra))
+        # Respaldo opcional: otro modelo y/o endpoint para peticiones especulativas
+        self.backup: Optional[InferenceBackend] = None
+        if backup_model or backup_base_url:
+            backup_keys = keys
+            if backup_api_key or backup_base_url:
+                backup_keys = [ApiKey("backup", create_groq_client(
+                    backup_api_key or api_keys[0], timeout, backup_base_url or None))]
+            self.backup = InferenceBackend("backup", backup_keys, backup_model or model)
+        self.hedges = 0
+        # Streaming: se corta la generación en cuanto hay una respuesta completa
+        self.streaming = streaming
+        self.early_stops = 0
+        # Limita las inferencias simultáneas, ordena por plazo y respeta la cuota de cada clave
+        self.scheduler = InferenceScheduler(max_concurrency)
+        self._inflight: Set[asyncio.Task] = set()
+        # Última petición a Groq (time.monotonic), para el keep-alive en reposo
+        self.last_activity = 0.0
+        self._keepalive_task: Optional[asyncio.Task] = None
+    
+    async def list_models(self) -> Set[str]:
+        """Modelos que sirve el endpoint del backend principal (models.list)"""
+        response = await self.primary.client.models.list()
+        return {model.id for model in response.data}
+    
+    def set_model(self, model: str):
+        """Cambia en caliente el modelo principal (servido con las mismas claves)"""
+        if self.models.get(self.primary.model) is self.primary:
+            del self.models[self.primary.model]
+        self.model = self.primary.model = model
+        self.models[model] = self.primary
+    
+    @property
+    def backends(self) -> Tuple[InferenceBackend, ...]:
+        """Backends configurados (principal y, si hay, respaldo)"""
+        return (self.primary, self.backup) if self.backup is not None else (self.primary,)
+    
+    @property
+    def clients(self) -> List[AsyncGroq]:
+        """Clientes HTTP distintos de todos los backends"""
+        clients: List[AsyncGroq] = []
+        for backend in self.backends:
+            clients.extend(k.client for k in backend.keys if k.client not in clients)
+        return clients
+    
+    async def ping(self, backend: InferenceBackend):
+        """Petición ligera (lista de modelos) que abre o mantiene viva la conexión de cada clave"""
+        await asyncio.gather(*(key.client.models.list() for key in backend.keys))
+        self.last_activity = time.monotonic()
+    
+    async def warm_up(self, synthetic: bool = settings.warmup_inference):
+        """
+        Abre las conexiones con cada backend antes del primer juego y, opcionalmente,
+        lanza una inferencia mínima de solo texto para calentar el modelo.
+        El resultado de cada paso queda en warmup_status (se muestra en -cf).
+        """
+        for backend in self.backends:
+            async with warmup_step(f"groq {backend.name}"):
+                await self.ping(backend)
+            if synthetic:
+                async with warmup_step(f"inferencia {backend.name}"):
+                    await backend.client.chat.completions.create(
+                        model=backend.model,
+                        messages=[{"role": "user", "content": "Responde solo: ok"}],
+                        max_completion_tokens=1,
+                    )
+    
+    def start_keepalive(self, interval: float = settings.keepalive_interval):
+        """Arranca el ping periódico mientras no haya actividad"""
+        if interval > 0 and self._keepalive_task is None:
+            self._keepalive_task = asyncio.create_task(self._keepalive(interval))
+    
+    async def _keepalive(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            if time.monotonic() - self.last_activity < interval:
+                continue
+            for backend in self.backends:
+                try:
+                    await self.ping(backend)
+                except Exception as e:
+                    log.warning(f"[ChatFight] Keep-alive de Groq ({backend.name}) fallido: {e}")
+    
+    def image_to_base64(self, image: ImageData, mime_type: str = "image/jpeg") -> str:
+        """Convierte una imagen en memoria en una data URL base64 (sin copias intermedias)"""
+        encoded_string = base64.b64encode(image).decode('ascii')
+        return f"data:{mime_type};base64,{encoded_string}"
+    
+    def get_prompt_for_type(self, tipo: str) -> PromptVariant:
+        """Prompt base del tipo de juego (el router puede elegir otra variante)"""
+        game = GAME_TYPES.get(tipo)
+        return game.prompts[0] if game is not None else PromptVariant("base", DEFAULT_PROMPT)
+    
+    @property
+    def inflight(self) -> int:
+        """Número de inferencias en curso"""
+        return len(self._inflight)
+    
+    async def analyze_image(self, image: ImageData, tipo: str, mime_type: str = "image/jpeg",
+                            timeout: Optional[float] = None, round_key: Optional[RoundKey] = None,
+                            route: Optional["RouteArm"] = None) -> str:
+        """
+        Analiza una imagen y retorna una respuesta que supera el validador del tipo.
+        El plazo incluye la espera por un hueco libre en el pool de inferencia.
+        round_key: (group_id, message_id) del juego; uno más reciente en el grupo lo deja obsoleto.
+        route: modelo y variante de prompt elegidos por el router (None = principal y prompt base).
+        """
+        timeout = timeout if timeout is not None else self.timeout
+        deadline = time.monotonic() + timeout
+        self.scheduler.note_round(round_key)
+        task = asyncio.current_task()
+        if task is not None:
+            self._inflight.add(task)
+        try:
+            return await asyncio.wait_for(self._analyze(image, tipo, mime_type, deadline, round_key, route),
+                                          timeout=timeout)
+        except asyncio.TimeoutError:
+            log.error(f"[ChatFight] Inferencia excedió el plazo de {timeout:.0f}s")
+            raise
+        except StaleRoundError as e:
+            log.info(f"[ChatFight] Inferencia descartada: {e}")
+            raise
+        except asyncio.CancelledError:
+            log.info("[ChatFight] Inferencia cancelada")
+            raise
+        except Exception as e:
+            log.error(f"[ChatFight] Error analyzing image: {e}")
+            raise
+        finally:
+            if task is not None:
+                self._inflight.discard(task)
+    
+    async def _analyze(self, image: ImageData, tipo: str, mime_type: str, deadline: float,
+                       round_key: Optional[RoundKey] = None, route: Optional["RouteArm"] = None) -> str:
+        """Lanza la petición principal y, si tarda o falla, una especulativa al respaldo"""
+        with metrics.span("encode"):
+            image_data_url = self.image_to_base64(image, mime_type)
+        if route is not None:
+            backend, prompt = self.models.get(route.model, self.primary), route.prompt
+        else:
+            backend, prompt = self.primary, self.get_prompt_for_type(tipo)
+        
+        if self.backup is None:
+            return await self._attempt(backend, prompt, image_data_url, tipo, deadline, round_key)
+        
+        started = asyncio.Event()
+        primary = asyncio.create_task(
+            self._attempt(backend, prompt, image_data_url, tipo, deadline, round_key, started)
+        )
+        pending = {primary}
+        try:
+            # El plazo de hedging cuenta desde que la petición sale, no mientras espera en cola
+            waiter = asyncio.create_task(started.wait())
+            await asyncio.wait({primary, waiter}, return_when=asyncio.FIRST_COMPLETED)
+            waiter.cancel()
+            if primary.done() and not started.is_set():
+                # No llegó a salir (ronda obsoleta, sin propietario o cancelada): nada que cubrir
+                return primary.result()
+            done, _ = await asyncio.wait(pending, timeout=self.hedge_delay)
+            if primary in done and (primary.cancelled() or primary.exception() is None
+                                    or isinstance(primary.exception(), StaleRoundError)):
+                # Respuesta válida, o la ronda ya no admite otra petición
+                return primary.result()
+            
+            # Sin respuesta válida a tiempo: lanzar la petición de respaldo
+            self.hedges += 1
+            trace_note(hedged=True)
+            log.info(f"[ChatFight] Hedging: lanzando petición a {self.backup.model}")
+            pending = {t for t in pending if not t.done()}
+            pending.add(asyncio.create_task(
+                self._attempt(self.backup, prompt, image_data_url, tipo, deadline, round_key)
+            ))
+            
+            error: Optional[BaseException] = primary.exception() if primary.done() else None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for finished in done:
+                    if finished.exception() is None:
+                        return finished.result()
+                    error = finished.exception()
+            raise error
+        finally:
+            # Cancelar la petición perdedora
+            for task in pending:
+                task.cancel()
+    
+    async def _attempt(self, backend: InferenceBackend, prompt: PromptVariant, image_data_url: str, tipo: str,
+                       deadline: float, round_key: Optional[RoundKey] = None,
+                       started: Optional[asyncio.Event] = None) -> str:
+        """
+        Una petición a un backend a través del planificador, con reintentos ante 429/5xx
+        y errores de red mientras quede plazo. Lanza InvalidAnswerError si la respuesta no es válida.
+        """
+        queued_at = time.perf_counter()
+        attempt = 0
+        while True:
+            async with self.scheduler.slot(deadline, round_key):
+                if attempt == 0:
+                    metrics.observe("inference_queue", time.perf_counter() - queued_at)
+                key = await self.scheduler.pick_key(backend, deadline)
+                if started is not None:
+                    started.set()
+                self.last_activity = time.monotonic()
+                try:
+                    with metrics.span("inference"):
+                        response, raw = await self._request(backend, key, prompt, image_data_url, tipo)
+                    break
+                except RateLimitError as e:
+                    key.update(e.response.headers)
+                    key.on_rate_limited(parse_reset(e.response.headers.get("retry-after")))
+                    error: Exception = e
+                except APIStatusError as e:
+                    if e.status_code < 500:
+                        backend.failures += 1
+                        raise
+                    error = e
+                except APIConnectionError as e:
+                    error = e
+                except Exception:
+                    backend.failures += 1
+                    raise
+            
+            # Fuera del hueco: esperar con jitter y reintentar si aún llega a tiempo
+            attempt += 1
+            delay = self.scheduler.backoff(attempt)
+            if attempt > self.scheduler.max_retries or time.monotonic() + delay >= deadline:
+                backend.failures += 1
+                raise error
+            self.scheduler.retries += 1
+            log.warning(f"[ChatFight] Groq ({backend.name}/{key.name}) falló ({error}), "
+                        f"reintento {attempt} en {delay:.2f}s")
+            await asyncio.sleep(delay)
+        
+        if not is_valid_answer(tipo, response):
+            backend.failures += 1
+            raise InvalidAnswerError(f"Respuesta no válida de {backend.model}: {raw[:80]!r}")
+        
+        backend.wins += 1
+        trace_note(model=backend.model, retries=attempt)
+        return response
+    
+    async def _request(self, backend: InferenceBackend, key: ApiKey, prompt: PromptVariant, image_data_url: str,
+                       tipo: str) -> Tuple[str, str]:
+        """Envía la petición con una clave y actualiza su presupuesto. Returns: (respuesta, texto recibido)"""
+        raw_response = await key.client.chat.completions.with_raw_response.create(
+            model=backend.model,
+            messages=[
+                {
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "text",
+                            "text": prompt.text
+                        },
+                        {
+                            "type": "image_url",
+                            "image_url": {
+                                "url": image_data_url
+                            }
+                        }
+                    ]
+                }
+            ],
+            temperature=prompt.temperature,
+            max_completion_tokens=self.max_tokens,
+            top_p=1,
+            stream=self.streaming,
+        )
+        key.update(raw_response.headers)
+        completion = await raw_response.parse()
+        if self.streaming:
+            return await self._consume_stream(completion, tipo)
+        raw = completion.choices[0].message.content or ""
+        return early_answer(tipo, raw, final=True) or clean_answer(tipo, raw), raw
+    
+    async def _consume_stream(self, stream, tipo: str) -> Tuple[str, str]:
+        """
+        Lee los tokens según llegan y corta el stream en cuanto hay una respuesta completa
+        y válida. Returns: (respuesta, texto recibido)
+        """
+        text = ""
+        started_at = time.perf_counter()
+        try:
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content or ""
+                if not delta:
+                    continue
+                if not text:
+                    metrics.observe("inference_first_token", time.perf_counter() - started_at)
+                text += delta
+                answer = early_answer(tipo, text)
+                if answer is not None:
+                    self.early_stops += 1
+                    return answer, text
+        finally:
+            # Cierra la conexión sin esperar a los tokens restantes
+            await stream.close()
+        
+        return early_answer(tipo, text, final=True) or clean_answer(tipo, text), text
+    
+    def cancel_all(self) -> int:
+        """Cancela todas las inferencias en curso"""
+        tasks = list(self._inflight)
+        for task in tasks:
+            task.cancel()
+        return len(tasks)
+    
+    async def close(self):
+        """Cancela lo pendiente y cierra los clientes HTTP"""
+        self.cancel_all()
+        if self._keepalive_task is not None:
+            self._keepalive_task.cancel()
+        for client in self.clients:
+            await client.close()
+
+# =============================================================================
+# CHATFIGHT LOCAL ARITHMETIC SOLVER
+# =============================================================================
+
+_ARITHMETIC_OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+}
+
+# Caracteres que el OCR puede devolver para cada operador
+_EXPRESSION_TRANSLATION = str.maketrans({
+    "×": "*", "x": "*", "X": "*", "·": "*",
+    "÷": "/", ":": "/",
+    "−": "-", "–": "-", "—": "-",
+})
+
+_EXPRESSION_PATTERN = re.compile(r"^\(?-?\d+(?:\s*[-+*/]\s*\(?-?\d+\)?)+\)?$")
+
+def normalize_expression(text: str) -> str:
+    """Normaliza el texto del OCR a una expresión aritmética de Python"""
+    text = text.translate(_EXPRESSION_TRANSLATION)
+    text = text.split("=")[0]
+    return re.sub(r"[^0-9+\-*/()]", "", text)
+
+def safe_eval(expression: str) -> Optional[int]:
+    """
+    Evalúa una expresión aritmética de enteros recorriendo el AST.
+    Solo admite + - * / y paréntesis. Retorna None si no es válida o el resultado no es entero.
+    """
+    if not expression or len(expression) > 64 or not _EXPRESSION_PATTERN.match(expression):
+        return None
+    
+    def _eval(node):
+        if isinstance(node, ast.Expression):
+            return _eval(node.body)
+        if isinstance(node, ast.Constant) and type(node.value) is int:
+            return node.value
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+            value = _eval(node.operand)
+            return -value if isinstance(node.op, ast.USub) else value
+        if isinstance(node, ast.BinOp) and type(node.op) in _ARITHMETIC_OPERATORS:
+            return _ARITHMETIC_OPERATORS[type(node.op)](_eval(node.left), _eval(node.right))
+        raise ValueError(f"Nodo no permitido: {type(node).__name__}")
+    
+    try:
+        result = _eval(ast.parse(expression, mode="eval"))
+    except (SyntaxError, ValueError, ZeroDivisionError):
+        return None
+    
+    if isinstance(result, float):
+        if not result.is_integer():
+            return None
+        result = int(result)
+    return result
+
+def _ocr_expression(image: bytes) -> Tuple[str, float]:
+    """
+    Extrae la expresión de la imagen con Tesseract.
+    Se ejecuta en el pool de procesos. Retorna (texto, confianza media).
+    """
+    with Image.open(BytesIO(image)) as img:
+        gray = ImageOps.autocontrast(img.convert("L"))
+        gray = gray.resize((gray.width * 2, gray.height * 2), Image.LANCZOS)
+        # Texto oscuro sobre fondo claro, que es lo que espera Tesseract
+        if sum(gray.resize((1, 1)).tobytes()) < 128:
+            gray = ImageOps.invert(gray)
+    
+    data = pytesseract.image_to_data(
+        gray,
+        config="--psm 7 -c tessedit_char_whitelist=0123456789+-xX*/:=()×÷",
+        output_type=pytesseract.Output.DICT,
+    )
+    words, confidences = [], []
+    for word, conf in zip(data["text"], data["conf"]):
+        conf = float(conf)
+        if word.strip() and conf >= 0:
+            words.append(word.strip())
+            confidences.append(conf)
+    if not words:
+        return "", 0.0
+    return " ".join(words), min(confidences)
+
+def _warm_worker() -> bool:
+    """Tarea vacía: obliga al pool a arrancar sus procesos antes del primer juego"""
+    return True
+
+def _solver_mp_context():
+    """
+    Contexto de multiprocessing del pool de OCR. Con fork los hijos heredarían el estado de
+    los hilos de Pyrogram, MongoDB y el monitor del loop (riesgo de interbloqueo): forkserver
+    los crea desde un proceso limpio, y spawn donde forkserver no existe (Windows, macOS)
+    """
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+class LocalArithmeticSolver:
+    """
+    Resuelve operaciones sin salir de la máquina: OCR local + evaluación exacta por AST.
+    Si la confianza del OCR es baja retorna None y se recurre a Groq.
+    """
+    
+    def __init__(self, workers: int = settings.local_solver_workers, min_confidence: float = settings.local_ocr_min_confidence):
+        self.min_confidence = min_confidence
+        self.workers = workers
+        self.solved = 0
+        self.fallbacks = 0
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self.available = workers > 0 and Image is not None and pytesseract is not None
+        if self.available:
+            try:
+                pytesseract.get_tesseract_version()
+            except Exception as e:
+                log.warning(f"[ChatFight] Tesseract no disponible, solver local desactivado: {e}")
+                self.available = False
+        if self.available:
+            self._pool = ProcessPoolExecutor(max_workers=workers, mp_context=_solver_mp_context())
+    
+    async def warm_up(self):
+        """
+        Arranca los procesos del pool en un hilo: crear el primero espera a que el forkserver
+        importe el módulo, y así no lo paga la primera operación
+        """
+        if not self.available:
+            return
+        started = time.perf_counter()
+        
+        def _start_workers():
+            futures = [self._pool.submit(_warm_worker) for _ in range(self.workers)]
+            for future in futures:
+                future.result()
+        
+        try:
+            await asyncio.to_thread(_start_workers)
+        except Exception as e:
+            log.warning(f"[ChatFight] No se pudo arrancar el pool del solver local: {e}")
+            return
+        log.info(f"[ChatFight] Pool del solver local listo en {time.perf_counter() - started:.2f}s")
+    
+    async def solve(self, image: ImageData) -> Optional[str]:
+        """Intenta resolver la operación localmente"""
+        if not self.available:
+            return None
+        
+        loop = asyncio.get_running_loop()
+        try:
+            text, confidence = await loop.run_in_executor(self._pool, _ocr_expression, bytes(image))
+        except Exception as e:
+            log.warning(f"[ChatFight] Error en el OCR local: {e}")
+            self.fallbacks += 1
+            return None
+        
+        expression = normalize_expression(text)
+        result = safe_eval(expression)
+        if result is None or confidence < self.min_confidence:
+            log.info(f"[ChatFight] Solver local sin confianza (texto='{text}', confianza={confidence:.0f})")
+            self.fallbacks += 1
+            return None
+        
+        log.info(f"[ChatFight] Solver local: {expression} = {result} (confianza={confidence:.0f})")
+        self.solved += 1
+        return str(result)
+    
+    def close(self):
+        """Detiene el pool de procesos"""
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+
+async def solve_arithmetic_locally(image: ImageData) -> Optional[str]:
+    """Solver de la cadena de "operacion": OCR local si está disponible"""
+    if _local_solver is None:
+        return None
+    return await _local_solver.solve(image)
+
+# =============================================================================
+# CHATFIGHT ANSWER CACHE
+# =============================================================================
+
+class LRUCache:
+    """Caché LRU acotada por tamaño y por tiempo de vida"""
+    
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max(1, max_size)
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # key -> (expira_en, tipo, respuesta)
+        self._entries: "OrderedDict[str, Tuple[float, str, str]]" = OrderedDict()
+    
+    def __len__(self) -> int:
+        return len(self._entries)
+    
+    def __contains__(self, key: str) -> bool:
+        return key in self._entries
+    
+    def get(self, key: str, tipo: str) -> Optional[str]:
+        """Retorna la respuesta guardada o None si no existe, caducó o es de otro tipo"""
+        entry = self._entries.get(key)
+        if entry is None or entry[1] != tipo:
+            self.misses += 1
+            return None
+        if entry[0] < time.time():
+            self.discard(key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[2]
+    
+    def discard(self, key: str):
+        """Elimina una entrada (caducada o invalidada), si existe"""
+        if self._entries.pop(key, None) is not None:
+            self._on_evict(key)
+    
+    def put(self, key: str, tipo: str, answer: str, created_at: Optional[float] = None):
+        """Guarda una respuesta desalojando la menos usada si se supera el tamaño"""
+        expires_at = (created_at if created_at is not None else time.time()) + self.ttl
+        self._entries[key] = (expires_at, tipo, answer)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            evicted, _ = self._entries.popitem(last=False)
+            self._on_evict(evicted)
+    
+    def _on_evict(self, key: str):
+        """Punto de extensión para limpiar índices auxiliares"""
+
+class PerceptualCache(LRUCache):
+    """
+    Caché indexada por hash perceptual: si no hay coincidencia exacta
+    acepta la entrada más cercana dentro de una distancia de Hamming.
+    """
+    
+    def __init__(self, max_size: int, ttl: float, max_distance: int = settings.phash_max_distance):
+        super().__init__(max_size, ttl)
+        self.max_distance = max_distance
+        self._hashes: Dict[str, int] = {}
+    
+    def get(self, key: str, tipo: str) -> Optional[str]:
+        return super().get(self.resolve(key), tipo)
+    
+    def resolve(self, key: str) -> str:
+        """Clave con la que se guardó la imagen: la propia o la más cercana dentro de la distancia"""
+        if key not in self._entries and self.max_distance > 0:
+            return self._nearest(key) or key
+        return key
+    
+    def put(self, key: str, tipo: str, answer: str, created_at: Optional[float] = None):
+        self._hashes[key] = int(key, 16)
+        super().put(key, tipo, answer, created_at)
+    
+    def _on_evict(self, key: str):
+        self._hashes.pop(key, None)
+    
+    def _nearest(self, key: str) -> Optional[str]:
+        """
+        Busca el hash guardado más cercano dentro de la distancia máxima. Las entradas
+        caducadas que encuentra por el camino se eliminan (también de _hashes)
+        """
+        target = int(key, 16)
+        now = time.time()
+        best, best_distance, expired = None, self.max_distance + 1, []
+        for candidate, value in self._hashes.items():
+            if self._entries[candidate][0] < now:
+                expired.append(candidate)
+                continue
+            distance = (target ^ value).bit_count()
+            if distance < best_distance:
+                best, best_distance = candidate, distance
+        for candidate in expired:
+            self.discard(candidate)
+        return best
+
+def content_bbox(gray, threshold: int = 48) -> Optional[Tuple[int, int, int, int]]:
+    """
+    Caja de los píxeles que se distinguen del fondo (el valor mediano de las esquinas)
+    en una imagen en escala de grises. None si la imagen es lisa.
+    """
+    corners = ((0, 0), (gray.width - 1, 0), (0, gray.height - 1), (gray.width - 1, gray.height - 1))
+    background = sorted(gray.getpixel(corner) for corner in corners)[1]
+    return gray.point(lambda p: 255 if abs(p - background) > threshold else 0).getbbox()
+
+def perceptual_hash(image: ImageData, size: int = 16) -> Optional[str]:
+    """
+    Calcula un dHash de size*size bits sobre la zona con contenido de la imagen.
+    Es estable frente a recompresiones y cambios de tamaño. Retorna None sin Pillow.
+    """
+    if Image is None:
+        return None
+    with Image.open(BytesIO(image)) as img:
+        gray = ImageOps.autocontrast(img.convert("L"))
+    # Recortar al contenido: sobre un fondo liso el texto ocupa pocos píxeles y,
+    # sin recorte, imágenes distintas darían hashes casi idénticos
+    bbox = content_bbox(gray)
+    if bbox is not None:
+        gray = gray.crop(bbox)
+    pixels = gray.resize((size + 1, size), Image.LANCZOS).tobytes()
+    value = 0
+    for row in range(size):
+        offset = row * (size + 1)
+        for col in range(size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return f"{value:0{size * size // 4}x}"
+
+class AnswerCache:
+    """
+    Caché de respuestas en dos niveles:
+    - file: por file_unique_id de Telegram, responde antes de descargar nada
+    - phash: por hash perceptual de los píxeles, reconoce copias recodificadas
+    """
+    
+    def __init__(self, max_size: int = settings.cache_max_size, ttl: float = settings.cache_ttl):
+        self.tiers: Dict[str, LRUCache] = {
+            "file": LRUCache(max_size, ttl),
+            "phash": PerceptualCache(max_size, ttl),
+        }
+        self._persist_tasks: Set[asyncio.Task] = set()
+    
+    def get(self, tier: str, key: Optional[str], tipo: str) -> Optional[str]:
+        """Busca una respuesta en un nivel concreto"""
+        if not key:
+            return None
+        return self.tiers[tier].get(key, tipo)
+    
+    def put(self, tipo: str, answer: str, file_key: Optional[str] = None, phash: Optional[str] = None):
+        """Guarda la respuesta en todos los niveles disponibles y la persiste en segundo plano"""
+        entries = [(tier, key) for tier, key in (("file", file_key), ("phash", phash)) if key]
+        for tier, key in entries:
+            self.tiers[tier].put(key, tipo, answer)
+        if entries and mongo_ready.is_set():
+            task = asyncio.create_task(asyncio.to_thread(self._persist, entries, tipo, answer))
+            self._persist_tasks.add(task)
+            task.add_done_callback(self._persist_tasks.discard)
+    
+    def invalidate(self, tipo: str, file_key: Optional[str] = None, phash: Optional[str] = None,
+                   answer: Optional[str] = None):
+        """
+        Retira una respuesta que resultó errónea: la de file_unique_id, la del hash perceptual y
+        la de la imagen parecida de la que salió (si vino de ahí). Si se conoce la respuesta
+        correcta, se guarda en su lugar.
+        """
+        entries = []
+        if file_key:
+            self.tiers["file"].discard(file_key)
+            entries.append(("file", file_key))
+        if phash:
+            tier = self.tiers["phash"]
+            for key in {phash, tier.resolve(phash)}:
+                tier.discard(key)
+                entries.append(("phash", key))
+        if answer:
+            # put() sobrescribe también la copia persistida; solo hay que borrar la de la imagen parecida
+            self.put(tipo, answer, file_key=file_key, phash=phash)
+            entries = [(tier, key) for tier, key in entries if key not in (file_key, phash)]
+        if entries and mongo_ready.is_set():
+            task = asyncio.create_task(asyncio.to_thread(self._forget, entries))
+            self._persist_tasks.add(task)
+            task.add_done_callback(self._persist_tasks.discard)
+    
+    def _forget(self, entries):
+        """Borra las entradas de MongoDB (se ejecuta fuera del event loop)"""
+        try:
+            collection = get_cache_collection()
+            for tier, key in entries:
+                collection.delete_one({"tier": tier, "key": key})
+        except Exception as e:
+            log.warning(f"[ChatFight] Error borrando de la caché persistida: {e}")
+    
+    def _persist(self, entries, tipo: str, answer: str):
+        """Escribe las entradas en MongoDB (se ejecuta fuera del event loop)"""
+        try:
+            collection = get_cache_collection()
+            now = datetime.now(timezone.utc)
+            for tier, key in entries:
+                collection.update_one(
+                    {"tier": tier, "key": key},
+                    {"$set": {"tipo": tipo, "answer": answer, "created_at": now}},
+                    upsert=True
+                )
+        except Exception as e:
+            log.warning(f"[ChatFight] Error persistiendo la caché: {e}")
+    
+    def _fetch_persisted(self) -> Dict[str, list]:
+        """Lee las entradas más recientes de cada nivel (se ejecuta fuera del event loop)"""
+        collection = get_cache_collection()
+        return {
+            tier: list(collection.find({"tier": tier}).sort("created_at", -1).limit(cache.max_size))
+            for tier, cache in self.tiers.items()
+        }
+    
+    async def warm_load(self) -> int:
+        """Precarga las entradas más recientes desde MongoDB sin pisar las ya resueltas en memoria"""
+        loaded = 0
+        try:
+            persisted = await asyncio.to_thread(self._fetch_persisted)
+            for tier, docs in persisted.items():
+                cache = self.tiers[tier]
+                # Insertar de la más antigua a la más reciente para respetar el orden LRU
+                for doc in reversed(docs):
+                    if doc["key"] in cache:
+                        continue
+                    created = doc.get("created_at")
+                    created_ts = created.replace(tzinfo=timezone.utc).timestamp() if created else None
+                    cache.put(doc["key"], doc.get("tipo", ""), doc.get("answer", ""), created_ts)
+                    loaded += 1
+            log.info(f"[ChatFight] Caché precargada con {loaded} entradas")
+        except Exception as e:
+            log.error(f"[ChatFight] Error precargando la caché: {e}")
+        return loaded
+    
+    def stats_text(self) -> str:
+        """Resumen de aciertos y fallos por nivel"""
+        lines = []
+        for tier, cache in self.tiers.items():
+            lines.append(f"• {tier}: {cache.hits} aciertos / {cache.misses} fallos ({len(cache)} entradas)")
+        return "\n".join(lines)
+
+answer_cache = AnswerCache()
+
+# =============================================================================
+# CHATFIGHT IMAGE PREPROCESSING
+# =============================================================================
+
+class ImageProfile:
+    """Parámetros del preprocesado de la imagen que se envía al modelo"""
+    
+    MODES = IMAGE_MODES
+    
+    def __init__(self, crop: bool = settings.image_crop, max_side: int = settings.image_max_side,
+                 mode: str = settings.image_mode, quality: int = settings.image_quality, margin: int = 8):
+        if mode not in self.MODES:
+            raise ValueError(f"Modo de imagen desconocido: {mode}")
+        self.crop = crop
+        self.max_side = max_side
+        self.mode = mode
+        self.quality = quality
+        self.margin = margin
+    
+    @property
+    def name(self) -> str:
+        """Nombre corto del perfil para estadísticas, p. ej. crop-768-gray-q85"""
+        parts = ["crop"] if self.crop else []
+        parts.append(str(self.max_side) if self.max_side else "full")
+        parts.append(self.mode)
+        if self.mode != "binary":
+            parts.append(f"q{self.quality}")
+        return "-".join(parts)
+
+def preprocess_image(image: ImageData, mime_type: str, profile: ImageProfile) -> Tuple[bytes, str]:
+    """
+    Recorta, reduce, convierte y recodifica la imagen según el perfil (CPU, sin await).
+    Binario se codifica como PNG de 1 bit; el resto como JPEG.
+    Retorna (bytes, mime_type); si el resultado no es más pequeño se conserva el original.
+    """
+    with Image.open(BytesIO(image)) as img:
+        img = ImageOps.exif_transpose(img).convert("RGB")
+    if profile.crop:
+        bbox = content_bbox(ImageOps.autocontrast(img.convert("L")))
+        if bbox is not None:
+            left, top, right, bottom = bbox
+            m = profile.margin
+            img = img.crop((max(0, left - m), max(0, top - m), min(img.width, right + m), min(img.height, bottom + m)))
+    if profile.max_side and max(img.size) > profile.max_side:
+        img.thumbnail((profile.max_side, profile.max_side), Image.LANCZOS)
+    
+    out = BytesIO()
+    if profile.mode == "binary":
+        ImageOps.autocontrast(img.convert("L")).point(lambda p: 255 if p > 127 else 0).convert("1").save(
+            out, "PNG", optimize=True)
+        out_mime = "image/png"
+    else:
+        if profile.mode == "gray":
+            img = img.convert("L")
+        img.save(out, "JPEG", quality=profile.quality, optimize=True)
+        out_mime = "image/jpeg"
+    
+    data = out.getvalue()
+    if len(data) >= len(image):
+        return bytes(image), mime_type
+    return data, out_mime
+
+class PreprocessStats:
+    """Efecto de cada perfil de preprocesado: bytes enviados, latencia de inferencia y acierto"""
+    
+    def __init__(self, window: int = settings.metrics_window):
+        self.window = window
+        self.profiles: Dict[str, Dict[str, float]] = {}
+        self.latency: Dict[str, LatencyHistogram] = {}
+    
+    def _entry(self, profile: str) -> Dict[str, float]:
+        entry = self.profiles.get(profile)
+        if entry is None:
+            entry = self.profiles[profile] = {"images": 0, "bytes_in": 0, "bytes_out": 0,
+                                              "correct": 0, "wrong": 0}
+            self.latency[profile] = LatencyHistogram(self.window)
+        return entry
+    
+    def record_payload(self, profile: str, bytes_in: int, bytes_out: int):
+        entry = self._entry(profile)
+        entry["images"] += 1
+        entry["bytes_in"] += bytes_in
+        entry["bytes_out"] += bytes_out
+    
+    def record_inference(self, profile: str, seconds: float):
+        self._entry(profile)
+        self.latency[profile].observe(seconds)
+    
+    def record_outcome(self, profile: str, outcome: str):
+        """Veredicto de una respuesta de Groq: won y lost son respuestas correctas, wrong no"""
+        entry = self._entry(profile)
+        entry["wrong" if outcome == "wrong" else "correct"] += 1
+    
+    def text(self) -> str:
+        """Una línea por perfil para -cf"""
+        if not self.profiles:
+            return "• Sin datos todavía"
+        lines = []
+        for profile, entry in self.profiles.items():
+            saved = 1 - entry["bytes_out"] / entry["bytes_in"] if entry["bytes_in"] else 0.0
+            line = (f"• {profile}: {entry['images']} imágenes, {entry['bytes_in'] / 1024:.0f} KB → "
+                    f"{entry['bytes_out'] / 1024:.0f} KB (-{saved:.0%})")
+            p50, p95 = self.latency[profile].percentiles(0.5, 0.95)
+            if p50 is not None:
+                line += f", inferencia p50 {p50 * 1000:.0f} · p95 {p95 * 1000:.0f} ms"
+            decided = entry["correct"] + entry["wrong"]
+            if decided:
+                line += f", aciertos {entry['correct']}/{decided} ({entry['correct'] / decided:.0%})"
+            lines.append(line)
+        return "\n".join(lines)
+
+# Perfil activo (None = se envía la imagen descargada tal cual)
+image_profile: Optional[ImageProfile] = ImageProfile() if settings.image_preprocess and Image is not None else None
+preprocess_stats = PreprocessStats()
+
+# =============================================================================
+# CHATFIGHT INFERENCE ROUTER
+# =============================================================================
+
+class RouteArm:
+    """
+    Una combinación (modelo, variante de prompt, perfil de imagen) para un tipo de juego,
+    con su posterior Beta(1 + victorias, 1 + derrotas) y la latencia media de inferencia.
+    """
+    
+    def __init__(self, tipo: str, model: str, prompt: PromptVariant, profile: Optional[ImageProfile]):
+        self.tipo = tipo
+        self.model = model
+        self.prompt = prompt
+        self.profile = profile
+        self.wins = 0
+        self.losses = 0
+        self.pulls = 0
+        self.latency: Optional[float] = None
+        # Clave válida como nombre de campo de MongoDB (sin puntos ni $)
+        profile_name = profile.name if profile is not None else "original"
+        self.key = re.sub(r"[.$]", "_", f"{model}|{prompt.name}|{profile_name}")
+    
+    @property
+    def label(self) -> str:
+        """Nombre corto para -cf: modelo sin proveedor · prompt · perfil"""
+        profile_name = self.profile.name if self.profile is not None else "original"
+        return f"{self.model.rsplit('/', 1)[-1]} · {self.prompt.name} · {profile_name}"
+    
+    def win_rate(self) -> float:
+        """Media del posterior"""
+        return (1 + self.wins) / (2 + self.wins + self.losses)
+    
+    def sample(self, latency_budget: float) -> float:
+        """
+        Muestra de Thompson sampling. Si la latencia media supera el presupuesto, la muestra
+        se escala por presupuesto/latencia: a igual acierto gana la combinación más rápida.
+        """
+        value = random.betavariate(1 + self.wins, 1 + self.losses)
+        if self.latency is not None and latency_budget > 0 and self.latency > latency_budget:
+            value *= latency_budget / self.latency
+        return value
+
+class InferenceRouter:
+    """
+    Elige por tipo de juego la combinación (modelo, prompt, perfil de imagen) con Thompson
+    sampling sobre el resultado de cada ronda (won = 1; lost o wrong = 0), de modo que
+    maximiza la tasa de victorias esperada sin pasarse del presupuesto de latencia.
+    El estado se persiste en el documento {"type": "chatfight_router"}.
+    """
+    
+    def __init__(self, enabled: bool = settings.router_enabled, models: Optional[List[str]] = None,
+                 image_modes: Optional[List[str]] = None, latency_budget: float = settings.router_latency_budget):
+        self.enabled = enabled
+        self.models = models if models is not None else [settings.groq_model, *settings.router_models]
+        self.image_modes = image_modes if image_modes is not None else list(settings.router_image_modes)
+        self.latency_budget = latency_budget
+        self.arms: Dict[str, Dict[str, RouteArm]] = {}
+        self.writer = StatsWriter({"type": "chatfight_router"})
+        self.loaded = False
+    
+    def profiles(self) -> List[Optional[ImageProfile]]:
+        """Perfiles de imagen a probar: el activo y sus variantes de modo de color"""
+        if image_profile is None:
+            return [None]
+        profiles = [image_profile]
+        for mode in self.image_modes:
+            if mode != image_profile.mode and mode in ImageProfile.MODES:
+                profiles.append(ImageProfile(crop=image_profile.crop, max_side=image_profile.max_side,
+                                             mode=mode, quality=image_profile.quality))
+        return profiles
+    
+    def arms_for(self, tipo: str) -> Dict[str, RouteArm]:
+        """Combinaciones de un tipo de juego (se crean la primera vez que se piden)"""
+        arms = self.arms.get(tipo)
+        if arms is None:
+            game = GAME_TYPES.get(tipo)
+            prompts = game.prompts if game is not None else (PromptVariant("base", DEFAULT_PROMPT),)
+            if not self.enabled:
+                # Sin router: siempre el modelo principal, el prompt base y el perfil activo
+                prompts, models, profiles = prompts[:1], self.models[:1], [image_profile]
+            else:
+                models, profiles = self.models, self.profiles()
+            arms = {}
+            for model in models:
+                for prompt in prompts:
+                    for profile in profiles:
+                        arm = RouteArm(tipo, model, prompt, profile)
+                        arms[arm.key] = arm
+            self.arms[tipo] = arms
+        return arms
+    
+    def reset_arms(self):
+        """
+        Rehace las combinaciones tras cambiar el modelo principal, el perfil de imagen o la
+        activación del router. Las que siguen existiendo conservan lo aprendido.
+        """
+        previous, self.arms = self.arms, {}
+        for tipo, arms in previous.items():
+            current = self.arms_for(tipo)
+            for key in current:
+                if key in arms:
+                    current[key] = arms[key]
+    
+    def choose(self, tipo: str) -> RouteArm:
+        """Combinación para la siguiente ronda: la de mayor muestra del posterior"""
+        arms = list(self.arms_for(tipo).values())
+        if len(arms) == 1:
+            return arms[0]
+        return max(arms, key=lambda arm: arm.sample(self.latency_budget))
+    
+    def observe_latency(self, arm: RouteArm, seconds: float, alpha: float = 0.2):
+        """Media móvil exponencial de la latencia de inferencia de la combinación"""
+        arm.latency = seconds if arm.latency is None else (1 - alpha) * arm.latency + alpha * seconds
+        self.writer.set(f"arms.{arm.tipo}.{arm.key}.latency", round(arm.latency, 4))
+    
+    def record(self, tipo: str, key: str, outcome: str):
+        """Actualiza el posterior con el resultado de una ronda (won, lost o wrong)"""
+        arm = self.arms_for(tipo).get(key)
+        if arm is None:
+            return
+        field = "wins" if outcome == "won" else "losses"
+        setattr(arm, field, getattr(arm, field) + 1)
+        arm.pulls += 1
+        self.writer.inc(f"arms.{tipo}.{key}.{field}")
+        self.writer.inc(f"arms.{tipo}.{key}.pulls")
+    
+    def reconcile(self, doc: Optional[dict]):
+        """Suma el estado persistido a lo aprendido desde el arranque (mismo criterio que los grupos)"""
+        if self.loaded:
+            return
+        self.loaded = True
+        for tipo, persisted_arms in ((doc or {}).get("arms") or {}).items():
+            arms = self.arms_for(tipo)
+            for key, state in persisted_arms.items():
+                arm = arms.get(key)
+                if arm is None:
+                    # Combinación que ya no está configurada
+                    continue
+                arm.wins += state.get("wins", 0)
+                arm.losses += state.get("losses", 0)
+                arm.pulls += state.get("pulls", 0)
+                if arm.latency is None:
+                    arm.latency = state.get("latency")
+    
+    def text(self) -> str:
+        """Mejores combinaciones por tipo de juego para -cf"""
+        if not self.arms:
+            return "• Sin datos todavía"
+        lines = []
+        for tipo, arms in self.arms.items():
+            ranked = sorted(arms.values(), key=lambda arm: arm.win_rate(), reverse=True)
+            for arm in ranked[:3]:
+                latency = f"{arm.latency * 1000:.0f} ms" if arm.latency is not None else "—"
+                lines.append(f"• {tipo}: {arm.label} — {arm.wins}/{arm.pulls} victorias "
+                             f"({arm.win_rate():.0%}), {latency}")
+        return "\n".join(lines)
+
+router = InferenceRouter()
+
+# =============================================================================
+# CHATFIGHT GAME DETECTION
+# =============================================================================
+
+# Tipos de juego incluidos. Otros minijuegos o idiomas se añaden con register_game_type()
+register_game_type(GameType(
+    "operacion", "Operaciones calculadas",
+    matchers=("resultado del cálculo", "tabla de clasificación"),
+    prompt="Responde SOLO con el resultado del cálculo matemático de la imagen. Solo el número, sin puntos, sin comas. fijate siempre si el resultado es negativo o positivo, el orden de los factores en restas si altera el producto",
+    validator=re.compile(r"^-?\d+$"),
+    normalize=lambda answer: answer.replace("−", "-").replace(".", "").replace(",", "").replace(" ", ""),
+    solvers=(solve_arithmetic_locally,),
+    example_caption=CAPTION_OPERACION,
+    prompt_variants=(
+        PromptVariant("estricto", "Calcula la operación de la imagen respetando el signo y la prioridad de los "
+                                  "operadores. Responde únicamente con el número entero resultante.", 0.0),
+    ),
+))
+register_game_type(GameType(
+    "palabra", "Palabras encontradas",
+    matchers=("escribir la palabra", "escalar en la clasificación"),
+    prompt="Responde SOLO con la palabra que aparece en la imagen, sin puntos, sin comas, sin nada más. Solo la palabra.",
+    validator=re.compile(r"^[^\W\d_]+$"),
+    example_caption=CAPTION_PALABRA,
+    prompt_variants=(
+        PromptVariant("estricto", "Transcribe exactamente, letra por letra, la palabra de la imagen. "
+                                  "Responde únicamente con esa palabra.", 0.0),
+    ),
+))
+
+def has_game_media(message) -> bool:
+    """True si el mensaje trae una foto o un documento de imagen"""
+    if message.photo is not None:
+        return True
+    document = message.document
+    return document is not None and (document.mime_type or "").startswith("image/")
+
+def classify_game(message) -> Optional[str]:
+    """
+    Clasifica un mensaje del bot ChatFight según los tipos registrados.
+    Se revisan el caption (o texto) y el nombre del documento, si lo hay.
+    Returns: tipo de juego o None
+    """
+    text = message.caption or message.text or ""
+    if message.document is not None and message.document.file_name:
+        text = f"{text} {message.document.file_name}"
+    return classify_caption(text)
+
+def detect_game_type(message) -> Tuple[bool, Optional[str], Optional[str]]:
+    """
+    Detecta el tipo de mensaje del bot ChatFight
+    Returns: (is_game, tipo, None)
+    """
+    try:
+        # Verificar que sea del bot ChatFight
+        if not message.from_user or message.from_user.id != settings.bot_id:
+            return False, None, None
+        
+        # Verificar que sea en uno de los grupos atendidos
+        if message.chat.id not in shards:
+            return False, None, None
+        
+        tipo = classify_game(message)
+        return tipo is not None, tipo, None
+        
+    except Exception as e:
+        log.error(f"[ChatFight] Error de detección del tipo: {e}")
+        return False, None, None
+
+async def _chatfight_game_filter(_, __, message) -> bool:
+    """
+    Filtro de Pyrogram: deja pasar solo juegos registrados del bot ChatFight con imagen.
+    Guarda el tipo detectado en message.chatfight_tipo (como hace filters.command con
+    message.command) para no volver a clasificar el mensaje, y el instante en que empezó
+    en message.chatfight_received_at para que la ronda cuente también el filtro.
+    Es asíncrono para que Pyrogram no lo ejecute en su pool de hilos.
+    """
+    started = time.perf_counter()
+    if message.from_user is None or message.from_user.id != settings.bot_id:
+        return False
+    if not has_game_media(message):
+        return False
+    tipo = classify_game(message)
+    if tipo is None:
+        return False
+    message.chatfight_tipo = tipo
+    message.chatfight_received_at = started
+    # Solo los juegos: la charla descartada no debe diluir el percentil
+    metrics.observe("filter", time.perf_counter() - started)
+    return True
+
+chatfight_game_filter = filters.create(_chatfight_game_filter, "ChatFightGameFilter")
+
+# =============================================================================
+# CHATFIGHT ROUND TRACKING
+# =============================================================================
+
+class RoundTracker:
+    """
+    Rondas abiertas por grupo (clave: message.id del juego) con la tarea que las procesa.
+    Cuando ChatFight cierra una ronda (ganador, respuesta al juego o juego siguiente),
+    se cancela su tarea en la etapa en que esté para no gastar cuota ni responder tarde.
+    """
+    
+    def __init__(self, close_pattern: str = settings.round_close_pattern,
+                 close_on_next: bool = settings.drop_superseded_rounds):
+        self.close_pattern = re.compile(close_pattern, re.IGNORECASE) if close_pattern else None
+        self.close_on_next = close_on_next
+        self.rounds: Dict[int, Dict[int, asyncio.Task]] = {}
+        self._closing: Set[asyncio.Task] = set()
+    
+    def open(self, shard: GroupShard, message_id: int, task: asyncio.Task):
+        """Registra la ronda de un juego nuevo; cierra las anteriores del grupo si procede"""
+        if self.close_on_next:
+            self.close(shard.group_id, before=message_id, reason="juego siguiente")
+        group_rounds = self.rounds.setdefault(shard.group_id, {})
+        group_rounds[message_id] = task
+        
+        def _done(finished: asyncio.Task):
+            group_rounds.pop(message_id, None)
+            cancelled = finished in self._closing
+            self._closing.discard(finished)
+            shard.record_round(cancelled)
+        
+        task.add_done_callback(_done)
+    
+    def close(self, group_id: int, message_id: Optional[int] = None, before: Optional[int] = None,
+              reason: str = "") -> int:
+        """
+        Cancela la ronda message_id, las anteriores a `before` o, sin ninguno de los dos,
+        todas las abiertas del grupo. Returns: rondas cerradas.
+        """
+        group_rounds = self.rounds.get(group_id, {})
+        if message_id is not None:
+            targets = [message_id] if message_id in group_rounds else []
+        elif before is not None:
+            targets = [mid for mid in group_rounds if mid < before]
+        else:
+            targets = list(group_rounds)
+        for mid in targets:
+            task = group_rounds[mid]
+            if not task.done():
+                self._closing.add(task)
+                task.cancel()
+                log.info(f"[ChatFight] Ronda {mid} en {group_id} cerrada ({reason}), trabajo cancelado")
+        return len(targets)
+    
+    def on_bot_message(self, message, me=None) -> int:
+        """
+        Procesa un mensaje del bot ChatFight que no es un juego: ¿cierra alguna ronda?
+        Un mensaje que responde a algo solo cierra la ronda aludida (el juego o nuestra respuesta);
+        el cierre de todas las rondas del grupo queda para los anuncios sin destinatario.
+        """
+        group_id = message.chat.id
+        if not self.rounds.get(group_id):
+            return 0
+        reply_to = getattr(message, "reply_to_message_id", None)
+        if reply_to is not None:
+            if reply_to not in self.rounds[group_id]:
+                reply_to = outcome_tracker.round_for_reply(group_id, reply_to)
+            if reply_to is None:
+                return 0
+            return self.close(group_id, message_id=reply_to, reason="respuesta del bot")
+        text = message.text or message.caption or ""
+        if OutcomeTracker.mentions(message, text, me):
+            # Nuestra victoria anunciada sin responder: no dice qué ronda cierra
+            return 0
+        if self.close_pattern is not None and self.close_pattern.search(text):
+            return self.close(group_id, reason="ganador")
+        return 0
+    
+    @property
+    def open_rounds(self) -> int:
+        return sum(len(group_rounds) for group_rounds in self.rounds.values())
+
+round_tracker = RoundTracker()
+
+class OutcomeTracker:
+    """
+    Resultado de cada respuesta enviada según los mensajes posteriores del bot ChatFight:
+    - won: el mensaje responde a nuestra respuesta o nos menciona (y no revela otra respuesta)
+    - lost: respuesta correcta, pero ganó otro jugador
+    - wrong: la respuesta correcta que revela el bot no coincide con la nuestra
+    El resultado va a las estadísticas del grupo, al historial y al router.
+    Si no llega ningún mensaje concluyente en `timeout` segundos, la ronda caduca sin resultado.
+    """
+    
+    def __init__(self, answer_pattern: str = settings.outcome_answer_pattern, close_pattern: str = settings.round_close_pattern,
+                 timeout: float = settings.outcome_timeout):
+        self.answer_pattern = re.compile(answer_pattern, re.IGNORECASE) if answer_pattern else None
+        self.close_pattern = re.compile(close_pattern, re.IGNORECASE) if close_pattern else None
+        self.timeout = timeout
+        # group_id -> {message_id del juego: ronda pendiente}, en orden de llegada
+        self.pending: Dict[int, "OrderedDict[int, dict]"] = {}
+        self.counts = {"won": 0, "lost": 0, "wrong": 0, "expired": 0}
+    
+    def expect(self, shard: GroupShard, message_id: int, reply_id: Optional[int], tipo: str, answer: str,
+               route: Optional[str] = None, file_key: Optional[str] = None, phash: Optional[str] = None,
+               profile: Optional[str] = None):
+        """Registra una respuesta enviada a la espera de su resultado (con sus claves de caché y perfil de imagen)"""
+        self.pending.setdefault(shard.group_id, OrderedDict())[message_id] = {
+            "shard": shard, "message_id": message_id, "reply_id": reply_id, "tipo": tipo,
+            "answer": answer, "route": route, "file_key": file_key, "phash": phash, "profile": profile,
+            "expires": time.monotonic() + self.timeout,
+        }
+    
+    def round_for_reply(self, group_id: int, reply_id: int) -> Optional[int]:
+        """message_id del juego al que respondimos con el mensaje reply_id (None si no es nuestro)"""
+        for entry in self.pending.get(group_id, {}).values():
+            if entry["reply_id"] == reply_id:
+                return entry["message_id"]
+        return None
+    
+    def _expire(self, group_rounds: "OrderedDict[int, dict]"):
+        now = time.monotonic()
+        while group_rounds:
+            entry = next(iter(group_rounds.values()))
+            if entry["expires"] > now:
+                break
+            group_rounds.popitem(last=False)
+            self.counts["expired"] += 1
+    
+    @staticmethod
+    def mentions(message, text: str, me) -> bool:
+        """True si el mensaje menciona a nuestra cuenta (mención con o sin @username)"""
+        if me is None:
+            return False
+        entities = list(message.entities or []) + list(getattr(message, "caption_entities", None) or [])
+        for entity in entities:
+            user = getattr(entity, "user", None)
+            if user is not None and user.id == me.id:
+                return True
+        username = getattr(me, "username", None)
+        return bool(username) and f"@{username}".lower() in text.lower()
+    
+    def on_bot_message(self, message, me=None) -> Optional[str]:
+        """Procesa un mensaje del bot ChatFight que no es un juego. Returns: resultado o None"""
+        group_rounds = self.pending.get(message.chat.id)
+        if not group_rounds:
+            return None
+        self._expire(group_rounds)
+        if not group_rounds:
+            return None
+        
+        # La ronda aludida (respuesta al juego o a nuestra respuesta) o, si no, la más antigua
+        reply_to = getattr(message, "reply_to_message_id", None)
+        entry = group_rounds.get(reply_to)
+        if entry is None and reply_to is not None:
+            entry = next((e for e in group_rounds.values() if e["reply_id"] == reply_to), None)
+            replied = getattr(message, "reply_to_message", None)
+            if entry is None and replied is not None and getattr(replied.from_user, "id", None) == settings.bot_id:
+                # Cierra otro juego del bot al que no respondimos: no es el resultado de ninguna de las nuestras
+                return None
+        if entry is None:
+            entry = next(iter(group_rounds.values()))
+        
+        text = message.text or message.caption or ""
+        addressed = (reply_to is not None and reply_to == entry["reply_id"]) or self.mentions(message, text, me)
+        revealed = self.answer_pattern.search(text) if self.answer_pattern is not None else None
+        correct = expected = None
+        if revealed is not None:
+            expected = clean_answer(entry["tipo"], revealed.group("answer"))
+            correct = expected.lower() == entry["answer"].lower()
+        
+        if addressed and correct is not False:
+            outcome = "won"
+        elif correct is not None:
+            outcome = "lost" if correct else "wrong"
+        elif self.close_pattern is not None and self.close_pattern.search(text):
+            outcome = "lost"
+        else:
+            return None
+        
+        del group_rounds[entry["message_id"]]
+        self.resolve(entry, outcome, expected)
+        return outcome
+    
+    def resolve(self, entry: dict, outcome: str, expected: Optional[str] = None):
+        """
+        Propaga el resultado de una ronda a estadísticas, historial y router. Una respuesta
+        errónea se retira de la caché (o se corrige con la que revela ChatFight)
+        """
+        shard: GroupShard = entry["shard"]
+        self.counts[outcome] += 1
+        shard.record_outcome(outcome)
+        history_writer.set_outcome((shard.group_id, entry["message_id"]), outcome)
+        if entry["route"] is not None:
+            router.record(entry["tipo"], entry["route"], outcome)
+        if entry.get("profile") is not None:
+            preprocess_stats.record_outcome(entry["profile"], outcome)
+        if outcome == "wrong":
+            correct = expected if expected and is_valid_answer(entry["tipo"], expected) else None
+            answer_cache.invalidate(entry["tipo"], entry.get("file_key"), entry.get("phash"), answer=correct)
+        log.info(f"[ChatFight] Ronda {entry['message_id']} en {shard.group_id}: {outcome} ({entry['answer']})")
+    
+    def text(self) -> str:
+        counts = self.counts
+        decided = counts["won"] + counts["lost"] + counts["wrong"]
+        rate = f"{counts['won'] / decided:.0%}" if decided else "—"
+        return (f"• Ganadas {counts['won']} · perdidas {counts['lost']} · erróneas {counts['wrong']} "
+                f"(victorias {rate}) · sin resultado {counts['expired']}")
+
+outcome_tracker = OutcomeTracker()
+
+# =============================================================================
+# CHATFIGHT ROUND HISTORY
+# =============================================================================
+
+class HistoryWriter(BackgroundWriter):
+    """
+    Historial de rondas: un documento por ronda en su propia colección, insertados por lotes
+    con insert_many sin orden. Sin MongoDB se conservan hasta max_buffer (se descartan los más antiguos).
+    """
+    
+    label = "rondas de historial"
+    
+    def __init__(self, flush_interval: float = settings.stats_flush_interval, batch_size: int = settings.history_batch,
+                 max_buffer: int = settings.history_max_buffer):
+        super().__init__(flush_interval, batch_size)
+        self.max_buffer = max(batch_size, max_buffer)
+        self.inserted = 0
+        self.dropped = 0
+        self._docs: List[dict] = []
+        # Resultados de rondas ya insertadas: ((group_id, message_id), outcome)
+        self._outcomes: List[Tuple[RoundKey, str]] = []
+    
+    def add(self, doc: dict):
+        """Encola el documento de una ronda"""
+        self._docs.append(doc)
+        if len(self._docs) > self.max_buffer:
+            del self._docs[0]
+            self.dropped += 1
+            self._pending -= 1
+        self._mark()
+    
+    def set_outcome(self, round_key: RoundKey, outcome: str):
+        """Anota el resultado de una ronda: en el documento si aún no se insertó, si no con una actualización"""
+        for doc in reversed(self._docs):
+            if (doc["group_id"], doc["message_id"]) == round_key:
+                doc["outcome"] = outcome
+                return
+        self._outcomes.append((round_key, outcome))
+        del self._outcomes[:-self.max_buffer]
+        self._mark()
+    
+    async def flush(self) -> bool:
+        """Inserta los documentos y actualiza los resultados pendientes. Si falla, los devuelve al buffer"""
+        if not self._docs and not self._outcomes:
+            return True
+        if not mongo_ready.is_set():
+            return False
+        docs, outcomes = self._docs, self._outcomes
+        self._docs, self._outcomes, self._pending = [], [], 0
+        try:
+            with metrics.span("db_save"):
+                await asyncio.to_thread(self._write, docs, outcomes)
+            self.inserted += len(docs)
+            self.flushes += 1
+            return True
+        except Exception as e:
+            log.error(f"[ChatFight] Error guardando el historial en MongoDB: {e}")
+            self._docs[:0] = docs
+            del self._docs[:-self.max_buffer]
+            self._outcomes[:0] = outcomes
+            self._pending = len(self._docs) + len(self._outcomes)
+            return False
+    
+    def _write(self, docs: List[dict], outcomes: List[Tuple[RoundKey, str]]):
+        collection = get_history_collection()
+        if docs:
+            # insert_many añade _id a los documentos: se insertan copias para poder reintentar
+            collection.insert_many([dict(doc) for doc in docs], ordered=False)
+        for (group_id, message_id), outcome in outcomes:
+            collection.update_one({"group_id": group_id, "message_id": message_id},
+                                  {"$set": {"outcome": outcome}})
+
+history_writer = HistoryWriter()
+
+def build_history_doc(shard: GroupShard, message, tipo: str, trace: dict, received_at: Optional[float],
+                      answer: Optional[str] = None, outcome: str = "answered",
+                      error: Optional[str] = None, finished_at: Optional[float] = None) -> dict:
+    """
+    Documento de historial de una ronda a partir de su traza
+    finished_at: instante (time.perf_counter) en que terminó la ronda; por defecto, ahora
+    """
+    source = trace.get("source")
+    if finished_at is None:
+        finished_at = time.perf_counter()
+    return {
+        "created_at": datetime.now(timezone.utc),
+        "group_id": shard.group_id,
+        "message_id": message.id,
+        "account": shard.account,
+        "tipo": tipo,
+        "answer": answer,
+        "outcome": outcome,
+        "error": error,
+        "source": source,
+        "model": trace.get("model"),
+        "route": trace.get("route"),
+        "cache_hit": source in ("cache_file", "cache_phash"),
+        "hedged": trace.get("hedged", False),
+        "retries": trace.get("retries", 0),
+        "rendition": trace.get("rendition"),
+        "downloaded_bytes": trace.get("downloaded"),
+        "latency_ms": round((finished_at - received_at) * 1000, 1) if received_at is not None else None,
+        "stages_ms": {stage: round(seconds * 1000, 1) for stage, seconds in trace["stages"].items()},
+    }
+
+# Dimensiones de los informes de -cfh: sin modelo (caché, solver local) se agrupa por origen
+HISTORY_DIMENSIONS = {
+    "tipo": "$tipo",
+    "modelo": {"$ifNull": ["$model", "$source"]},
+    "hora": {"$hour": "$created_at"},
+}
+
+# $percentile requiere MongoDB 7.0; si el servidor no lo admite se calcula aquí
+_native_percentile = True
+
+def history_pipeline(dimension: str, since: datetime, group_id: Optional[int] = None,
+                     native_percentile: bool = True) -> list:
+    """Agregación de rondas, victorias, errores y latencia p50/p95 por dimensión"""
+    match: dict = {"created_at": {"$gte": since}}
+    if group_id is not None:
+        match["group_id"] = group_id
+    group = {
+        "_id": HISTORY_DIMENSIONS[dimension],
+        "rounds": {"$sum": 1},
+        "won": {"$sum": {"$cond": [{"$eq": ["$outcome", "won"]}, 1, 0]}},
+        "decided": {"$sum": {"$cond": [{"$in": ["$outcome", ["won", "lost", "wrong"]]}, 1, 0]}},
+        "errors": {"$sum": {"$cond": [{"$eq": ["$outcome", "error"]}, 1, 0]}},
+    }
+    if native_percentile:
+        group["latency"] = {"$percentile": {"input": "$latency_ms", "p": [0.5, 0.95], "method": "approximate"}}
+    else:
+        group["latencies"] = {"$push": "$latency_ms"}
+    return [{"$match": match}, {"$group": group}, {"$sort": {"_id": 1}}]
+
+def query_history(group_id: Optional[int] = None, days: float = 7) -> Dict[str, List[dict]]:
+    """Ejecuta los informes de historial (bloqueante, se ejecuta en un hilo)"""
+    global _native_percentile
+    
+    collection = get_history_collection()
+    since = datetime.now(timezone.utc) - timedelta(days=days)
+    results = {}
+    for dimension in HISTORY_DIMENSIONS:
+        rows = None
+        if _native_percentile:
+            try:
+                rows = list(collection.aggregate(history_pipeline(dimension, since, group_id)))
+            except OperationFailure as e:
+                log.info(f"[ChatFight] $percentile no disponible, se calcula en el bot: {e}")
+                _native_percentile = False
+        if rows is None:
+            rows = list(collection.aggregate(history_pipeline(dimension, since, group_id, native_percentile=False)))
+            for row in rows:
+                values = [v for v in row.pop("latencies") if v is not None]
+                histogram = LatencyHistogram(len(values))
+                for value in values:
+                    histogram.observe(value)
+                row["latency"] = list(histogram.percentiles(0.5, 0.95)) if values else None
+        results[dimension] = rows
+    return results
+
+def format_history_report(results: Dict[str, List[dict]], days: float, group_id: Optional[int] = None) -> str:
+    """Texto de -cfh: una línea por valor de cada dimensión"""
+    scope = f"grupo `{group_id}`" if group_id is not None else "todos los grupos"
+    blocks = [f"📜 **Historial ({scope}, últimos {days:g} días)**"]
+    for dimension, rows in results.items():
+        lines = []
+        for row in rows:
+            win_rate = f"{row['won'] / row['decided']:.0%}" if row["decided"] else "—"
+            latency = row.get("latency") or [None, None]
+            p50, p95 = (f"{v:.0f}" if v is not None else "—" for v in latency)
+            label = f"{row['_id']:02d}h" if dimension == "hora" and row["_id"] is not None else row["_id"]
+            lines.append(f"• {label}: {row['rounds']} rondas · victorias {win_rate} · "
+                         f"errores {row['errors']} · p50 {p50} · p95 {p95} ms")
+        blocks.append(f"**Por {dimension}:**\n" + ("\n".join(lines) or "• Sin datos"))
+    return "\n\n".join(blocks)
 
-def save_chatfight_db(enabled: bool, stats: dict):
-    """Guarda el estado en MongoDB"""
-    try:
-        collection = get_chatfight_collection()
-        collection.update_one(
-            {"type": "chatfight_stats"},
-            {
-                "$set": {
-                    "type": "chatfight_stats",
-                    "enabled": enabled,
-                    "stats": stats,
-                    "updated_at": datetime.now(timezone.utc)
-                }
-            },
-            upsert=True
-        )
-    except Exception as e:
-        log.error(f"[ChatFight] Error de guardado en MongoDB: {e}")
+# =============================================================================
+# CHATFIGHT IMAGE ARCHIVE (DEBUG)
+# =============================================================================
 
-# Inicializar el estado desde MongoDB
-db_data = load_chatfight_db()
-chatfight_enabled = db_data.get("enabled", False)
+_archive_tasks: Set[asyncio.Task] = set()
 
-# Estadísticas por defecto
-default_stats = {
-    "total_responses": 0,
-    "palabra_responses": 0,
-    "operacion_responses": 0,
-    "errors": 0,
-    "last_response": None,
-    "history": []
-}
+def _write_archive_file(path: str, data: bytes):
+    """Escribe una imagen archivada en disco"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
 
-chatfight_stats = default_stats.copy()
-saved_stats = db_data.get("stats", {})
-chatfight_stats.update(saved_stats)
+def archive_image(data: bytes, message_id: int, tipo: str, mime_type: str):
+    """
+    Guarda una copia de la imagen en CHATFIGHT_ARCHIVE_DIR en segundo plano.
+    Solo para depuración: no bloquea ni retrasa la respuesta.
+    """
+    ext = mime_type.split("/")[-1] or "bin"
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S")
+    path = os.path.join(settings.archive_dir, f"{stamp}_{message_id}_{tipo}.{ext}")
+    
+    async def _write():
+        try:
+            await asyncio.to_thread(_write_archive_file, path, data)
+        except Exception as e:
+            log.warning(f"[ChatFight] Error archivando imagen: {e}")
+    
+    task = asyncio.create_task(_write())
+    _archive_tasks.add(task)
+    task.add_done_callback(_archive_tasks.discard)
 
 # =============================================================================
-# CHATFIGHT GROQ CLIENT
+# CHATFIGHT ANSWER SENDER
 # =============================================================================
 
-class ChatFightProcessor:
-    def __init__(self, api_key: str):
-        self.client = Groq(api_key=api_key)
-        self.model = "meta-llama/llama-4-scout-17b-16e-instruct"
-    
-    def image_to_base64(self, image_path: str) -> str:
-        """Convierte una imagen en base64"""
-        with open(image_path, "rb") as image_file:
-            encoded_string = base64.b64encode(image_file.read()).decode('utf-8')
-            return f"data:image/jpeg;base64,{encoded_string}"
-    
-    def get_prompt_for_type(self, tipo: str) -> str:
-        """Obtiene el prompt según el tipo de juego"""
-        if tipo == "palabra":
-            return "Responde SOLO con la palabra que aparece en la imagen, sin puntos, sin comas, sin nada más. Solo la palabra."
-        elif tipo == "operacion":
-            return "Responde SOLO con el resultado del cálculo matemático de la imagen. Solo el número, sin puntos, sin comas. fijate siempre si el resultado es negativo o positivo, el orden de los factores en restas si altera el producto"
-        return "Responde solo con lo que se pide en la imagen."
-    
-    async def analyze_image(self, image_path: str, tipo: str) -> str:
-        """Analiza una imagen y retorna la respuesta con timeout"""
-        image_data_url = self.image_to_base64(image_path)
-        prompt = self.get_prompt_for_type(tipo)
-        
+class AnswerSender:
+    """
+    Envío de respuestas por la vía más corta: messages.SendMessage en crudo con reply_to_msg_id
+    ya fijado y el InputPeer del grupo resuelto de antemano. Evita lo que añade message.reply():
+    la consulta del peer al almacenamiento de la sesión, el parseo de entidades del texto
+    y la construcción del Message de Pyrogram a partir del resultado.
+    """
+    
+    def __init__(self):
+        # (cuenta, chat_id) -> InputPeer
+        self.peers: Dict[Tuple[str, int], object] = {}
+        self.sent = 0
+    
+    async def resolve(self, client: Client, chat_id: int):
+        """InputPeer del chat, resuelto una vez por cuenta"""
+        key = (getattr(client, "name", ""), chat_id)
+        peer = self.peers.get(key)
+        if peer is None:
+            peer = self.peers[key] = await client.resolve_peer(chat_id)
+        return peer
+    
+    async def prime(self, client: Client, group_ids: List[int]):
+        """Resuelve de antemano los peers de los grupos de una cuenta"""
+        for group_id in group_ids:
+            await self.resolve(client, group_id)
+    
+    async def send(self, client: Client, message, text: str) -> Optional[int]:
+        """Responde al mensaje con el texto tal cual (sin formato). Returns: id del mensaje enviado"""
+        peer = await self.resolve(client, message.chat.id)
+        random_id = client.rnd_id()
         try:
-            # La API de Groq es síncrona, no necesita asyncio.wait_for
-            completion = self.client.chat.completions.create(
-                model=self.model,
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "text",
-                                "text": prompt
-                            },
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": image_data_url
-                                }
-                            }
-                        ]
-                    }
-                ],
-                temperature=0.3,
-                max_completion_tokens=100,
-                top_p=1,
-                stream=False,
-            )
-            
-            response = completion.choices[0].message.content or ""
-            
-            # Limpiar la respuesta
-            response = response.strip()
-            response = response.replace(".", "").replace(",", "").replace(" ", "")
-            
-            return response
-            
-        except Exception as e:
-            log.error(f"[ChatFight] Error analyzing image: {e}")
+            result = await client.invoke(raw.functions.messages.SendMessage(
+                peer=peer, message=text, random_id=random_id,
+                reply_to_msg_id=message.id, no_webpage=True,
+            ))
+        except Exception:
+            # Un peer caducado (access_hash) se vuelve a resolver en el siguiente envío
+            self.peers.pop((getattr(client, "name", ""), message.chat.id), None)
             raise
+        self.sent += 1
+        return self.sent_id(result, random_id)
+    
+    @staticmethod
+    def sent_id(result, random_id: int) -> Optional[int]:
+        """Id del mensaje enviado a partir de las actualizaciones que devuelve Telegram"""
+        if isinstance(result, raw.types.UpdateShortSentMessage):
+            return result.id
+        for update in getattr(result, "updates", None) or []:
+            if isinstance(update, raw.types.UpdateMessageID) and update.random_id == random_id:
+                return update.id
+            if isinstance(update, (raw.types.UpdateNewMessage, raw.types.UpdateNewChannelMessage)):
+                return update.message.id
+        return None
+
+answer_sender = AnswerSender()
+
+class PostProcessor:
+    """
+    Trabajo posterior a cada respuesta (estadísticas, historial, espera del veredicto, logs):
+    se encola y una tarea en segundo plano lo ejecuta en orden, de modo que entre tener la
+    respuesta y enviarla a Telegram no se ejecuta nada más. Sin arrancar, se ejecuta en línea.
+    """
+    
+    def __init__(self):
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.done = 0
+        self.failed = 0
+        self._task: Optional[asyncio.Task] = None
+    
+    def submit(self, job: Callable, *args):
+        if self._task is None:
+            self._execute(job, args)
+        else:
+            self.queue.put_nowait((job, args))
+    
+    def _execute(self, job: Callable, args: tuple):
+        try:
+            job(*args)
+            self.done += 1
+        except Exception as e:
+            self.failed += 1
+            log.error(f"[ChatFight] Error en el postprocesado de una ronda: {e}")
+    
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+    
+    async def _run(self):
+        while True:
+            job, args = await self.queue.get()
+            self._execute(job, args)
+            self.queue.task_done()
+    
+    async def stop(self):
+        """Ejecuta lo pendiente y detiene la tarea"""
+        if self._task is not None:
+            await self.queue.join()
+            self._task.cancel()
+            self._task = None
+
+post_processor = PostProcessor()
 
 # =============================================================================
-# CHATFIGHT GAME DETECTION
+# CHATFIGHT MESSAGE PROCESSING
 # =============================================================================
 
-def detect_game_type(message) -> Tuple[bool, Optional[str], Optional[str]]:
+class DownloadStats:
+    """Bytes descargados por ronda y escalados de miniatura a original"""
+    
+    def __init__(self):
+        self.rounds = 0
+        self.bytes = 0
+        self.thumbnails = 0
+        self.escalations = 0
+    
+    def record(self, nbytes: int, thumbnail: bool):
+        self.bytes += nbytes
+        if thumbnail:
+            self.thumbnails += 1
+    
+    def text(self) -> str:
+        average = self.bytes / self.rounds / 1024 if self.rounds else 0.0
+        return (f"• {self.rounds} rondas, {self.bytes / 1024:.0f} KB ({average:.1f} KB/ronda)\n"
+                f"• Miniaturas: {self.thumbnails} · escaladas al original: {self.escalations}")
+
+download_stats = DownloadStats()
+
+def select_renditions(media, mime_type: str, min_side: Optional[int] = None) -> List[Tuple[object, str, str]]:
     """
-    Detecta el tipo de mensaje del bot ChatFight
-    Returns: (is_game, tipo, image_path_or_none)
+    Versiones de la imagen a probar, de menor a mayor: la miniatura más pequeña cuyo lado
+    mayor alcanza min_side (si la hay y es más ligera) y, para escalar, el original.
+    Returns: [(media o file_id, etiqueta, mime_type)]
+    """
+    if min_side is None:
+        min_side = runtime_settings.value("photo_min_side")
+    original = (media, "original", mime_type)
+    if min_side <= 0:
+        return [original]
+    candidates = [t for t in (getattr(media, "thumbs", None) or [])
+                  if t.file_id and max(t.width or 0, t.height or 0) >= min_side]
+    if not candidates:
+        return [original]
+    thumb = min(candidates, key=lambda t: t.file_size or (t.width or 0) * (t.height or 0))
+    if media.file_size and thumb.file_size and thumb.file_size >= media.file_size:
+        return [original]
+    # Las miniaturas de Telegram son siempre JPEG
+    return [(thumb.file_id, f"{thumb.width}x{thumb.height}", "image/jpeg"), original]
+
+async def recognize_image(client: Client, message, processor: ChatFightProcessor, tipo: str,
+                          media, mime_type: str) -> str:
+    """
+    Descarga una versión de la imagen y obtiene la respuesta: caché por hash perceptual,
+    solvers del tipo de juego y, por último, Groq. Lanza InvalidAnswerError si no es válida.
+    La respuesta se guarda en caché después del envío (record_answer), con las claves de la traza.
     """
+    with metrics.span("download"):
+        buffer = await client.download_media(media, in_memory=True)
+    media_keepalive.touch(client)
+    if buffer is None:
+        raise RuntimeError("No se pudo descargar la imagen")
+    
+    image = buffer.getbuffer()
+    download_stats.record(image.nbytes, thumbnail=isinstance(media, str))
+    log.debug("[ChatFight] Imagen descargada en memoria (%s bytes)", image.nbytes)
+    
+    if settings.archive_dir:
+        archive_image(bytes(image), message.id, tipo, mime_type)
+    
+    # Nivel 2 de caché: por hash perceptual de los píxeles
+    phash = None
     try:
-        # Verificar que sea del bot ChatFight
-        if not message.from_user or message.from_user.id != CHATFIGHT_BOT_ID:
-            return False, None, None
-        
-        # Verificar que sea en el grupo correcto
-        if message.chat.id != CHATFIGHT_GROUP_ID:
-            return False, None, None
-        
-        # Verificar caption
-        caption = message.caption or ""
-        
-        # Buscar el tipo de operación matemática
-        if "resultado del cálculo" in caption.lower() or "tabla de clasificación" in caption.lower():
-            return True, "operacion", None
-        
-        # Buscar el tipo de palabra
-        if "escribir la palabra" in caption.lower() or "escalar en la clasificación" in caption.lower():
-            return True, "palabra", None
+        with metrics.span("phash"):
+            phash = await asyncio.to_thread(perceptual_hash, image)
+    except Exception as e:
+        log.warning(f"[ChatFight] No se pudo calcular el hash perceptual: {e}")
+    trace_note(phash=phash)
+    response = answer_cache.get("phash", phash, tipo)
+    
+    if response is not None:
+        log.debug("[ChatFight] Respuesta desde caché (hash perceptual): %s", response)
+        trace_note(source="cache_phash")
+        return response
+    
+    # Solvers propios del tipo de juego antes de recurrir a Groq
+    for solver in GAME_TYPES[tipo].solvers:
+        with metrics.span("local_solver"):
+            response = await solver(image)
+        if response is not None:
+            trace_note(source="local")
+            break
+    
+    if response is None:
+        # Modelo, prompt y perfil de imagen elegidos por el router para este tipo de juego
+        route = router.choose(tipo)
+        trace_note(source="groq", route=route.key)
         
-        return False, None, None
+        # Preparar la imagen para el modelo (fuera del event loop)
+        payload, payload_mime, profile_name = image, mime_type, "original"
+        if route.profile is not None:
+            try:
+                with metrics.span("preprocess"):
+                    payload, payload_mime = await asyncio.to_thread(
+                        preprocess_image, image, mime_type, route.profile)
+                profile_name = route.profile.name
+            except Exception as e:
+                log.warning(f"[ChatFight] Preprocesado fallido, se envía la original: {e}")
+        trace_note(profile=profile_name)
+        # Las estadísticas del intento se registran después del envío (record_inference_attempts)
+        attempt = {"route": route, "profile": profile_name, "bytes_in": image.nbytes,
+                   "bytes_out": len(payload), "seconds": None}
+        trace = round_trace.get()
+        if trace is not None:
+            trace.setdefault("attempts", []).append(attempt)
         
-    except Exception as e:
-        log.error(f"[ChatFight] Error de detección del tipo: {e}")
-        return False, None, None
+        # Analizar la imagen; una respuesta no válida cuenta como fallo de la combinación
+        inference_started = time.perf_counter()
+        try:
+            response = await processor.analyze_image(
+                payload, tipo, payload_mime, round_key=(message.chat.id, message.id), route=route)
+        except InvalidAnswerError:
+            post_processor.submit(router.record, tipo, route.key, "wrong")
+            raise
+        attempt["seconds"] = time.perf_counter() - inference_started
+    return response
 
-# =============================================================================
-# CHATFIGHT MESSAGE PROCESSING
-# =============================================================================
+def record_inference_attempts(trace: dict):
+    """Estadísticas de preprocesado y latencia de cada inferencia de la ronda (fuera del camino crítico)"""
+    for attempt in trace.pop("attempts", ()):
+        preprocess_stats.record_payload(attempt["profile"], attempt["bytes_in"], attempt["bytes_out"])
+        if attempt["seconds"] is not None:
+            preprocess_stats.record_inference(attempt["profile"], attempt["seconds"])
+            router.observe_latency(attempt["route"], attempt["seconds"])
+
+def record_answer(shard: GroupShard, message, tipo: str, trace: dict, received_at: Optional[float],
+                  answered_at: float, response: str, sent_id: Optional[int]):
+    """
+    Postprocesado de una respuesta enviada: logs, caché, estadísticas, historial y espera
+    del veredicto. Nada de esto se ejecuta antes del envío
+    """
+    log.info("[ChatFight] Respuesta enviada en %s (%s): %s", message.chat.id, tipo, response)
+    # Guardar en caché según de dónde salió la respuesta (la de file_unique_id ya estaba)
+    source = trace.get("source")
+    if source == "cache_phash":
+        answer_cache.put(tipo, response, file_key=trace.get("file_key"))
+    elif source != "cache_file":
+        answer_cache.put(tipo, response, file_key=trace.get("file_key"), phash=trace.get("phash"))
+    record_inference_attempts(trace)
+    # Las estadísticas y el historial se persisten en segundo plano
+    shard.record_response(tipo, response)
+    history_writer.add(build_history_doc(shard, message, tipo, trace, received_at, answer=response,
+                                         finished_at=answered_at))
+    # Última ronda respondida por la cuenta principal: imagen de referencia de -cfprobe
+    if shard.account == MAIN_ACCOUNT:
+        runtime_settings.remember_probe(message, tipo, response)
+    # Esperar el veredicto de ChatFight (ganada, perdida o errónea) para el router
+    outcome_tracker.expect(shard, message.id, sent_id, tipo, response, trace.get("route"),
+                           file_key=trace.get("file_key"), phash=trace.get("phash"),
+                           profile=trace.get("profile") if trace.get("source") == "groq" else None)
 
-async def process_chatfight_message(client: Client, message, processor: ChatFightProcessor):
+async def process_chatfight_message(client: Client, message, processor: ChatFightProcessor,
+                                    received_at: Optional[float] = None, tipo: Optional[str] = None):
     """
     Procesa un mensaje del bot ChatFight
+    received_at: instante (time.perf_counter) en que llegó el mensaje, para medir la latencia total
+    tipo: tipo de juego ya clasificado por el filtro; si es None se detecta aquí
     """
-    global chatfight_stats, chatfight_enabled
+    shard = get_shard(message.chat.id)
     
-    log.info(f"[ChatFight] process_chatfight_message iniciado (enabled={chatfight_enabled})")
-    
-    if not chatfight_enabled:
-        log.warning("[ChatFight] ChatFight está desactivado")
+    if shard is None or not shard.enabled:
+        log.warning("[ChatFight] ChatFight está desactivado en este grupo")
         return
     
+    # Traza de la ronda para el historial (etapas, modelo, origen de la respuesta)
+    trace = {"stages": {}}
+    round_trace.set(trace)
+    
     try:
-        # Detectar el tipo de juego
-        is_game, tipo, _ = detect_game_type(message)
-        
-        log.info(f"[ChatFight] detect_game_type resultado: is_game={is_game}, tipo={tipo}")
-        
-        if not is_game:
-            log.warning("[ChatFight] No se detectó un juego válido")
-            return
-        
-        log.info(f"[ChatFight] Detectado juego tipo: {tipo}")
+        # Detectar el tipo de juego (solo si el filtro no lo hizo ya)
+        if tipo is None:
+            with metrics.span("detect"):
+                is_game, tipo, _ = detect_game_type(message)
+            if not is_game:
+                log.warning("[ChatFight] No se detectó un juego válido")
+                return
         
-        # Descargar la imagen
-        temp_file = f"temp_chatfight_{uuid.uuid4().hex[:8]}.jpg"
+        log.debug("[ChatFight] Juego tipo %s en %s (mensaje %s)", tipo, message.chat.id, message.id)
         
         try:
-            # Descargar según el tipo de media
-            downloaded_path = None
+            # Seleccionar la media según su tipo
             if message.photo:
-                log.info(f"[ChatFight] Descargando photo...")
-                downloaded_path = await client.download_media(message.photo, file_name=temp_file)
+                media, mime_type = message.photo, "image/jpeg"
             elif message.document and message.document.mime_type.startswith('image/'):
-                log.info(f"[ChatFight] Descargando document...")
-                downloaded_path = await client.download_media(message.document, file_name=temp_file)
+                media, mime_type = message.document, message.document.mime_type
             else:
                 log.warning("[ChatFight] No se encontró media para descargar")
                 return
             
-            if not downloaded_path or not os.path.exists(downloaded_path):
-                log.error(f"[ChatFight] Error: No se pudo descargar la imagen (path={downloaded_path})")
-                return
-            
-            log.info(f"[ChatFight] Imagen descargada: {downloaded_path}")
-            
-            # Analizar la imagen
-            log.info(f"[ChatFight] Analizando imagen con Groq (timeout 30s)...")
-            response = await processor.analyze_image(downloaded_path, tipo)
+            # Nivel 1 de caché: por file_unique_id, sin descargar nada
+            file_key = media.file_unique_id
+            trace_note(file_key=file_key)
+            response = answer_cache.get("file", file_key, tipo)
             
-            log.info(f"[ChatFight] Respuesta: {response}")
-            
-            # Responder al mensaje
-            log.info(f"[ChatFight] Enviando respuesta...")
-            await message.reply(response)
-            log.info(f"[ChatFight] Respuesta enviada exitosamente")
-            
-            # Actualizar las estadísticas
-            chatfight_stats["total_responses"] += 1
-            if tipo == "palabra":
-                chatfight_stats["palabra_responses"] += 1
+            if response is not None:
+                log.debug("[ChatFight] Respuesta desde caché (file_unique_id): %s", response)
+                trace_note(source="cache_file")
             else:
-                chatfight_stats["operacion_responses"] += 1
-            
-            chatfight_stats["last_response"] = datetime.now(timezone.utc).isoformat()
-            
-            # Guardar en el historial
-            chatfight_stats["history"].append({
-                "timestamp": datetime.now(timezone.utc).isoformat(),
-                "tipo": tipo,
-                "response": response
-            })
-            
-            # Mantener el historial limitado a los últimos 100
-            if len(chatfight_stats["history"]) > 100:
-                chatfight_stats["history"] = chatfight_stats["history"][-100:]
+                # Primero la versión más pequeña suficiente; el original solo si no sale una respuesta válida
+                download_stats.rounds += 1
+                downloaded = download_stats.bytes
+                renditions = select_renditions(media, mime_type)
+                try:
+                    for index, (rendition, label, rendition_mime) in enumerate(renditions):
+                        trace_note(rendition=label)
+                        try:
+                            response = await recognize_image(
+                                client, message, processor, tipo, rendition, rendition_mime)
+                            break
+                        except InvalidAnswerError:
+                            if index == len(renditions) - 1:
+                                raise
+                            download_stats.escalations += 1
+                            post_processor.submit(
+                                log.info, "[ChatFight] Respuesta no válida con la versión %s, descargando el original", label)
+                finally:
+                    # También en las rondas fallidas, obsoletas o canceladas, que son las que más suelen escalar
+                    trace_note(downloaded=download_stats.bytes - downloaded)
             
-            # Guardar en MongoDB
-            save_chatfight_db(chatfight_enabled, chatfight_stats)
-            
-            # Limpiar el archivo temporal
-            try:
-                os.remove(downloaded_path)
-                log.info(f"[ChatFight] Archivo temporal eliminado: {downloaded_path}")
-            except Exception as e:
-                log.warning(f"[ChatFight] Error eliminando archivo temporal: {e}")
+            # Responder al mensaje: nada más se ejecuta antes del envío
+            with metrics.span("reply"):
+                sent_id = await answer_sender.send(client, message, response)
+            answered_at = time.perf_counter()
+            if received_at is not None:
+                metrics.observe("total", answered_at - received_at)
+            post_processor.submit(record_answer, shard, message, tipo, trace, received_at, answered_at,
+                                  response, sent_id)
             
+        except StaleRoundError:
+            # La ronda terminó o no había cuota a tiempo: no es un error, pero queda en el historial
+            record_inference_attempts(trace)
+            history_writer.add(build_history_doc(shard, message, tipo, trace, received_at, outcome="stale"))
+            return
         except Exception as e:
             log.error(f"[ChatFight] Error de procesamiento: {e}")
             log.exception("[ChatFight] Traceback:")
-            chatfight_stats["errors"] += 1
-            save_chatfight_db(chatfight_enabled, chatfight_stats)
+            record_inference_attempts(trace)
+            shard.record_error()
+            history_writer.add(build_history_doc(shard, message, tipo, trace, received_at,
+                                                 outcome="error", error=str(e)[:200]))
             
     except Exception as e:
         log.error(f"[ChatFight] Error general: {e}")
         traceback.print_exc()
-        chatfight_stats["errors"] += 1
-        save_chatfight_db(chatfight_enabled, chatfight_stats)
+        shard.record_error()
+    finally:
+        if "downloaded" in trace:
+            post_processor.submit(log.info, "[ChatFight] Ronda %s: %s bytes descargados (%s)",
+                                  message.id, trace["downloaded"], trace.get("rendition"))
 
 # =============================================================================
 # CHATFIGHT CONTROL COMMANDS
 # =============================================================================
 
-def chatfight_toggle():
-    """Activa/desactiva el módulo ChatFight"""
-    global chatfight_enabled
-    chatfight_enabled = not chatfight_enabled
-    save_chatfight_db(chatfight_enabled, chatfight_stats)
-    return chatfight_enabled
+def chatfight_toggle(group_id: Optional[int] = None) -> bool:
+    """
+    Activa/desactiva ChatFight en un grupo.
+    Sin group_id (o fuera de un grupo atendido) se aplica a todos: se activan
+    todos si alguno estaba desactivado, si no se desactivan todos.
+    """
+    shard = shards.get(group_id) if group_id is not None else None
+    if shard is not None:
+        return shard.toggle()
+    new_state = not all(s.enabled for s in shards.values())
+    for s in shards.values():
+        s.toggle(new_state)
+    return new_state
 
-def get_chatfight_status() -> dict:
-    """Obtiene el estado actual del módulo"""
+def get_chatfight_status(group_id: int) -> dict:
+    """Obtiene el estado actual de un grupo"""
+    shard = shards[group_id]
     return {
-        "enabled": chatfight_enabled,
-        "stats": chatfight_stats.copy()
+        "enabled": shard.enabled,
+        "stats": shard.stats.copy()
     }
 
-def get_chatfight_stats_text() -> str:
-    """Genera un texto con las estadísticas"""
-    stats = chatfight_stats
+def get_shards_summary_text() -> str:
+    """Una línea por grupo atendido: estado, cuenta y respuestas"""
+    if not shards:
+        return "• (ningún grupo configurado)"
+    lines = []
+    for s in shards.values():
+        emoji = "✅" if s.enabled else "❌"
+        lines.append(f"• {emoji} `{s.group_id}` ({s.account}): {s.stats['total_responses']} respuestas, "
+                     f"{s.stats['errors']} errores, {s.budget.rejected} limitadas")
+    return "\n".join(lines)
+
+def get_chatfight_stats_text(group_id: Optional[int] = None) -> str:
+    """Genera un texto con las estadísticas del grupo indicado (o el resumen de todos)"""
+    shard = shards.get(group_id) if group_id is not None else None
+    if shard is None:
+        return f"""🤖 **ChatFight Auto-Responder**
+
+👥 **Grupos:**
+{get_shards_summary_text()}
+
+🛡 Peticiones de respaldo (hedging): {_chatfight_processor.hedges if _chatfight_processor else 0}
+🧮 Operaciones resueltas en local: {_local_solver.solved if _local_solver else 0}
+
+🗂 **Caché de respuestas:**
+{answer_cache.stats_text()}
+
+🎯 **Resultados:**
+{outcome_tracker.text()}
+
+🧭 **Router (modelo · prompt · imagen):**
+{router.text()}
+
+🚦 **Planificador de inferencia:**
+{_chatfight_processor.scheduler.text() if _chatfight_processor else "• Sin inicializar"}
+
+🔥 **Calentamiento:**
+{get_warmup_text()}
+
+🗄 **MongoDB:**
+{get_database_text()}
+• Historial: {history_writer.inserted} rondas guardadas, {history_writer.pending} pendientes, {history_writer.dropped} descartadas
+
+🔄 **Event loop:**
+{loop_monitor.text()}
+• Rondas en proceso: {len(_chatfight_tasks)}
+
+⏱ **Latencias por etapa:**
+{metrics.summary_text()}"""
     
-    status_emoji = "✅" if chatfight_enabled else "❌"
-    status_text = "ACTIVADO" if chatfight_enabled else "DESACTIVADO"
+    stats = shard.stats
+    status_text = "ACTIVADO" if shard.enabled else "DESACTIVADO"
     
     last_resp = stats.get('last_response') or 'Nunca'
+    game_lines = "\n".join(f"• {game.label}: {stats.get(f'{game.name}_responses', 0)}"
+                           for game in GAME_TYPES.values())
     
     text = f"""🤖 **ChatFight Auto-Responder**
 
-✅ Estado: **{status_text}**
+✅ Estado: **{status_text}** (grupo `{shard.group_id}`, cuenta {shard.account})
 
 📊 **Estadísticas:**
 • Total de respuestas: {stats['total_responses']}
-• Palabras encontradas: {stats['palabra_responses']}
-• Operaciones calculadas: {stats['operacion_responses']}
+{game_lines}
 • Errores: {stats['errors']}
+• Rondas completadas / canceladas: {stats.get('rounds_completed', 0)} / {stats.get('rounds_cancelled', 0)}
+• Ganadas / perdidas / erróneas: {stats.get('won', 0)} / {stats.get('lost', 0)} / {stats.get('wrong', 0)}
+• Limitadas por presupuesto: {shard.budget.rejected}
+
+🛡 Peticiones de respaldo (hedging): {_chatfight_processor.hedges if _chatfight_processor else 0}
+🧮 Operaciones resueltas en local: {_local_solver.solved if _local_solver else 0}
+
+🗂 **Caché de respuestas:**
+{answer_cache.stats_text()}
+
+📥 **Descargas:**
+{download_stats.text()}
+
+🖼 **Preprocesado de imágenes:**
+{preprocess_stats.text()}
+
+🔥 **Calentamiento:**
+{get_warmup_text()}
+
+🔄 **Event loop:**
+{loop_monitor.text()}
+
+⏱ **Latencias por etapa:**
+{metrics.summary_text()}
 
 🕐 Última respuesta: {last_resp}"""
     return text
@@ -414,132 +3399,599 @@ def get_chatfight_stats_text() -> str:
 # =============================================================================
 
 _chatfight_processor = None
+_local_solver: Optional[LocalArithmeticSolver] = None
+_solver_warmup: Optional[asyncio.Task] = None
 
-def init_chatfight_module(api_key: str):
+# Tareas de procesamiento en curso (se guarda la referencia para que no se recolecten)
+_chatfight_tasks: Set[asyncio.Task] = set()
+
+def init_chatfight_module(api_key: str, api_keys: Optional[List[str]] = None):
     """
     Inicializa el módulo ChatFight
     Returns: processor instance
     """
-    global _chatfight_processor
+    global _chatfight_processor, _local_solver, _solver_warmup
     
     log.info(f"[ChatFight] Inicializando módulo ChatFight...")
     log.info(f"[ChatFight] API Key proporcionada: {'Sí' if api_key else 'No'}")
-    log.info(f"[ChatFight] CHATFIGHT_BOT_ID: {CHATFIGHT_BOT_ID}")
-    log.info(f"[ChatFight] CHATFIGHT_GROUP_ID: {CHATFIGHT_GROUP_ID}")
-    
-    # Inicializar MongoDB
-    init_chatfight_db()
+    log.info(f"[ChatFight] CHATFIGHT_BOT_ID: {settings.bot_id}")
+    log.info(f"[ChatFight] Grupos: {', '.join(f'{s.group_id} ({s.account})' for s in shards.values())}")
     
     if not api_key:
         log.warning("[ChatFight] Advertencia: No se proporcionó clave API Groq")
         return None
     
-    _chatfight_processor = ChatFightProcessor(api_key)
-    log.info(f"[ChatFight] Módulo inicializado (Estado: {'Activado' if chatfight_enabled else 'Desactivado'})")
+    _chatfight_processor = ChatFightProcessor(api_key, api_keys=api_keys)
+    runtime_settings.apply_all()
+    _local_solver = LocalArithmeticSolver()
+    _solver_warmup = asyncio.create_task(_local_solver.warm_up())
+    log.info(f"[ChatFight] Solver local de operaciones: {'Sí' if _local_solver.available else 'No'}")
+    log.info(f"[ChatFight] Módulo inicializado (Activado en {sum(s.enabled for s in shards.values())}/{len(shards)} grupos, "
+             f"estado persistido {'cargado' if mongo_ready.is_set() else 'pendiente'})")
     log.info(f"[ChatFight] Processor creado: {'Sí' if _chatfight_processor else 'No'}")
     return _chatfight_processor
 
+async def connect_database(uri: str, timeout: float = settings.mongo_timeout, retry_max: float = settings.mongo_retry_max):
+    """
+    Conecta con MongoDB en segundo plano con reintentos y backoff exponencial. Al conectar
+    combina el estado persistido de cada grupo con el acumulado en memoria (la activación
+    guardada sustituye a CHATFIGHT_START_ENABLED salvo que haya un -cft posterior), habilita la
+    persistencia y precarga la caché. El bot responde mientras tanto con el estado en memoria,
+    sin esperar a la base de datos.
+    """
+    if not uri:
+        mongo_status.update(state="desactivado")
+        log.warning("[ChatFight] MONGO_URI no configurado. Continuando sin persistencia.")
+        return
+    delay = 1.0
+    while True:
+        mongo_status["attempts"] += 1
+        started = time.perf_counter()
+        try:
+            await asyncio.to_thread(init_chatfight_db, uri, timeout)
+            persisted = {}
+            for shard in shards.values():
+                persisted[shard.group_id] = await asyncio.to_thread(
+                    load_chatfight_db, shard.group_id, shard.group_id == settings.group_id)
+            router_doc = await asyncio.to_thread(get_chatfight_collection().find_one, {"type": "chatfight_router"})
+            settings_doc = await asyncio.to_thread(get_chatfight_collection().find_one, {"type": "chatfight_settings"})
+            break
+        except Exception as e:
+            mongo_status.update(state="sin conexión", error=str(e)[:120])
+            log.warning(f"[ChatFight] MongoDB no disponible (intento {mongo_status['attempts']}), "
+                        f"reintento en {delay:.0f}s: {e}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, retry_max)
+    
+    for shard in shards.values():
+        shard.reconcile(persisted[shard.group_id])
+    runtime_settings.reconcile(settings_doc)
+    router.reconcile(router_doc)
+    mongo_status.update(state="conectado", error=None)
+    mongo_ready.set()
+    log.info(f"[ChatFight] Estado persistido cargado en {time.perf_counter() - started:.2f}s "
+             f"(activado en {sum(s.enabled for s in shards.values())}/{len(shards)} grupos)")
+    await answer_cache.warm_load()
+
+def get_database_text() -> str:
+    """Estado de la conexión con MongoDB"""
+    line = f"• {mongo_status['state']} (intentos: {mongo_status['attempts']})"
+    if mongo_status["error"]:
+        line += f"\n• Último error: {mongo_status['error']}"
+    return line
+
+async def prime_media_session(client: Client, group_ids: List[int], history_limit: int = 50):
+    """
+    Descarga la miniatura más pequeña de la última foto de los grupos para que Pyrogram
+    abra la sesión con el DC de medios antes del primer juego. Returns: la media descargada
+    """
+    for group_id in group_ids:
+        async for message in client.get_chat_history(group_id, limit=history_limit):
+            if message.photo is None:
+                continue
+            thumbs = [t for t in (message.photo.thumbs or []) if t.file_id]
+            media = min(thumbs, key=lambda t: t.file_size or 0).file_id if thumbs else message.photo
+            await client.download_media(media, in_memory=True)
+            return media
+    raise LookupError("no hay fotos recientes en los grupos")
+
+class MediaKeepAlive:
+    """
+    Mantiene abierta la sesión con el DC de medios de cada cuenta: si en `interval` segundos no
+    se ha descargado nada, vuelve a bajar la miniatura del calentamiento (o busca otra si caducó).
+    """
+    
+    def __init__(self, interval: float = settings.keepalive_interval):
+        self.interval = interval
+        # Cliente -> (grupos de la cuenta, media del calentamiento)
+        self.targets: Dict[Client, Tuple[List[int], object]] = {}
+        self.last_activity: Dict[Client, float] = {}
+        self.pings = 0
+        self._task: Optional[asyncio.Task] = None
+    
+    def remember(self, client: Client, group_ids: List[int], media):
+        self.targets[client] = (group_ids, media)
+        self.touch(client)
+    
+    def touch(self, client: Client):
+        """Anota una descarga de la cuenta (la sesión de medios sigue viva)"""
+        self.last_activity[client] = time.monotonic()
+    
+    def start(self):
+        if self.interval > 0 and self.targets and self._task is None:
+            self._task = asyncio.create_task(self._run())
+    
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            for client, (group_ids, media) in list(self.targets.items()):
+                if time.monotonic() - self.last_activity.get(client, 0.0) < self.interval:
+                    continue
+                try:
+                    try:
+                        await client.download_media(media, in_memory=True)
+                    except Exception:
+                        # La referencia del fichero puede caducar: otra foto reciente sirve igual
+                        self.targets[client] = (group_ids, await prime_media_session(client, group_ids))
+                    self.pings += 1
+                except Exception as e:
+                    log.warning(f"[ChatFight] Keep-alive de medios fallido: {e}")
+                self.touch(client)
+    
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+media_keepalive = MediaKeepAlive()
+
+async def warm_up_connections():
+    """
+    Calienta las conexiones en paralelo: HTTP con Groq y la sesión de medios de cada cuenta
+    de Telegram (las dos con keep-alive posterior) y los peers a los que se responde.
+    """
+    steps = []
+    if _chatfight_processor is not None:
+        steps.append(_chatfight_processor.warm_up())
+    for account, client in accounts.items():
+        group_ids = [s.group_id for s in shards.values() if s.account == account]
+        if group_ids:
+            async def _prime(client=client, account=account, group_ids=group_ids):
+                async with warmup_step(f"media {account}"):
+                    media_keepalive.remember(client, group_ids, await prime_media_session(client, group_ids))
+            async def _peers(client=client, account=account, group_ids=group_ids):
+                async with warmup_step(f"peers {account}"):
+                    await answer_sender.prime(client, group_ids)
+            steps.extend((_prime(), _peers()))
+    await asyncio.gather(*steps)
+    if _chatfight_processor is not None:
+        _chatfight_processor.start_keepalive()
+    media_keepalive.start()
+
+def get_warmup_text() -> str:
+    """Una línea por paso de calentamiento"""
+    if not warmup_status:
+        return "• Sin calentar"
+    lines = [f"• {name}: {status}" for name, status in warmup_status.items()]
+    if media_keepalive.pings:
+        lines.append(f"• Keep-alive de medios: {media_keepalive.pings} descargas")
+    return "\n".join(lines)
+
+# =============================================================================
+# CHATFIGHT RUNTIME SETTINGS
+# =============================================================================
+
+class Tunable:
+    """Parámetro ajustable en caliente con -cfset: tipo, validación, valor por defecto y cómo aplicarlo"""
+    
+    def __init__(self, name: str, kind: type, default, getter: Optional[Callable[[], object]],
+                 setter: Optional[Callable[[object], None]], description: str,
+                 minimum: Optional[float] = None, maximum: Optional[float] = None,
+                 choices: Optional[Tuple[str, ...]] = None,
+                 check: Optional[Callable[[object], Awaitable[None]]] = None):
+        self.name = name
+        self.kind = kind
+        self.default = default
+        if getter is None:
+            # Sin objeto al que aplicarlo: el propio parámetro guarda el valor vigente
+            self.value = default
+            getter, setter = (lambda: self.value), (lambda value: setattr(self, "value", value))
+        self.getter = getter
+        self.setter = setter
+        self.description = description
+        self.minimum = minimum
+        self.maximum = maximum
+        self.choices = choices
+        # Comprobación asíncrona adicional antes de aceptar un valor (lanza ConfigError)
+        self.check = check
+    
+    def parse(self, text: str):
+        """Convierte y valida el valor. Lanza ConfigError con el motivo"""
+        text = str(text).strip()
+        if self.kind is bool:
+            if text.lower() in ("1", "true", "on", "si", "sí"):
+                return True
+            if text.lower() in ("0", "false", "off", "no"):
+                return False
+            raise ConfigError(f"{self.name} debe ser on/off")
+        if self.kind is str:
+            if not text:
+                raise ConfigError(f"{self.name} no puede estar vacío")
+            if self.choices is not None and text not in self.choices:
+                raise ConfigError(f"{self.name} debe ser uno de: {', '.join(self.choices)}")
+            return text
+        try:
+            value = self.kind(text)
+        except ValueError:
+            raise ConfigError(f"{self.name} debe ser un número{' entero' if self.kind is int else ''}")
+        if (self.minimum is not None and value < self.minimum) or (self.maximum is not None and value > self.maximum):
+            raise ConfigError(f"{self.name} debe estar entre {self.minimum} y {self.maximum}")
+        return value
+    
+    def format(self, value) -> str:
+        if self.kind is bool:
+            return "on" if value else "off"
+        if self.kind is str and len(str(value)) > 60:
+            return f"{str(value)[:57]}..."
+        return str(value)
+
+class RuntimeSettings:
+    """
+    Parámetros de inferencia y del pipeline ajustables sin reiniciar (-cfset). Los cambios se
+    aplican al momento y se persisten en el documento {"type": "chatfight_settings"}; al conectar
+    MongoDB se restauran los guardados (salvo los cambiados antes de conectar). Guarda también la
+    imagen de referencia de la sonda -cfprobe.
+    """
+    
+    def __init__(self):
+        self.tunables: Dict[str, Tunable] = {}
+        self.overrides: Dict[str, object] = {}
+        self.probe: Optional[dict] = None
+        self.writer = StatsWriter({"type": "chatfight_settings"})
+        self.loaded = False
+    
+    def register(self, tunable: Tunable) -> Tunable:
+        self.tunables[tunable.name] = tunable
+        return tunable
+    
+    def value(self, name: str):
+        """Valor vigente de un parámetro (el de la configuración si no se ha cambiado)"""
+        return self.get(name).getter()
+    
+    def get(self, name: str) -> Tunable:
+        tunable = self.tunables.get(name)
+        if tunable is None:
+            raise ConfigError(f"parámetro desconocido: {name}")
+        return tunable
+    
+    async def set(self, name: str, text: str):
+        """Valida, aplica y persiste un valor ("default" vuelve al valor de arranque). Returns: valor aplicado"""
+        tunable = self.get(name)
+        if text.strip().lower() == "default":
+            tunable.setter(tunable.default)
+            self.overrides.pop(name, None)
+            self.writer.set(f"values.{name}", None)
+            return tunable.default
+        value = tunable.parse(text)
+        if tunable.check is not None:
+            await tunable.check(value)
+        tunable.setter(value)
+        self.overrides[name] = value
+        self.writer.set(f"values.{name}", value)
+        log.info(f"[ChatFight] Ajuste {name} = {tunable.format(value)}")
+        return value
+    
+    def apply_all(self):
+        """Vuelve a aplicar los valores cambiados (p. ej. al crear el procesador)"""
+        for name, value in self.overrides.items():
+            self.tunables[name].setter(value)
+    
+    def reconcile(self, doc: Optional[dict]):
+        """Restaura los valores guardados; los cambiados antes de conectar prevalecen"""
+        if self.loaded:
+            return
+        self.loaded = True
+        doc = doc or {}
+        for name, value in (doc.get("values") or {}).items():
+            if value is None or name not in self.tunables or self.writer.has_pending(f"values.{name}"):
+                continue
+            try:
+                tunable = self.tunables[name]
+                value = tunable.parse(value)
+                tunable.setter(value)
+                self.overrides[name] = value
+            except ConfigError as e:
+                log.warning(f"[ChatFight] Ajuste guardado no válido, se ignora: {e}")
+        if self.probe is None:
+            self.probe = doc.get("probe")
+    
+    def remember_probe(self, message, tipo: str, answer: Optional[str] = None):
+        """Guarda como referencia de la sonda la imagen de un juego (la versión que se descarga primero)"""
+        if message.photo:
+            media, mime_type = message.photo, "image/jpeg"
+        elif message.document and (message.document.mime_type or "").startswith("image/"):
+            media, mime_type = message.document, message.document.mime_type
+        else:
+            return False
+        rendition, label, rendition_mime = select_renditions(media, mime_type)[0]
+        file_id = rendition if isinstance(rendition, str) else rendition.file_id
+        if self.probe is not None and self.probe.get("file_id") == file_id:
+            return True
+        self.probe = {"file_id": file_id, "mime_type": rendition_mime, "rendition": label,
+                      "tipo": tipo, "answer": answer}
+        self.writer.set("probe", self.probe)
+        return True
+    
+    def text(self) -> str:
+        """Valores actuales para -cfset (* = cambiado en caliente)"""
+        lines = []
+        for name, tunable in self.tunables.items():
+            mark = " *" if name in self.overrides else ""
+            lines.append(f"• `{name}` = {tunable.format(tunable.getter())}{mark}")
+        return "\n".join(lines)
+
+runtime_settings = RuntimeSettings()
+
+def _processor_attr(attr: str, default):
+    """Getter y setter de un atributo del procesador (si aún no existe se aplica al crearlo)"""
+    def getter():
+        return getattr(_chatfight_processor, attr, default)
+    def setter(value):
+        if _chatfight_processor is not None:
+            setattr(_chatfight_processor, attr, value)
+    return getter, setter
+
+async def _check_model(model: str):
+    """Acepta los modelos configurados y los que Groq sirve con las claves del principal"""
+    known = {settings.groq_model, settings.groq_backup_model, *settings.router_models, *router.models}
+    if model in known:
+        return
+    if _chatfight_processor is None:
+        raise ConfigError(f"{model} no está configurado y no se puede consultar Groq sin processor")
+    try:
+        available = await _chatfight_processor.list_models()
+    except Exception as e:
+        raise ConfigError(f"no se pudo consultar la lista de modelos de Groq: {e}")
+    if model not in available:
+        raise ConfigError(f"Groq no sirve el modelo {model}")
+
+def _set_model(model: str):
+    if _chatfight_processor is not None:
+        _chatfight_processor.set_model(model)
+    router.models[0] = model
+    router.reset_arms()
+
+def _set_concurrency(capacity: int):
+    if _chatfight_processor is not None:
+        _chatfight_processor.scheduler.set_capacity(capacity)
+
+def _set_image_profile(field: str):
+    def setter(value):
+        global image_profile
+        if image_profile is None:
+            raise ConfigError("el preprocesado de imágenes está desactivado (IMAGE_PREPROCESS o Pillow)")
+        options = {"crop": image_profile.crop, "max_side": image_profile.max_side,
+                   "mode": image_profile.mode, "quality": image_profile.quality}
+        options[field] = value
+        image_profile = ImageProfile(**options)
+        router.reset_arms()
+    return setter
+
+def _set_router_enabled(value: bool):
+    router.enabled = value
+    router.reset_arms()
+
+def register_tunables(settings: Settings):
+    """Registra los parámetros ajustables con -cfset; el valor por defecto es el de la configuración"""
+    register = runtime_settings.register
+    register(Tunable("groq_model", str, settings.groq_model, lambda: router.models[0], _set_model,
+                     "Modelo principal", check=_check_model))
+    register(Tunable("groq_max_tokens", int, settings.groq_max_tokens, *_processor_attr("max_tokens", settings.groq_max_tokens),
+                     "Tokens máximos por respuesta", 1, 1024))
+    register(Tunable("groq_timeout", float, settings.groq_timeout, *_processor_attr("timeout", settings.groq_timeout),
+                     "Plazo por análisis (s)", 1, 300))
+    register(Tunable("groq_streaming", bool, settings.groq_streaming, *_processor_attr("streaming", settings.groq_streaming),
+                     "Streaming con corte anticipado"))
+    register(Tunable("hedge_delay", float, settings.hedge_delay, *_processor_attr("hedge_delay", settings.hedge_delay),
+                     "Espera antes de la petición de respaldo (s)", 0, 60))
+    register(Tunable("groq_max_concurrency", int, settings.groq_max_concurrency,
+                     lambda: _chatfight_processor.scheduler.capacity if _chatfight_processor else settings.groq_max_concurrency,
+                     _set_concurrency, "Inferencias simultáneas", 1, 64))
+    for game in GAME_TYPES.values():
+        base = game.prompts[0]
+        register(Tunable(f"temperature_{game.name}", float, base.temperature,
+                         lambda base=base: base.temperature,
+                         lambda value, base=base: setattr(base, "temperature", value),
+                         f"Temperatura del prompt base ({game.label})", 0, 2))
+        register(Tunable(f"prompt_{game.name}", str, base.text,
+                         lambda base=base: base.text,
+                         lambda value, base=base: setattr(base, "text", value),
+                         f"Prompt base ({game.label})"))
+    register(Tunable("photo_min_side", int, settings.photo_min_side, None, None,
+                     "Lado mínimo de la miniatura descargada (0 = original)", 0, 4096))
+    register(Tunable("phash_max_distance", int, settings.phash_max_distance,
+                     lambda: answer_cache.tiers["phash"].max_distance,
+                     lambda value: setattr(answer_cache.tiers["phash"], "max_distance", value),
+                     "Distancia de Hamming máxima del hash perceptual", 0, 256))
+    register(Tunable("router_enabled", bool, settings.router_enabled, lambda: router.enabled, _set_router_enabled,
+                     "Router adaptativo"))
+    register(Tunable("router_latency_budget", float, settings.router_latency_budget, lambda: router.latency_budget,
+                     lambda value: setattr(router, "latency_budget", value),
+                     "Latencia a partir de la cual se penaliza una combinación (s)", 0, 60))
+    register(Tunable("image_mode", str, settings.image_mode, lambda: image_profile.mode if image_profile else "—",
+                     _set_image_profile("mode"), "Modo de color de la imagen", choices=ImageProfile.MODES))
+    register(Tunable("image_max_side", int, settings.image_max_side, lambda: image_profile.max_side if image_profile else "—",
+                     _set_image_profile("max_side"), "Lado máximo de la imagen (0 = sin reducir)", 0, 4096))
+    register(Tunable("image_quality", int, settings.image_quality, lambda: image_profile.quality if image_profile else "—",
+                     _set_image_profile("quality"), "Calidad JPEG", 1, 100))
+
+register_tunables(settings)
+
+async def run_probe(client: Client, message) -> str:
+    """
+    Sonda de extremo a extremo con la imagen de referencia: descarga, preprocesado e inferencia
+    (sin caché, con el modelo principal y el prompt base) y respuesta por la vía rápida al
+    mensaje del comando. Returns: informe con el tiempo de cada etapa
+    """
+    probe = runtime_settings.probe
+    if probe is None:
+        return "🔬 Sin imagen de referencia: responde a una foto con `-cfprobe [tipo]` o espera a la próxima ronda"
+    if _chatfight_processor is None:
+        return "🔬 Processor no inicializado"
+    tipo = probe["tipo"]
+    trace = {"stages": {}}
+    # El comando corre en la tarea del handler: la traza no debe quedarse en su contexto
+    token = round_trace.set(trace)
+    stages: Dict[str, float] = {}
+    stage = "download"
+    started = time.perf_counter()
+    try:
+        mark = time.perf_counter()
+        buffer = await client.download_media(probe["file_id"], in_memory=True)
+        stages["download"] = time.perf_counter() - mark
+        image = buffer.getbuffer()
+        payload, payload_mime = image, probe["mime_type"]
+        if image_profile is not None:
+            stage = "preprocess"
+            mark = time.perf_counter()
+            payload, payload_mime = await asyncio.to_thread(preprocess_image, image, payload_mime, image_profile)
+            stages["preprocess"] = time.perf_counter() - mark
+        stage = "inference"
+        mark = time.perf_counter()
+        answer = await _chatfight_processor.analyze_image(payload, tipo, payload_mime)
+        stages["inference"] = time.perf_counter() - mark
+        stage = "reply"
+        mark = time.perf_counter()
+        sent_id = await answer_sender.send(client, message, answer)
+        stages["reply"] = time.perf_counter() - mark
+    except Exception as e:
+        return f"🔬 Sonda fallida en `{stage}`: {type(e).__name__}: {str(e)[:200]}"
+    finally:
+        round_trace.reset(token)
+    total = time.perf_counter() - started
+    if sent_id is not None:
+        delete_message_later(client, message.chat.id, sent_id, 30)
+    
+    lines = [f"🔬 **Sonda** ({tipo}, {probe['rendition']}, {image.nbytes} bytes, {_chatfight_processor.model})"]
+    for name, seconds in stages.items():
+        lines.append(f"• {name}: {seconds * 1000:.0f} ms")
+        if name == "inference":
+            # Desglose interno de la inferencia (cola, primer token, codificación)
+            for detail in ("encode", "inference_queue", "inference_first_token"):
+                if detail in trace["stages"]:
+                    lines.append(f"  ◦ {detail}: {trace['stages'][detail] * 1000:.0f} ms")
+    lines.append(f"• total: {total * 1000:.0f} ms")
+    expected = probe.get("answer")
+    check = "" if expected is None else (" ✅" if answer.lower() == expected.lower() else f" ❌ (esperada {expected})")
+    lines.append(f"• respuesta: `{answer}`{check}")
+    return "\n".join(lines)
+
 # =============================================================================
 # TELEGRAM CLIENT CREATION
 # =============================================================================
 
-# Crear el cliente Pyrogram a nivel de módulo para que esté disponible para los handlers
-if SESSION_STRING:
-    app = Client(
-        "chatfight_bot",
-        api_id=API_ID,
-        api_hash=API_HASH,
-        session_string=SESSION_STRING
-    )
-else:
-    app = Client(
-        "chatfight_bot",
-        api_id=API_ID,
-        api_hash=API_HASH
-    )
+def create_client(settings: Settings, account: str) -> Client:
+    """
+    Crea el cliente Pyrogram de una cuenta.
+    La principal usa SESSION_STRING; las demás SESSION_STRING_<CUENTA>.
+    """
+    name = "chatfight_bot" if account == MAIN_ACCOUNT else f"chatfight_bot_{account}"
+    session_string = settings.session_strings.get(account)
+    if session_string:
+        return Client(name, api_id=settings.api_id, api_hash=settings.api_hash, session_string=session_string)
+    return Client(name, api_id=settings.api_id, api_hash=settings.api_hash)
+
+# Crear los clientes Pyrogram a nivel de módulo para que estén disponibles para los handlers.
+# La cuenta principal siempre existe (está en session_strings): recibe los comandos de control
+accounts: Dict[str, Client] = {account: create_client(settings, account) for account in settings.session_strings}
+app = accounts[MAIN_ACCOUNT]
 
 # =============================================================================
 # TELEGRAM HANDLERS
 # =============================================================================
 
-@app.on_message(filters.chat(CHATFIGHT_GROUP_ID))
 async def chatfight_handler(app: Client, message: Message):
-    """Procesa mensajes del bot ChatFight"""
-    global chatfight_enabled, _chatfight_processor
-    
-    log.info(f"[ChatFight] Mensaje recibido en grupo {message.chat.id} (enabled={chatfight_enabled})")
+    """
+    Procesa mensajes del bot ChatFight.
+    Solo recibe mensajes que ya pasaron chatfight_game_filter (bot, imagen y caption de juego).
+    """
+    received_at = getattr(message, "chatfight_received_at", None) or time.perf_counter()
+    shard = get_shard(message.chat.id)
     
-    # Verificar si está activado
-    if not chatfight_enabled:
-        log.warning("[ChatFight] Módulo desactivado, ignorando mensaje")
+    # Verificar si está activado en este grupo
+    if shard is None or not shard.enabled:
+        log.debug("[ChatFight] Grupo %s desactivado, ignorando mensaje", message.chat.id)
         return
     
     if _chatfight_processor is None:
         log.warning("[ChatFight] Processor no inicializado")
         return
     
-    log.info(f"[ChatFight] Processor disponible")
-    
-    # Verificar que sea del bot ChatFight
-    if not message.from_user:
-        log.warning("[ChatFight] Mensaje sin usuario")
-        return
-    
-    log.info(f"[ChatFight] Usuario: {message.from_user.id} (esperado: {CHATFIGHT_BOT_ID})")
-    
-    if message.from_user.id != CHATFIGHT_BOT_ID:
-        log.warning(f"[ChatFight] Usuario no es ChatFight bot")
-        return
-    
-    # Verificar caption para detectar juegos
-    caption = message.caption or message.text or ""
-    
-    # Si es un documento, también verificar file_name
-    if message.document:
-        doc_name = message.document.file_name or ""
-        caption = caption + " " + doc_name
-    
-    # Debug: Mostrar todos los campos relevantes del mensaje
-    log.info(f"[ChatFight] --- DEBUG MESSAGE ---")
-    log.info(f"[ChatFight] message_id: {message.id}")
-    log.info(f"[ChatFight] caption: '{message.caption}'")
-    log.info(f"[ChatFight] text: '{message.text}'")
-    if message.entities:
-        log.info(f"[ChatFight] entities: {[e.type for e in message.entities]}")
-    if message.document:
-        log.info(f"[ChatFight] doc.file_name: '{message.document.file_name}'")
-        log.info(f"[ChatFight] doc.mime_type: '{message.document.mime_type}'")
-    log.info(f"[ChatFight] photo: {message.photo is not None}")
-    log.info(f"[ChatFight] --- END DEBUG ---")
-    
-    log.info(f"[ChatFight] Caption completo: {caption[:200]}...")
-    
-    # Buscar patrones en caption o text
-    caption_lower = caption.lower()
-    has_resultado = "resultado del cálculo" in caption_lower or "tabla de clasificación" in caption_lower
-    has_palabra = "escribir la palabra" in caption_lower or "escalar en la clasificación" in caption_lower
-    
-    log.info(f"[ChatFight] has_resultado={has_resultado}, has_palabra={has_palabra}")
-    
-    if not (has_resultado or has_palabra):
-        log.warning(f"[ChatFight] Caption no coincide con juego (caption: '{caption[:100]}')")
+    # Respetar el presupuesto de respuestas del grupo
+    if not shard.budget.try_acquire():
+        log.warning("[ChatFight] Presupuesto de respuestas agotado en %s, ignorando", message.chat.id)
         return
     
-    # Verificar que tenga media
-    has_photo = message.photo is not None
-    has_doc = message.document is not None and message.document.mime_type.startswith('image/')
-    log.info(f"[ChatFight] Photo: {has_photo}, Document: {has_doc}")
-    
-    if not has_photo and not has_doc:
-        log.warning("[ChatFight] No tiene media")
+    tipo = getattr(message, "chatfight_tipo", None)
+    log.debug("[ChatFight] Juego detectado: mensaje %s, tipo %s", message.id, tipo)
+    task = asyncio.create_task(
+        process_chatfight_message(app, message, _chatfight_processor, received_at, tipo=tipo)
+    )
+    _chatfight_tasks.add(task)
+    task.add_done_callback(_chatfight_tasks.discard)
+    round_tracker.open(shard, message.id, task)
+
+async def round_signal_handler(app: Client, message: Message):
+    """Mensajes del bot ChatFight que no son juegos: ganador o cierre de ronda"""
+    if classify_game(message) is not None:
         return
-    
-    log.info(f"[ChatFight] Mensaje detectado: {message.id}, procesando...")
-    asyncio.create_task(process_chatfight_message(app, message, _chatfight_processor))
+    round_tracker.on_bot_message(message, app.me)
+    # Por la cola de postprocesado: así llega después del registro de nuestra respuesta
+    post_processor.submit(outcome_tracker.on_bot_message, message, app.me)
+
+# Cada cuenta escucha solo los grupos que tiene asignados
+for _account, _client in accounts.items():
+    _groups = [s.group_id for s in shards.values() if s.account == _account]
+    if _groups:
+        _client.add_handler(MessageHandler(chatfight_handler, filters.chat(_groups) & chatfight_game_filter))
+        # En otro grupo de handlers para que también vea los mensajes que no son juegos
+        _client.add_handler(
+            MessageHandler(round_signal_handler, filters.chat(_groups) & filters.user(settings.bot_id)),
+            group=1,
+        )
 
 
 # Commands: -cf (status), -cft (toggle), -ping
 
+# Borrados diferidos de las respuestas a comandos (se guarda la referencia hasta que terminen)
+_cleanup_tasks: Set[asyncio.Task] = set()
+
+async def _delete_after(message: Message, delay: float):
+    await asyncio.sleep(delay)
+    try:
+        await message.delete()
+    except Exception as e:
+        log.debug(f"[ChatFight] No se pudo borrar el mensaje {message.id}: {e}")
+
+def delete_later(message: Message, delay: float):
+    """Borra el mensaje pasados `delay` segundos sin retener al handler"""
+    task = asyncio.create_task(_delete_after(message, delay))
+    _cleanup_tasks.add(task)
+    task.add_done_callback(_cleanup_tasks.discard)
+
+async def _delete_id_after(client: Client, chat_id: int, message_id: int, delay: float):
+    await asyncio.sleep(delay)
+    try:
+        await client.delete_messages(chat_id, message_id)
+    except Exception as e:
+        log.debug(f"[ChatFight] No se pudo borrar el mensaje {message_id}: {e}")
+
+def delete_message_later(client: Client, chat_id: int, message_id: int, delay: float):
+    """Como delete_later para los mensajes enviados en crudo (solo se conoce su id)"""
+    task = asyncio.create_task(_delete_id_after(client, chat_id, message_id, delay))
+    _cleanup_tasks.add(task)
+    task.add_done_callback(_cleanup_tasks.discard)
+
 @app.on_message(filters.command("ping", prefixes=["-"]))
 async def ping_me(_, message: Message):
     await message.delete()
@@ -547,8 +3999,7 @@ async def ping_me(_, message: Message):
     m = await message.reply_text("pong…")
     dt = (time.time() - start) * 1000
     msg = await m.edit_text(f"pong {dt:.0f} ms")
-    await asyncio.sleep(3)
-    await msg.delete()
+    delete_later(msg, 3)
 
 
 @app.on_message(filters.command("help", prefixes=["."]))
@@ -559,33 +4010,107 @@ async def help_cmd(_, message: Message):
 
 🟢 **Comandos:**
 • `-cf` - Ver estado y estadísticas
-• `-cft` - Activar/Desactivar
+• `-cft [group_id]` - Activar/Desactivar (grupo actual, el indicado o todos)
+• `-cfh [días]` - Victorias y latencias por tipo, modelo y hora
+• `-cfset [clave [valor]]` - Ver o cambiar un ajuste en caliente
+• `-cfprobe [tipo]` - Sonda de latencia de extremo a extremo
 • `-ping` - Verificar bot online"""
     msg = await message.reply_text(help_text, parse_mode=ParseMode.MARKDOWN)
-    await asyncio.sleep(30)
-    await msg.delete()
+    delete_later(msg, 30)
 
 
 # ChatFight control commands
-@app.on_message(filters.command("cf", prefixes=["-"]))
+@app.on_message(filters.command("cf", prefixes=["-"]) & filters.me)
 async def chatfight_status(_, message: Message):
     """Muestra el estado del módulo ChatFight"""
     await message.delete()
-    status_text = get_chatfight_stats_text()
+    status_text = get_chatfight_stats_text(message.chat.id)
     msg = await message.reply_text(status_text, parse_mode=ParseMode.MARKDOWN)
-    await asyncio.sleep(30)
-    await msg.delete()
+    delete_later(msg, 30)
 
 
-@app.on_message(filters.command("cft", prefixes=["-"]))
+@app.on_message(filters.command("cft", prefixes=["-"]) & filters.me)
 async def chatfight_toggle_cmd(_, message: Message):
-    """Activa o desactiva el módulo ChatFight"""
+    """Activa o desactiva ChatFight en el grupo actual, en el indicado o en todos"""
     await message.delete()
-    new_state = chatfight_toggle()
+    group_id = message.chat.id
+    if len(message.command) > 1:
+        try:
+            group_id = int(message.command[1])
+        except ValueError:
+            pass
+    new_state = chatfight_toggle(group_id)
     state_text = "✅ Activado" if new_state else "❌ Desactivado"
-    msg = await message.reply_text(f"ChatFight {state_text}")
-    await asyncio.sleep(5)
-    await msg.delete()
+    scope = f"en {group_id}" if group_id in shards else "en todos los grupos"
+    msg = await message.reply_text(f"ChatFight {state_text} {scope}")
+    delete_later(msg, 5)
+
+@app.on_message(filters.command("cfh", prefixes=["-"]) & filters.me)
+async def chatfight_history_cmd(_, message: Message):
+    """Informe del historial de rondas (grupo actual o todos) de los últimos N días"""
+    await message.delete()
+    days = 7.0
+    if len(message.command) > 1:
+        try:
+            days = float(message.command[1])
+        except ValueError:
+            pass
+    group_id = message.chat.id if message.chat.id in shards else None
+    if not mongo_ready.is_set():
+        text = "🗄 El historial no está disponible: MongoDB no está conectado"
+    else:
+        try:
+            results = await asyncio.to_thread(query_history, group_id, days)
+            text = format_history_report(results, days, group_id)
+        except PyMongoError as e:
+            text = f"❌ Error consultando el historial: {e}"
+    msg = await message.reply_text(text, parse_mode=ParseMode.MARKDOWN)
+    delete_later(msg, 30)
+
+@app.on_message(filters.command("cfset", prefixes=["-"]) & filters.me)
+async def chatfight_set_cmd(_, message: Message):
+    """Lista los ajustes en caliente, muestra uno o lo cambia (el valor puede contener espacios)"""
+    await message.delete()
+    parts = (message.text or "").split(maxsplit=2)
+    if len(parts) == 1:
+        text = f"⚙️ **Ajustes** (`-cfset clave valor`, `default` para restaurar; * = cambiado)\n{runtime_settings.text()}"
+    else:
+        try:
+            tunable = runtime_settings.get(parts[1])
+            if len(parts) == 2:
+                text = (f"⚙️ `{tunable.name}` = {tunable.format(tunable.getter())}\n"
+                        f"{tunable.description} (por defecto: {tunable.format(tunable.default)})")
+            else:
+                value = await runtime_settings.set(parts[1], parts[2])
+                text = f"✅ `{tunable.name}` = {tunable.format(value)}"
+        except ConfigError as e:
+            text = f"❌ {e}"
+    msg = await message.reply_text(text, parse_mode=ParseMode.MARKDOWN)
+    delete_later(msg, 30)
+
+@app.on_message(filters.command("cfprobe", prefixes=["-"]) & filters.me)
+async def chatfight_probe_cmd(client: Client, message: Message):
+    """Sonda de latencia; respondiendo a una foto, la fija antes como imagen de referencia"""
+    target = message.reply_to_message
+    if target is not None:
+        tipo = message.command[1] if len(message.command) > 1 else None
+        if tipo is None:
+            tipo = classify_game(target) or next(iter(GAME_TYPES))
+        if tipo not in GAME_TYPES:
+            await message.delete()
+            msg = await message.reply_text(f"❌ Tipo desconocido: {tipo} ({', '.join(GAME_TYPES)})")
+            delete_later(msg, 10)
+            return
+        if not runtime_settings.remember_probe(target, tipo):
+            await message.delete()
+            msg = await message.reply_text("❌ El mensaje no contiene una imagen")
+            delete_later(msg, 10)
+            return
+    # La respuesta de la sonda va al propio comando: se borra después de enviarla
+    text = await run_probe(client, message)
+    await message.delete()
+    msg = await message.reply_text(text, parse_mode=ParseMode.MARKDOWN)
+    delete_later(msg, 30)
 
 # =============================================================================
 # MAIN
@@ -594,28 +4119,80 @@ async def chatfight_toggle_cmd(_, message: Message):
 async def main():
     log.info("Starting ChatFight Bot...")
     
-    # Conectar a MongoDB
-    if not init_chatfight_db():
-        log.warning("MongoDB no disponible. Continuando sin persistencia.")
+    # La configuración se leyó al importar: comprobar que no hubo errores antes de abrir conexiones
+    try:
+        settings.validate()
+    except ConfigError as e:
+        log.error(f"Configuración no válida: {e}")
+        return
     
-    # Iniciar el cliente (ya creado a nivel de módulo)
+    # MongoDB se conecta en segundo plano: no retrasa la primera respuesta
+    background_tasks = [asyncio.create_task(
+        connect_database(settings.mongo_uri, settings.mongo_timeout, settings.mongo_retry_max)
+    )]
+    
+    # Iniciar los clientes (ya creados a nivel de módulo)
     try:
-        await app.start()
+        for client in accounts.values():
+            await client.start()
     except Exception as e:
         log.error(f"Error iniciando el cliente: {e}")
         return
     
-    log.info("ChatFight Bot iniciado correctamente!")
+    log.info(f"ChatFight Bot iniciado correctamente! ({len(accounts)} cuentas, {len(shards)} grupos)")
+    
+    # Volcado periódico de estadísticas de cada grupo en segundo plano
+    for shard in shards.values():
+        shard.writer.start()
+    history_writer.start()
+    router.writer.start()
+    runtime_settings.writer.start()
+    loop_monitor.start()
+    post_processor.start()
+    
+    # Exportación opcional de métricas de latencia
+    if settings.metrics_file:
+        background_tasks.append(asyncio.create_task(metrics_file_exporter(settings.metrics_file)))
+    metrics_server = None
+    if settings.metrics_port:
+        try:
+            metrics_server = await start_metrics_server()
+        except OSError as e:
+            log.error(f"[ChatFight] No se pudo abrir el endpoint de métricas: {e}")
     
     # Inicializar módulo ChatFight con Groq
-    if GROQ_API_KEY:
-        init_chatfight_module(GROQ_API_KEY)
+    if settings.groq_api_keys:
+        init_chatfight_module(settings.groq_api_keys[0], list(settings.groq_api_keys))
     else:
         log.warning("[ChatFight] GROQ_API_KEY no configurado. El módulo ChatFight no funcionará.")
     
+    # Calentar conexiones en segundo plano (los juegos que lleguen antes se atienden igual)
+    background_tasks.append(asyncio.create_task(warm_up_connections()))
+    
     # Mantener el bot corriendo
-    await app.idle()
-    await app.stop()
+    await idle()
+    
+    # Cancelar el trabajo pendiente antes de cerrar
+    for task in list(_chatfight_tasks):
+        task.cancel()
+    if _chatfight_processor is not None:
+        await _chatfight_processor.close()
+    media_keepalive.stop()
+    if _local_solver is not None:
+        _local_solver.close()
+    await post_processor.stop()
+    for shard in shards.values():
+        await shard.writer.stop()
+    await history_writer.stop()
+    await router.writer.stop()
+    await runtime_settings.writer.stop()
+    await loop_monitor.stop()
+    for task in background_tasks:
+        task.cancel()
+    if metrics_server is not None:
+        metrics_server.close()
+    for client in accounts.values():
+        await client.stop()
 
 
 if __name__ == "__main__":
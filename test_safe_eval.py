@@ -0,0 +1,63 @@
+"""Pruebas de safe_eval, el evaluador por AST de las operaciones que lee el OCR"""
+
+import pytest
+
+from main import normalize_expression, safe_eval
+
+
+@pytest.mark.parametrize("expression, expected", [
+    ("2+3", 5),
+    ("12 - 20", -8),
+    ("7*6", 42),
+    ("-4*3", -12),
+    ("(2+3)*4", 20),
+    ("8/4", 2),
+    ("100/25+1", 5),
+])
+def test_evaluates_integer_arithmetic(expression, expected):
+    result = safe_eval(expression)
+    assert result == expected
+    assert type(result) is int
+
+
+@pytest.mark.parametrize("expression", [
+    "2**3",
+    "2**100000",
+    "9//2",
+    "7%3",
+    "2<<3",
+])
+def test_rejects_unsupported_operators(expression):
+    assert safe_eval(expression) is None
+
+
+@pytest.mark.parametrize("expression", [
+    "x+1",
+    "__import__",
+    "True+1",
+    "abs(-3)",
+    "__import__('os').system('true')",
+    "(1).__class__",
+    "[1]*3",
+    "'a'*3",
+    "lambda: 1",
+])
+def test_rejects_names_calls_and_other_nodes(expression):
+    assert safe_eval(expression) is None
+
+
+@pytest.mark.parametrize("expression", ["7/2", "1/3", "10/4*2+1/2"])
+def test_rejects_non_integer_division(expression):
+    assert safe_eval(expression) is None
+
+
+@pytest.mark.parametrize("expression", ["", "1/0", "2+", "1.5+1", "1e3+1", "1" + "+1" * 40])
+def test_rejects_malformed_or_oversized_input(expression):
+    assert safe_eval(expression) is None
+
+
+def test_normalized_ocr_text_cannot_smuggle_code():
+    # Lo que sobrevive a la normalización son solo dígitos, operadores y paréntesis
+    assert normalize_expression("__import__('os')") == "()"
+    assert safe_eval(normalize_expression("__import__('os')")) is None
+    assert safe_eval(normalize_expression("12 x 3 =")) == 36